@@ -76,7 +76,7 @@ class LispPrinter(Expr.Visitor):
         self.print(')')
     def visitWhileStmt(self, stmt):
         self.print('(while ')
-        self.visit(stmt.condition)
+        self.visit(stmt.condition) if stmt.condition is not None else self.print('true')
         self.print('\n')
         with self.incIndent():
             self.visitProgram(stmt.loop)
@@ -0,0 +1,517 @@
+'''Closure compiler: translate the resolved AST into nested python closures once,
+then run the program by calling the root closure. Every closure takes the
+current local Frame (None at global level) and returns the value of its node.'''
+
+import Expr
+from Scanner import *
+from LoxError import *
+from Functions import *
+from Resolver import Resolver
+from Environment import Frame, Cell, UNDEFINED
+from Interpreter import Interpreter, InterpType, Flow, lineOf, lookupMethod, lookupField, storeField, isSuper
+
+
+class ClosureCompiler(Expr.Visitor):
+    # fast paths when both operands are numbers
+    NumFns = { op : fn for (op, l, r), fn in Interpreter.FastFns.items() if l is float and r is float }
+
+    def __init__(self):
+        super().__init__()
+        self.globals = dict(lox_builtins)   # global vars, looked up by name
+        self.resolver = None
+
+    def interpret(self, ast, resolved=False):
+        rlt = self.compile(ast, resolved)(None)
+        if type(rlt) is Flow:
+            raise LoxFlowCtrl(rlt.token, rlt.value)
+        return rlt
+
+    def compile(self, ast, resolved=False):
+        if not resolved:    # not resolved by caller
+            if self.resolver is None: self.resolver = Resolver()
+            errors = self.resolver.resolve(ast)
+            if errors: raise errors[0]
+        return self.visit(ast)
+
+    def callFunc(self, func, args, this=UNDEFINED):
+        if len(args) != func.arity:
+            checkArity(func.name, func.arity, args)
+        rlt = func.code(Frame(func.env, func.frame(args, this)))
+        if type(rlt) is Flow:
+            if rlt.type is TokenType.RETURN: return rlt.value
+            raise LoxFlowCtrl(rlt.token, rlt.value)
+        return rlt
+
+    # helpers
+
+    def block(self, stmts):
+        '''run statements in order, the value of last statement is the result'''
+        if not stmts: return lambda env: None
+        # values of leading statements are dropped, only flow signals matter
+        body = [self.visit(s.expr) if isinstance(s, Expr.ExprStmt) else self.visit(s) for s in stmts[:-1]]
+        last = self.visit(stmts[-1])
+        if not body: return last
+        def run(env):
+            for s in body:
+                rlt = s(env)
+                if type(rlt) is Flow: return rlt
+            return last(env)
+        return run
+
+    def condition(self, expr, what, line=None):
+        '''evaluate expr as a boolean condition of statement `what`'''
+        value = self.visit(expr)
+        if line is None: line = lineOf(expr)
+        Boolean, INV = InterpType.Boolean, InterpType.INV
+        def cond(env):
+            v = value(env)
+            if v is True or v is False: return v
+            v = Boolean(v)
+            if v == INV:
+                raise InterpError(line, "{} statement requires a boolean condition".format(what))
+            return v
+        return cond
+
+    def frameOf(self, name, where):
+        '''returns (depth, slot) of name resolved to where, slot is the name for globals'''
+        depth, slot = where[0], where[1]    # where of super is followed by where of this
+        if depth < 0: return -1, name.lexeme
+        return depth, slot
+
+    def getter(self, name, where):
+        depth, slot = self.frameOf(name, where)
+        errUndeclared = Interpreter.errUndeclared
+        if depth < 0:
+            table = self.globals
+            def get(env):
+                try:
+                    return table[slot]
+                except KeyError:
+                    raise errUndeclared(name)
+        elif name.type == TokenType.SUPER:
+            thisOf, parentOf = self.superOf(name, where)
+            def get(env):
+                parent, this = parentOf(env), thisOf(env)
+                if this is UNDEFINED: return parent    # class method
+                return this.super(parent)   # a bare super
+        elif depth == 0:
+            def get(env):
+                value = env.values[slot]
+                if type(value) is Cell: value = value.value
+                if value is UNDEFINED: raise errUndeclared(name)
+                return value
+        elif depth == 1:
+            def get(env):
+                value = env.parent.values[slot]
+                if type(value) is Cell: value = value.value
+                if value is UNDEFINED: raise errUndeclared(name)
+                return value
+        else:
+            def get(env):
+                value = env.up(depth).values[slot]
+                if type(value) is Cell: value = value.value
+                if value is UNDEFINED: raise errUndeclared(name)
+                return value
+        return get
+
+    def superOf(self, name, where):
+        'returns (this(env), parent(env)) of super, this is UNDEFINED in a class method'
+        depth, slot, thisDepth, thisSlot = where
+        errUndeclared = Interpreter.errUndeclared
+        def parentOf(env):
+            parent = env.up(depth).values[slot]
+            if parent is UNDEFINED: raise errUndeclared(name)
+            return parent
+        return (lambda env: env.up(thisDepth).values[thisSlot]), parentOf
+
+    def setter(self, name, where, valueExpr):
+        depth, slot = self.frameOf(name, where)
+        value, errUndeclared = self.visit(valueExpr), Interpreter.errUndeclared
+        if depth < 0:
+            table = self.globals
+            def set(env):
+                if slot not in table: raise errUndeclared(name)
+                table[slot] = value(env)
+        else:
+            def set(env):
+                values = env.up(depth).values
+                old = values[slot]
+                if (old.value if type(old) is Cell else old) is UNDEFINED: raise errUndeclared(name)
+                new = value(env)    # which may make a closure boxing the slot
+                if type(values[slot]) is Cell: values[slot].value = new
+                else: values[slot] = new
+        return set
+
+    def definer(self, name, where, redefine=False):
+        '''returns define(env, value) declaring name in current scope'''
+        depth, slot = self.frameOf(name, where)
+        def errDuplicated():
+            return InterpError(name.line, "duplicated declaration of var {}".format(name.lexeme))
+        if depth < 0:
+            table = self.globals
+            def define(env, value):
+                if not redefine and slot in table: raise errDuplicated()
+                table[slot] = value
+        else:
+            def define(env, value):
+                values = env.values
+                old = values[slot]
+                if type(old) is Cell:   # captured before its value, see Resolver.Local
+                    if not redefine and old.value is not UNDEFINED: raise errDuplicated()
+                    old.value = value
+                    return
+                if not redefine and old is not UNDEFINED: raise errDuplicated()
+                values[slot] = value
+        return define
+
+    def function(self, stmt):
+        '''compile function body, which runs in the frame of the call'''
+        return self.block(stmt.block)
+
+    # statements
+
+    def visitProgram(self, prog):
+        return self.block(prog)
+
+    def visitScopeStmt(self, stmt):
+        run, size = self.block(stmt), stmt.nslots
+        return lambda env: run(Frame(env, [UNDEFINED] * size))
+
+    def visitPrintStmt(self, stmt):
+        value = self.visit(stmt.expr)
+        def run(env):
+            print(stringify(value(env)))
+        return run
+
+    def visitAssertStmt(self, stmt):
+        cond = self.condition(stmt.expr, 'assert', stmt.op.line)
+        def run(env):
+            if not cond(env):
+                from io import StringIO
+                from AstPrinter import LispPrinter
+                sp = LispPrinter(file=StringIO()).printProgram(stmt.expr, end='').getvalue()
+                raise AssertError(stmt.op.line, "assertion {} failed".format(sp))
+        return run
+
+    def visitExprStmt(self, stmt):
+        value = self.visit(stmt.expr)
+        if not stmt.semicolon: return value
+        def run(env):
+            value(env)
+        return run
+
+    def visitVarStmt(self, stmt):
+        define = self.definer(stmt.name, stmt.where)
+        if stmt.initial is None:
+            return lambda env: define(env, None)
+        initial, redefine = self.visit(stmt.initial), self.definer(stmt.name, stmt.where, redefine=True)
+        def run(env):
+            define(env, None)
+            redefine(env, initial(env))
+        return run
+
+    def visitFuncStmt(self, stmt):
+        code = self.function(stmt)
+        define = self.definer(stmt.name, stmt.where, redefine=True) if stmt.name else None
+        def run(env):
+            func = LoxFunc(stmt, env, code=code)   # lexical scope
+            if define: define(env, func)   # allow function redefine
+            return func
+        return run
+
+    def visitClassStmt(self, stmt):
+        parent = self.getter(stmt.parent, stmt.parent_where) if stmt.parent else None
+        codes = { method.name.lexeme : self.function(method) for method in stmt.members }
+        define = self.definer(stmt.name, stmt.where, redefine=True)
+        def method(func, env, method):
+            return LoxFunc(func, env, method=method, code=codes[func.name.lexeme])
+        def run(env):
+            cls = LoxClass.fromStmt(stmt, env, lookup=(lambda name: parent(env)), func=method)
+            define(env, cls)
+            return cls
+        return run
+
+    def visitIfStmt(self, stmt):
+        cond = self.condition(stmt.condition, 'if')
+        then_branch = self.visit(stmt.then_branch)
+        else_branch = self.visit(stmt.else_branch) if stmt.else_branch else (lambda env: None)
+        def run(env):
+            if cond(env):
+                return then_branch(env)
+            return else_branch(env)
+        return run
+
+    def visitWhileStmt(self, stmt):
+        cond = self.condition(stmt.condition, 'while') if stmt.condition is not None else None  # while (true)
+        loop = self.visit(stmt.loop)
+        iteration = self.visit(stmt.iteration) if stmt.iteration else (lambda env: None)
+        BREAK, RETURN = TokenType.BREAK, TokenType.RETURN
+        def run(env):
+            while cond is None or cond(env):
+                rlt = loop(env)
+                if type(rlt) is Flow:
+                    if rlt.type is BREAK: break
+                    if rlt.type is RETURN: return rlt
+                    # continue: goto iteration
+                iteration(env)
+        return run
+
+    def visitFlowStmt(self, stmt):
+        if stmt.value is None:
+            signal = Flow(stmt.type)
+            return lambda env: signal
+        value, token = self.visit(stmt.value), stmt.type
+        return lambda env: Flow(token, value(env))
+
+    # expressions
+
+    def visitBinaryExpr(self, expr):
+        op = expr.operator
+        if op.type == TokenType.EQUAL:
+            return self._visitAssignExpr(expr)
+        if op.type in (TokenType.AND, TokenType.OR):
+            return self._visitAndOrExpr(expr)
+        left, right = self.visit(expr.left), self.visit(expr.right)
+        if op.type == TokenType.EQUAL_EQUAL:
+            return lambda env: left(env) == right(env)
+        if op.type == TokenType.BANG_EQUAL:
+            return lambda env: left(env) != right(env)
+
+        fns, fast = Interpreter.BinFns[op.type], self.NumFns[op.type]
+        def slow(l, r):
+            for tl, tr, fn in fns:
+                vl, vr = tl(l), tr(r)
+                if vl == InterpType.INV or vr == InterpType.INV: continue
+                try:
+                    return fn(vl, vr)
+                except Exception as ex:
+                    raise RunningError(op.line, str(ex))
+            raise InterpError(op.line, "invalid operand(s) for operator {}".format(op))
+
+        literal = self.literal(expr.right)
+        if literal is not None and type(literal[0]) is float:
+            if self.literal(expr.left) is not None:   # both operands are known
+                try:
+                    value = slow(self.literal(expr.left)[0], literal[0])
+                    return lambda env: value
+                except LoxError:
+                    pass    # report at runtime
+            right = literal[0]
+            if op.type == TokenType.SLASH and right == 0:
+                return lambda env: slow(left(env), right)
+            def run(env):
+                l = left(env)
+                if type(l) is float: return fast(l, right)
+                return slow(l, right)
+        elif op.type == TokenType.PLUS:
+            def run(env):
+                l, r = left(env), right(env)
+                tl = type(l)
+                if tl is float and type(r) is float: return l + r
+                if (tl is str or tl is StrBuilder) and type(r) is str: return concat(l, r)
+                return slow(l, r)
+        elif op.type == TokenType.SLASH:
+            def run(env):
+                l, r = left(env), right(env)
+                if type(l) is float and type(r) is float and r: return l / r
+                return slow(l, r)
+        else:
+            def run(env):
+                l, r = left(env), right(env)
+                if type(l) is float and type(r) is float: return fast(l, r)
+                return slow(l, r)
+        return run
+
+    def literal(self, expr):
+        '''returns (value,) if expr is a literal, else None'''
+        while isinstance(expr, Expr.Grouping): expr = expr.expression
+        if not isinstance(expr, Expr.Literal): return None
+        return (Interpreter.visitLiteralExpr(self, expr),)
+
+    def visitAttribExpr(self, expr):
+        if isSuper(expr.object):
+            (thisOf, parentOf), get = self.superOf(expr.object.value, expr.object.where), self.superAttribute(expr)
+            def run(env):
+                parent = parentOf(env)
+                return get(thisOf(env), parent)
+            return run
+        object, get = self.visit(expr.object), self.attribute(expr)
+        return lambda env: get(object(env))
+
+    def attribute(self, expr):
+        'returns get(obj) of the Attrib expr: the field or method cached by lookupField and lookupMethod, or the attribute'
+        attr, line = expr.attribute.lexeme, expr.dot.line
+        def get(obj):
+            if type(obj) is LoxInstance:
+                cache = expr.field  # lookupField inlined for a hit
+                if cache is not None and cache[0] is obj.shape: return obj.values[cache[1]]
+                i = lookupField(expr, obj)
+                if i is not None: return obj.values[i]
+            fn = lookupMethod(expr, obj)
+            if fn is not None: return LoxMethod(obj, fn)
+            getter = getattr(obj, 'getattr', None)
+            if not getter:
+                raise InterpError(line, "left of operator '.' should be a gettable object")
+            try:
+                return getter(attr)
+            except KeyError:
+                raise InterpError(line, "{} doesn't have attr '{}'".format(obj, attr))
+        return get
+
+    def superAttribute(self, expr):
+        'returns get(this, parent) of super.name, the Attrib expr, as attribute() does without a LoxSuper'
+        attr, line, getAttr = expr.attribute.lexeme, expr.dot.line, self.attribute(expr)
+        def get(this, parent):
+            if this is UNDEFINED: return getAttr(parent)   # class method
+            i = lookupField(expr, this)
+            if i is not None: return this.values[i]
+            fn = lookupMethod(expr, this, parent)
+            if fn is not None: return LoxMethod(this, fn)
+            raise InterpError(line, "{} doesn't have attr '{}'".format(this.super(parent), attr))
+        return get
+
+    def _visitAssignExpr(self, expr):
+        if isinstance(expr.left, Expr.Identifier):
+            return self.setter(expr.left.value, expr.left.where, expr.right)
+        if isinstance(expr.left, Expr.Attrib):
+            return self._visitSetAttribExpr(expr.left, expr.right)
+        raise InterpError(expr.operator.line, "left value required before operator {}".format(expr.operator))
+
+    def _visitSetAttribExpr(self, expr, valueExpr):
+        attr, line = expr.attribute.lexeme, expr.dot.line
+        if isSuper(expr.object):    # the field of this
+            thisOf, parentOf = self.superOf(expr.object.value, expr.object.where)
+            def object(env):
+                parent, this = parentOf(env), thisOf(env)
+                return parent if this is UNDEFINED else this
+        else:
+            object = self.visit(expr.object)
+        value = self.visit(valueExpr)
+        def run(env):
+            obj = object(env)
+            if type(obj) is LoxInstance:
+                v, cache = value(env), expr.field
+                if cache is not None and cache[0] is obj.shape and cache[1] < len(obj.values):
+                    obj.values[cache[1]] = v    # storeField inlined for a hit on a field set before
+                else:
+                    storeField(expr, obj, v)
+                return
+            setter = getattr(obj, 'setattr', None)
+            if not setter:
+                raise InterpError(line, "left of operator '.' should be a settable object")
+            setter(attr, value(env))
+        return run
+
+    def _visitAndOrExpr(self, expr):
+        shortcircuit = (expr.operator.type == TokenType.OR) # or short-circuited by True, and by False
+        left, right, op = self.visit(expr.left), self.visit(expr.right), expr.operator
+        Boolean, INV = InterpType.Boolean, InterpType.INV
+        def run(env):
+            for opd in (left, right):
+                v = Boolean(opd(env))
+                if v == shortcircuit:
+                    return shortcircuit
+                if v == INV:
+                    raise InterpError(op.line, "invalid operand(s) for operator {}".format(op))
+            return not shortcircuit
+        return run
+
+    def visitGroupingExpr(self, expr):
+        return self.visit(expr.expression)
+
+    def visitUnaryExpr(self, expr):
+        right, op = self.visit(expr.right), expr.operator
+        fns = Interpreter.UniFns[op.type]
+        def slow(val):
+            for tp, fn in fns:
+                v = tp(val)
+                if v == InterpType.INV: continue
+                return fn(v)
+            raise InterpError(op.line, "invalid operand(s) for operator {}".format(op))
+        if op.type == TokenType.MINUS:
+            def run(env):
+                v = right(env)
+                if type(v) is float: return -v
+                return slow(v)
+        else:
+            def run(env):
+                v = right(env)
+                if v is True or v is False: return not v
+                return slow(v)
+        return run
+
+    def visitLiteralExpr(self, expr):
+        value = Interpreter.visitLiteralExpr(self, expr)
+        return lambda env: value
+
+    def visitIdentifierExpr(self, expr):
+        return self.getter(expr.value, expr.where)
+
+    def visitCallExpr(self, expr):
+        line = expr.paran.line
+        args = [self.visit(v) for v in expr.args]
+        callFunc = self.callFunc
+        def call(func, args, this=UNDEFINED):
+            try:
+                if type(func) is LoxFunc: return callFunc(func, args, this)
+                return func(self, args)
+            except LoxFuncArgc as ex:
+                if not ex.args[0]:  # raised by the callee itself
+                    ex.args = (line, ex.args[1])
+                raise ex
+            except RecursionError: # out of python stack, the vm engine is not
+                raise LoxStackOverflow(line, 'stack overflow') from None
+        def errCallable(func):
+            return InterpError(line, "need a callable object before '(', got {}".format(stringify(func)))
+        if type(expr.callee) is Expr.Attrib and isSuper(expr.callee.object):  # super.method(), called on this
+            attrib, attr = expr.callee, expr.callee.attribute.lexeme
+            (thisOf, parentOf), get = self.superOf(attrib.object.value, attrib.object.where), self.superAttribute(attrib)
+            def run(env):
+                parent, this = parentOf(env), thisOf(env)
+                if type(this) is LoxInstance and attr not in this.shape.fields:
+                    cache = attrib.method
+                    fn = cache[1] if cache is not None and cache[0] is parent else lookupMethod(attrib, this, parent)
+                    if type(fn) is LoxFunc:
+                        return call(fn, [arg(env) for arg in args], this)
+                func = get(this, parent)
+                if not callable(func): raise errCallable(func)
+                return call(func, [arg(env) for arg in args])
+            return run
+        if type(expr.callee) is Expr.Attrib:    # obj.method(), called without making a LoxMethod
+            attrib, attr = expr.callee, expr.callee.attribute.lexeme
+            object, get = self.visit(attrib.object), self.attribute(attrib)
+            def run(env):
+                obj = object(env)
+                if type(obj) is LoxInstance and attr not in obj.shape.fields:
+                    cache = attrib.method   # lookupMethod inlined for a hit
+                    fn = cache[1] if cache is not None and cache[0] is obj.cls else lookupMethod(attrib, obj)
+                    if type(fn) is LoxFunc:
+                        return call(fn, [arg(env) for arg in args], obj)
+                func = get(obj)
+                if not callable(func): raise errCallable(func)
+                return call(func, [arg(env) for arg in args])
+            return run
+        callee = self.visit(expr.callee)
+        if len(args) == 0:
+            def run(env):
+                func = callee(env)
+                if not callable(func): raise errCallable(func)
+                return call(func, [])
+        elif len(args) == 1:
+            arg0, = args
+            def run(env):
+                func = callee(env)
+                if not callable(func): raise errCallable(func)
+                return call(func, [arg0(env)])
+        elif len(args) == 2:
+            arg0, arg1 = args
+            def run(env):
+                func = callee(env)
+                if not callable(func): raise errCallable(func)
+                return call(func, [arg0(env), arg1(env)])
+        else:
+            def run(env):
+                func = callee(env)
+                if not callable(func): raise errCallable(func)
+                return call(func, [arg(env) for arg in args])
+        return run
@@ -1,99 +1,352 @@
+import os, math, marshal, hashlib, tempfile
 from contextlib import contextmanager
 import Expr
 from Scanner import *
 from LoxError import *
-from StackVM import StackVM
+from Interpreter import lineOf, isSuper
+from StackVM import StackVM, FuncProto, ClassProto
+
+class FuncState:
+    """compile-time scopes of the function being compiled"""
+    def __init__(self, enclosing=None, slot0=None):
+        self.enclosing = enclosing
+        self.locals = [] if slot0 is None else [(slot0, 0)] # (name, depth), index is the stack slot
+        self.upvalues = []  # (isLocal, index) of captured vars
+        self.depth = 0      # scope depth inside the function
+        self.loops = []     # [nlocals, breaks, continues] of enclosing loops
+
+    def isGlobal(self):
+        return self.enclosing is None and self.depth == 0
+
+    def declare(self, name):
+        '''slot of a new local var, the first one reserved by the scope if any;
+        a redefined name in the same scope keeps its slot'''
+        free = None
+        for i in range(len(self.locals) - 1, -1, -1):
+            if self.locals[i][1] < self.depth: break
+            if self.locals[i][0] == name: return i
+            if self.locals[i][0] is None: free = i
+        if free is not None:
+            self.locals[free] = (name, self.depth)
+            return free
+        self.locals.append((name, self.depth))
+        return len(self.locals) - 1
+
+    def reserve(self, n):
+        'n slots pushed by RESERVE for the locals the scope declares later, so locals match the stack'
+        self.locals.extend([(None, self.depth)] * n)
+
+    def resolveLocal(self, name):
+        for i in range(len(self.locals) - 1, -1, -1):
+            if self.locals[i][0] == name: return i
+        return -1
+
+    def resolveUpvalue(self, name):
+        if self.enclosing is None: return -1
+        i = self.enclosing.resolveLocal(name)
+        if i >= 0: return self.addUpvalue(True, i)
+        i = self.enclosing.resolveUpvalue(name)
+        if i >= 0: return self.addUpvalue(False, i)
+        return -1
+
+    def addUpvalue(self, isLocal, index):
+        if (isLocal, index) not in self.upvalues:
+            self.upvalues.append((isLocal, index))
+        return self.upvalues.index((isLocal, index))
+
+    def endScope(self):
+        'leave a scope, returns number of its locals'
+        n = 0
+        while self.locals and self.locals[-1][1] >= self.depth:
+            self.locals.pop()
+            n += 1
+        self.depth -= 1
+        return n
 
 class Compiler(Expr.Visitor):
-    """description of class"""
+    """compiles resolved ast to StackVM code"""
+    VERSION = 11     # bump when the code or data format changes, to invalidate .loxc caches
+
     def __init__(self):
         super().__init__()
         self.code = bytearray()
-        self.data = []
+        self.data = []      # constants: literals, prototypes and messages
+        self.names = []     # names of globals, attributes and methods
+        self.dataSlots, self.nameSlots = {}, {}     # key(value) => its index in data, names
+        self.lines = []     # [(pc, line)], where source lines change
+        self.notes = {}     # pc => token or statement kind, for error messages
+        self.line = None
+        self.fs = FuncState()   # top level
 
-    def append(self, op, opd=None):
+    def append(self, op, opd=None, note=None):
+        '''an operand beyond 16 bits is prefixed by EXTENDED_ARG with its higher bits (but a jump,
+        appended by jump() with its prefix)'''
+        if opd is not None and not -0x8000 <= opd < 0x8000 and op not in StackVM.Jumps:
+            self.append(StackVM.EXTENDED_ARG, opd >> 16)
+            opd = (opd & 0x7fff) - (opd & 0x8000)   # the lower 16 bits, signed
         pc = self.pc
+        if self.line is not None and (not self.lines or self.lines[-1][1] != self.line):
+            self.lines.append((pc, self.line))
+        if note is not None: self.notes[pc] = note
         self.code.append(op)
         if opd is not None:
             self.code.extend(self.operand(opd))
         return pc
 
     def operand(self, opd):
+        if not -0x8000 <= opd < 0x8000:
+            raise CompileError(self.line, "operand {} out of range".format(opd))
         return [opd & 0xff, (opd >> 8) & 0xff]
 
+    def jump(self, op, note=None):
+        '''a jump filled later by filljmp, its operand 32 bits wide: an EXTENDED_ARG slot is kept
+        before it, and the Peephole pass drops the ones not needed; returns the pc of the jump'''
+        self.append(StackVM.EXTENDED_ARG, 0)
+        return self.append(op, 0, note)
+
     def filljmp(self, ins, target=None):
+        'point the jump at pc ins, after its EXTENDED_ARG, to target (the next pc by default)'
         if target is None: target = self.pc
         dist = target - (ins + 3)
-        v = self.operand(dist)
-        self.code[ins+1] = v[0]
-        self.code[ins+2] = v[1]
+        self.code[ins-2:ins] = bytes(self.operand(dist >> 16))
+        self.code[ins+1:ins+3] = bytes((dist & 0xff, dist >> 8 & 0xff))
+
+    def mark(self, line):
+        'source line of code appended next'
+        if line is not None: self.line = line
 
     @property
     def pc(self):
         return len(self.code)
 
+    @staticmethod
+    def key(value):
+        'what tells values apart in a table: 1.0, true and "1" are different constants, so are 0 and -0'
+        if type(value) is float: return float, value, math.copysign(1.0, value)
+        return type(value), value
+
+    def slot(self, table, slots, value):
+        'index of value in table, appended if new; slots: its index'
+        key = self.key(value)
+        i = slots.get(key)
+        if i is None:
+            i = slots[key] = len(table)
+            table.append(value)
+        return i
+
+    def constant(self, value):
+        return self.slot(self.data, self.dataSlots, value)
+
+    def name(self, name):
+        return self.slot(self.names, self.nameSlots, name)
+
     def compile(self, prog):
-        self.visit(prog)
+        self.statements(prog, valued=True)
 
-    def visitProgram(self, prog):
-        for stmt in prog:
+    def statements(self, stmts, valued=False):
+        'compile a statement list, valued: leave value of the last one on stack'
+        for i, stmt in enumerate(stmts):
+            self.statement(stmt, valued and i == len(stmts) - 1)
+        if valued and not stmts:
+            self.append(StackVM.LOAD, self.constant(None))
+
+    def statement(self, stmt, valued=False):
+        '''valued statement leaves its value on stack, used at the end of a function or program
+        (where locals below it are dropped anyway)'''
+        if isinstance(stmt, Expr.Literal):  # void statement
+            if valued: self.append(StackVM.LOAD, self.constant(None))
+        elif not valued:
+            self.visit(stmt)
+        elif isinstance(stmt, Expr.ExprStmt):
+            if stmt.semicolon:
+                self.discard(stmt.expr)
+                self.append(StackVM.LOAD, self.constant(None))
+            else:
+                self.visit(stmt.expr)
+        elif isinstance(stmt, (Expr.FuncStmt, Expr.ClassStmt)):
             self.visit(stmt)
+            self.load(stmt.name)
+        elif isinstance(stmt, Expr.IfStmt):
+            self.visitIfStmt(stmt, valued=True)
+        elif isinstance(stmt, Expr.ScopeStmt):
+            self.visitScopeStmt(stmt, valued=True)
+        else:
+            self.visit(stmt)
+            self.append(StackVM.LOAD, self.constant(None))
+
+    # variables
+    def load(self, name):
+        fs = self.fs
+        self.mark(name.line)
+        slot = fs.resolveLocal(name.lexeme)
+        if slot >= 0: return self.append(StackVM.GET_LOCAL, slot, note=name)
+        slot = fs.resolveUpvalue(name.lexeme)
+        if slot >= 0: return self.append(StackVM.GET_UPVALUE, slot, note=name)
+        self.append(StackVM.GET_GLOBAL, self.name(name.lexeme), note=name)
+
+    def store(self, name):
+        fs = self.fs
+        self.mark(name.line)
+        slot = fs.resolveLocal(name.lexeme)
+        if slot >= 0: return self.append(StackVM.SET_LOCAL, slot, note=name)
+        slot = fs.resolveUpvalue(name.lexeme)
+        if slot >= 0: return self.append(StackVM.SET_UPVALUE, slot, note=name)
+        self.append(StackVM.SET_GLOBAL, self.name(name.lexeme), note=name)
+
+    def define(self, slot, name, redefine=False):
+        'pop value to a declared var, slot is None for global'
+        if slot is not None:
+            return self.append(StackVM.SET_LOCAL, slot, note=name)
+        self.mark(name.line)
+        op = StackVM.REDEF_GLOBAL if redefine else StackVM.DEF_GLOBAL
+        self.append(op, self.name(name.lexeme), note=name)
+
+    def declare(self, name):
+        return None if self.fs.isGlobal() else self.fs.declare(name.lexeme)
 
-    def visitScopeStmt(self, stmt):
-        self.visitProgram(stmt)
+    @contextmanager
+    def scope(self, valued=False):
+        'locals of the scope are dropped at its end, unless left for a valued statement'
+        self.fs.depth += 1
+        yield
+        n = self.fs.endScope()
+        if n and not valued: self.append(StackVM.DISCARD, n)
+
+    # statements
+    def visitProgram(self, prog):
+        self.statements(prog)
+
+    def visitScopeStmt(self, stmt, valued=False):
+        with self.scope(valued):
+            if stmt.nslots:
+                self.append(StackVM.RESERVE, stmt.nslots)
+                self.fs.reserve(stmt.nslots)
+            self.statements(stmt, valued)
 
     def visitPrintStmt(self, stmt):
         self.visit(stmt.expr)
         self.append(StackVM.PRINT)
 
     def visitAssertStmt(self, stmt):
-        pass
+        from io import StringIO
+        from AstPrinter import LispPrinter
+        self.visit(stmt.expr)
+        self.mark(stmt.op.line)
+        ok = self.jump(StackVM.JNZ, note='assert')
+        sp = LispPrinter(file=StringIO()).printProgram(stmt.expr, end='').getvalue()
+        self.append(StackVM.ASSERT, self.constant("assertion {} failed".format(sp)))
+        self.filljmp(ok)
 
     def visitExprStmt(self, stmt):
-        self.visit(stmt.expr)
-        if stmt.semicolon: self.append(StackVM.POP)
+        self.discard(stmt.expr)
 
     def visitVarStmt(self, stmt):
-        self.data.append(stmt.name.lexeme)
-        if stmt.initial:
-            pos = len(self.data) - 1
+        slot = self.declare(stmt.name)
+        if stmt.initial is not None:
             self.visit(stmt.initial)
-            self.append(StackVM.SAVE, pos)
+        else:
+            self.append(StackVM.LOAD, self.constant(None))
+        self.define(slot, stmt.name)
+
+    def function(self, stmt, method=False):
+        'compile function body, leaves the closure on stack'
+        over = self.jump(StackVM.JMP)
+        entry = self.pc
+        fs = self.fs = FuncState(self.fs, 'this' if method else '')
+        for p in stmt.params: fs.declare(p.lexeme)
+        nlocals = stmt.block.nslots - len(stmt.params) - int(method)
+        if nlocals > 0:
+            self.append(StackVM.RESERVE, nlocals)
+            fs.reserve(nlocals)
+        self.statements(stmt.block, valued=True)
+        self.append(StackVM.RETURN)
+        self.fs = fs.enclosing
+        self.filljmp(over)
+        name = stmt.name.lexeme if stmt.name else '<anonymous>'
+        proto = FuncProto(name, len(stmt.params), entry, tuple(fs.upvalues), method, stmt.line)
+        self.append(StackVM.CLOSURE, self.constant(proto))
 
     def visitFuncStmt(self, stmt):
-        pass
+        if not stmt.name:   # lambda
+            return self.function(stmt)
+        slot = self.declare(stmt.name)
+        self.function(stmt)
+        self.define(slot, stmt.name, redefine=True)
 
     def visitClassStmt(self, stmt):
-        pass
+        slot = self.declare(stmt.name)
+        with self.scope():
+            if stmt.parent:
+                self.load(stmt.parent)
+            else:
+                self.append(StackVM.LOAD, self.constant(None))
+            self.mark(stmt.name.line)
+            self.append(StackVM.INHERIT)
+            self.fs.declare('super')
+            for method in stmt.members:
+                self.function(method, method=True)
+            proto = ClassProto(stmt.name.lexeme, tuple(m.name.lexeme for m in stmt.members), stmt.name.line)
+            self.append(StackVM.CLASS, self.constant(proto))
+            self.define(slot, stmt.name, redefine=True)
+
+    def condition(self, expr, kind, op=StackVM.JZ):
+        'compile condition and the jump taken on false (or true with JNZ)'
+        self.visit(expr)
+        self.mark(lineOf(expr))
+        return self.jump(op, note=kind)
 
-    def visitIfStmt(self, stmt):
-        self.visit(stmt.condition)
-        cond = self.append(StackVM.JZ, 0)
-        self.visit(stmt.then_branch)
-        if not stmt.else_branch:
+    def visitIfStmt(self, stmt, valued=False):
+        cond = self.condition(stmt.condition, 'if')
+        self.statement(stmt.then_branch, valued)
+        if not stmt.else_branch and not valued:
             self.filljmp(cond)
         else:
-            end = self.append(StackVM.JMP, 0)
+            end = self.jump(StackVM.JMP)
             self.filljmp(cond)
-            self.visit(stmt.else_branch)
+            if stmt.else_branch:
+                self.statement(stmt.else_branch, valued)
+            else:
+                self.append(StackVM.LOAD, self.constant(None))
             self.filljmp(end)
 
     def visitWhileStmt(self, stmt):
         before = self.pc
-        self.visit(stmt.condition)
-        cond = self.append(StackVM.JNZ, 0)
-        self.visitProgram(stmt.loop)
+        cond = self.condition(stmt.condition, 'while') if stmt.condition is not None else None  # while (true)
+        loop = [len(self.fs.locals), [], []]
+        self.fs.loops.append(loop)
+        self.statement(stmt.loop)
+        self.fs.loops.pop()
+        for ins in loop[2]: self.filljmp(ins)
         if stmt.iteration:
-            self.visit(stmt.iteration)
-        self.append(StackVM.JMP, before - (self.pc + 3))
-        self.filljmp(cond)
+            self.discard(stmt.iteration)
+        self.filljmp(self.jump(StackVM.JMP), before)
+        if cond is not None: self.filljmp(cond)
+        for ins in loop[1]: self.filljmp(ins)
 
     def visitFlowStmt(self, stmt):
-        pass
+        self.mark(stmt.type.line)
+        if stmt.type.type == TokenType.RETURN:
+            if type(stmt.value) is Expr.Call:
+                self.visitCallExpr(stmt.value, tail=True)
+            elif stmt.value is not None:
+                self.visit(stmt.value)
+            else:
+                self.append(StackVM.LOAD, self.constant(None))
+            return self.append(StackVM.RETURN)
+        if not self.fs.loops:
+            raise CompileError(stmt.type.line, 'unexpected {} statement'.format(stmt.type.lexeme))
+        nlocals, breaks, continues = self.fs.loops[-1]
+        n = len(self.fs.locals) - nlocals
+        if n: self.append(StackVM.DISCARD, n)
+        jmp = self.jump(StackVM.JMP)
+        (breaks if stmt.type.type == TokenType.BREAK else continues).append(jmp)
 
+    # expressions
     def visitBinaryExpr(self, expr):
         if expr.operator.type == TokenType.EQUAL:
             return self._visitAssignExpr(expr)
+        if expr.operator.type in (TokenType.AND, TokenType.OR):
+            return self._visitAndOrExpr(expr)
 
         opmap = {
             TokenType.EQUAL_EQUAL   :   StackVM.EQUAL,
@@ -110,33 +363,85 @@ class Compiler(Expr.Visitor):
         op = opmap[expr.operator.type]
         self.visit(expr.left)
         self.visit(expr.right)
+        self.mark(expr.operator.line)
         self.append(op)
 
-    def _visitAssignExpr(self, expr):
+    def discard(self, expr):
+        'compile expr for its effects, its value popped'
+        if isinstance(expr, Expr.Binary) and expr.operator.type == TokenType.EQUAL:
+            self._visitAssignExpr(expr, used=False)
+        else:
+            self.visit(expr)
+        self.append(StackVM.POP)
+
+    def _visitAssignExpr(self, expr, used=True):
+        '''an assignment is valued nil; unused, it leaves the assigned value for the POP after it,
+        and DUP; SET_LOCAL; POP is one instruction after the Peephole pass'''
         if isinstance(expr.left, Expr.Identifier):
-            name = expr.left.value
-            idx = self.data.index(name.lexeme)
             self.visit(expr.right)
-            self.append(StackVM.DUP)
-            self.append(StackVM.SAVE, idx)
+            if not used: self.append(StackVM.DUP)
+            self.store(expr.left.value)
+        elif isinstance(expr.left, Expr.Attrib) and isSuper(expr.left.object):
+            self.load(expr.left.object.value)
+            self.visit(expr.right)
+            self.mark(expr.left.dot.line)
+            self.append(StackVM.SET_SUPER, self.name((expr.left.attribute.lexeme, self.thisOfSuper())))
+        elif isinstance(expr.left, Expr.Attrib):
+            self.visit(expr.left.object)
+            self.visit(expr.right)
+            self.mark(expr.left.dot.line)
+            self.append(StackVM.SET_ATTR, self.name(expr.left.attribute.lexeme))
+            if used: self.append(StackVM.POP)
+        else:
+            raise CompileError(expr.operator.line, "left value required before operator {}".format(expr.operator))
+        if used: self.append(StackVM.LOAD, self.constant(None))
+
+    def _visitAndOrExpr(self, expr):
+        kind = expr.operator.lexeme
+        op = StackVM.JNZ if expr.operator.type == TokenType.OR else StackVM.JZ # short-circuit jump
+        jmps = []
+        for opd in (expr.left, expr.right):
+            self.visit(opd)
+            self.mark(expr.operator.line)
+            jmps.append(self.jump(op, note=kind))
+        self.append(StackVM.LOAD, self.constant(op == StackVM.JZ))
+        end = self.jump(StackVM.JMP)
+        for ins in jmps: self.filljmp(ins)
+        self.append(StackVM.LOAD, self.constant(op == StackVM.JNZ))
+        self.filljmp(end)
 
     def visitGroupingExpr(self, expr):
         self.visit(expr.expression)
 
     def visitLiteralExpr(self, expr):
-        try:
-            idx = self.data.index(expr.value.literal)
-        except ValueError:
-            self.data.append(expr.value.literal)
-            idx = len(self.data) - 1
-        self.append(StackVM.LOAD, idx)
+        tok = expr.value
+        self.mark(tok.line)
+        if tok.type in (TokenType.TRUE, TokenType.FALSE):
+            value = tok.type == TokenType.TRUE
+        else:
+            value = tok.literal
+        self.append(StackVM.LOAD, self.constant(value))
 
     def visitIdentifierExpr(self, expr):
-        idx = self.data.index(expr.value.lexeme)
-        self.append(StackVM.LOAD, idx)
+        name = expr.value
+        if name.type != TokenType.SUPER:
+            return self.load(name)
+        self.load(name)     # parent class
+        self.append(StackVM.SUPER, self.thisOfSuper())
+
+    def thisOfSuper(self):
+        'where SUPER finds this: 0 for local slot 0, upvalue index + 1 otherwise'
+        slot = self.fs.resolveLocal('this')
+        return 0 if slot == 0 else self.fs.resolveUpvalue('this') + 1
 
     def visitAttribExpr(self, expr):
-        pass
+        if isSuper(expr.object):    # super.name: on this, without a bare super
+            self.load(expr.object.value)
+            self.mark(expr.dot.line)
+            return self.append(StackVM.GET_SUPER, self.name((expr.attribute.lexeme, self.thisOfSuper())))
+        self.visit(expr.object)
+        self.mark(expr.dot.line)
+        self.append(StackVM.GET_ATTR, self.name(expr.attribute.lexeme))
 
     def visitUnaryExpr(self, expr):
         opmap = {
@@ -145,9 +450,85 @@ class Compiler(Expr.Visitor):
         }
         op = opmap[expr.operator.type]
         self.visit(expr.right)
+        self.mark(expr.operator.line)
         self.append(op)
 
-    def visitCallExpr(self, expr):
-        pass
+    def visitCallExpr(self, expr, tail=False):
+        '''tail: the call is returned, by TAIL_CALL or TAIL_CALL_METHOD, followed by the RETURN'''
+        method = type(expr.callee) is Expr.Attrib
+        if method and isSuper(expr.callee.object):  # super.method(): called on this
+            self.load(expr.callee.object.value)
+            self.mark(expr.callee.dot.line)
+            self.append(StackVM.SUPER_METHOD, self.name((expr.callee.attribute.lexeme, self.thisOfSuper())))
+        elif method:    # obj.method(): this is passed on stack instead of a LoxMethod
+            self.visit(expr.callee.object)
+            self.mark(expr.callee.dot.line)
+            self.append(StackVM.GET_METHOD, self.name(expr.callee.attribute.lexeme))
+        else:
+            self.visit(expr.callee)
+        for arg in expr.args:
+            self.visit(arg)
+        self.mark(expr.paran.line)
+        if tail:
+            self.append(StackVM.TAIL_CALL_METHOD if method else StackVM.TAIL_CALL, len(expr.args))
+        else:
+            self.append(StackVM.CALL_METHOD if method else StackVM.CALL, len(expr.args))
+
+
+# .loxc cache of compiled programs: a header (magic, version, key) checked before the rest is read,
+# then the tables as plain values, so that loading the file never runs code (as unpickling can)
+MAGIC = b'LOXC'
+
+def sourceKey(source, optimize=True):
+    '''source: a str, or an iterable of str chunks (RegexScanner.chunksOf) hashed without joining them;
+    optimize: whether the Optimizer and Peephole passes ran, a cache of the other setting is stale'''
+    h = hashlib.sha256('{}\0{:d}\0'.format(Compiler.VERSION, optimize).encode())
+    for chunk in ([source] if isinstance(source, str) else source):
+        h.update(chunk.encode())
+    return h.hexdigest()
+
+def dumpValue(v):
+    'a prototype, token or tuple as a tagged tuple, marshal keeps the other values as they are'
+    if type(v) is FuncProto: return ('F', *v)
+    if type(v) is ClassProto: return ('C', *v)
+    if type(v) is Token: return ('T', v.type.value, v.lexeme, v.literal, v.line)
+    if type(v) is tuple: return ('t', *v)
+    return v
+
+def loadValue(v):
+    if type(v) is not tuple: return v
+    tag, *fields = v
+    if tag == 'F': return FuncProto(*fields)
+    if tag == 'C': return ClassProto(*fields)
+    if tag == 'T': return Token(TokenType(fields[0]), *fields[1:])
+    return tuple(fields)
+
+def loadCache(path, key):
+    'returns (code, data, lines, notes, names) cached for the source of sourceKey key, None if missing or stale'
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC or marshal.load(f) != (Compiler.VERSION, key):
+                return None
+            code, data, lines, notes, names = marshal.load(f)
+        return (code, [loadValue(v) for v in data], list(lines),
+                { pc : loadValue(note) for pc, note in notes.items() }, [loadValue(v) for v in names])
+    except Exception:   # missing, truncated or from an incompatible build
+        return None
 
+def saveCache(path, key, compiler):
+    tables = (bytes(compiler.code), [dumpValue(v) for v in compiler.data], compiler.lines,
+              { pc : dumpValue(note) for pc, note in compiler.notes.items() }, [dumpValue(v) for v in compiler.names])
+    writeAtomic(path, MAGIC + marshal.dumps((Compiler.VERSION, key)) + marshal.dumps(tables))
 
+def writeAtomic(path, data):
+    'write atomically, so a concurrent reader sees either the old or the new file'
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        umask = os.umask(0); os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)   # mkstemp makes it private
+        os.replace(tmp, path)
+    except OSError:     # read-only dir etc., just run without cache
+        try: os.unlink(tmp)
+        except (OSError, NameError): pass
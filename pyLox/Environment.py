@@ -1,13 +1,16 @@
 
 class KVList(list):
+    """[key, value] pairs in order, the first index of each key is kept in a dict"""
+    def __init__(self):
+        super().__init__()
+        self.positions = {}
     def append(self, kv):
+        self.positions.setdefault(kv[0], len(self))
         super().append(list(kv))
     def extend(self, kvs):
-        super().extend([k, v] for k, v in kvs)
+        for kv in kvs: self.append(kv)
     def lookup(self, key):
-        for i, (k, v) in enumerate(self):
-            if k == key: return i
-        return -1
+        return self.positions.get(key, -1)
     def index(self, key):
         i = self.lookup(key)
         if i < 0: raise KeyError(key)
@@ -90,3 +93,49 @@ class Environment:
 
     def value(self, name, depth=None):
         return self.lookup(name, depth=depth)[1]
+
+
+class Undefined:
+    """marks a slot whose variable is not declared yet"""
+    def __repr__(self):
+        return '<undefined>'
+UNDEFINED = Undefined()
+
+
+class Frame:
+    """Local env resolved by Resolver: variables live in fixed slots, no names kept;
+    values is the slot array, of the frame size, owned by the frame"""
+    __slots__ = ('values', 'parent')
+    def __init__(self, parent=None, values=()):
+        self.values = values
+        self.parent = parent
+
+    def up(self, depth):
+        '''returns the frame at depth'''
+        env = self
+        for i in range(depth):
+            env = env.parent
+        return env
+
+
+class Cell:
+    """a captured variable shared by its scope and the closures, which may assign it:
+    a slot holding a Cell holds the variable in it, see Resolver.Local"""
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+
+
+def capture(captures, env):
+    '''the closure of a function made in the local Frame env: a Frame of the values of the variables
+    it captures, (depth, slot, boxed) from env, None if it captures none. A boxed variable is moved
+    into a Cell, left in its slot, so the closure shares it, the others are copied'''
+    if not captures: return None
+    values = []
+    for depth, slot, boxed in captures:
+        slots = env.up(depth).values
+        value = slots[slot]
+        if boxed and type(value) is not Cell:
+            value = slots[slot] = Cell(value)
+        values.append(value)
+    return Frame(None, values)
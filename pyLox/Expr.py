@@ -1,4 +1,8 @@
-from collections import namedtuple
+class Node:
+    "base of the ast nodes: __slots__ classes, no per node dict"
+    __slots__ = ()
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(repr(getattr(self, k)) for k in self.__slots__))
 
 
 class Visitor:
@@ -41,70 +45,124 @@ class Visitor:
     def visitCallExpr(self, expr):
         pass
 
-class Binary(namedtuple("Binary", "left, operator, right")):
+class Binary(Node):
+    __slots__ = ('left', 'operator', 'right', 'fast')
+    def __init__(self, left, operator, right):
+        self.left, self.operator, self.right = left, operator, right
+        self.fast = None
     def accept(self, visitor):
         return visitor.visitBinaryExpr(self)
 
-class Grouping(namedtuple("Grouping", "expression")):
+class Grouping(Node):
+    __slots__ = ('expression',)
+    def __init__(self, expression):
+        self.expression = expression
     def accept(self, visitor):
         return visitor.visitGroupingExpr(self)
 
-class Literal(namedtuple("Literal", "value")):
+class Literal(Node):
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
     def accept(self, visitor):
         return visitor.visitLiteralExpr(self)
 
-class Identifier(namedtuple("Identifier", "value")):
+class Identifier(Node):
+    __slots__ = ('value', 'where')
+    def __init__(self, value):
+        self.value = value
+        self.where = None
     def accept(self, visitor):
         return visitor.visitIdentifierExpr(self)
 
-class Attrib(namedtuple("Attrib", "object, dot, attribute")):
+class Attrib(Node):
+    __slots__ = ('object', 'dot', 'attribute', 'field', 'method')
+    def __init__(self, object, dot, attribute):
+        self.object, self.dot, self.attribute = object, dot, attribute
+        self.field, self.method = None, None
     def accept(self, visitor):
         return visitor.visitAttribExpr(self)
 
-class Unary(namedtuple("Unary", "operator, right")):
+class Unary(Node):
+    __slots__ = ('operator', 'right')
+    def __init__(self, operator, right):
+        self.operator, self.right = operator, right
     def accept(self, visitor):
         return visitor.visitUnaryExpr(self)
 
-class Call(namedtuple("Call", "callee, paran, args")):
+class Call(Node):
+    __slots__ = ('callee', 'paran', 'args')
+    def __init__(self, callee, paran, args):
+        self.callee, self.paran, self.args = callee, paran, args
     def accept(self, visitor):
         return visitor.visitCallExpr(self)
 
 
 # Statements:
 
-class PrintStmt(namedtuple("PrintStmt", "expr")):
+class PrintStmt(Node):
+    __slots__ = ('expr',)
+    def __init__(self, expr):
+        self.expr = expr
     def accept(self, visitor):
         return visitor.visitPrintStmt(self)
 
-class AssertStmt(namedtuple("AssertStmt", "op, expr")):
+class AssertStmt(Node):
+    __slots__ = ('op', 'expr')
+    def __init__(self, op, expr):
+        self.op, self.expr = op, expr
     def accept(self, visitor):
         return visitor.visitAssertStmt(self)
 
-class ExprStmt(namedtuple("ExprStmt", "expr, semicolon")):
+class ExprStmt(Node):
+    __slots__ = ('expr', 'semicolon')
+    def __init__(self, expr, semicolon):
+        self.expr, self.semicolon = expr, semicolon
     def accept(self, visitor):
         return visitor.visitExprStmt(self)
 
-class VarStmt(namedtuple("VarStmt", "name, initial")):
+class VarStmt(Node):
+    __slots__ = ('name', 'initial', 'where')
+    def __init__(self, name, initial):
+        self.name, self.initial = name, initial
+        self.where = None
     def accept(self, visitor):
         return visitor.visitVarStmt(self)
 
-class FuncStmt(namedtuple("FuncStmt", "name, params, block")):
+class FuncStmt(Node):
+    __slots__ = ('name', 'params', 'block', 'line', 'where', 'captures')
+    def __init__(self, name, params, block, line):
+        self.name, self.params, self.block, self.line = name, params, block, line
+        self.where, self.captures = None, None
     def accept(self, visitor):
         return visitor.visitFuncStmt(self)
 
-class ClassStmt(namedtuple("ClassStmt", "name, parent, members")):
+class ClassStmt(Node):
+    __slots__ = ('name', 'parent', 'members', 'where', 'parent_where')
+    def __init__(self, name, parent, members):
+        self.name, self.parent, self.members = name, parent, members
+        self.where, self.parent_where = None, None
     def accept(self, visitor):
         return visitor.visitClassStmt(self)
 
-class IfStmt(namedtuple("IfStmt", "condition, then_branch, else_branch")):
+class IfStmt(Node):
+    __slots__ = ('condition', 'then_branch', 'else_branch')
+    def __init__(self, condition, then_branch, else_branch):
+        self.condition, self.then_branch, self.else_branch = condition, then_branch, else_branch
     def accept(self, visitor):
         return visitor.visitIfStmt(self)
 
-class WhileStmt(namedtuple("WhileStmt", "condition, loop, iteration")):
+class WhileStmt(Node):
+    __slots__ = ('condition', 'loop', 'iteration')
+    def __init__(self, condition, loop, iteration):
+        self.condition, self.loop, self.iteration = condition, loop, iteration
     def accept(self, visitor):
         return visitor.visitWhileStmt(self)
 
-class FlowStmt(namedtuple("FlowStmt", "type, value")):
+class FlowStmt(Node):
+    __slots__ = ('type', 'value')
+    def __init__(self, type, value):
+        self.type, self.value = type, value
     def accept(self, visitor):
         return visitor.visitFlowStmt(self)
 
@@ -114,4 +172,5 @@ class ScopeStmt(list):
 
 class Program(list):
     def accept(self, visitor):
-        return visitor.visitProgram(self)
\ No newline at end of file
+        return visitor.visitProgram(self)
+
@@ -2,7 +2,7 @@
 '''helpers and buildin functions for Interpreter'''
 
 from LoxError import *
-from Environment import Environment
+from Environment import Frame, UNDEFINED, capture
 
 def stringify(v):
     'parse interpreter value to string as in Lox program'
@@ -18,6 +18,44 @@ __stringify_fns = {
     str         : (lambda v: v),
 }
 
+class StrBuilder:
+    '''a Lox string made by concatenation, joined when first read: s + t appends t to the parts
+    shared with s, unless something was appended to them since s was made, so building a string
+    piece by piece costs amortized O(1) per piece instead of a copy of the string so far'''
+    typename = 'String'
+    __slots__ = ('parts', 'n', 'flat')
+    MinSize = 256   # shorter strings are concatenated as python str
+    def __init__(self, parts):
+        self.parts, self.n, self.flat = parts, len(parts), None
+    def __str__(self):
+        if self.flat is None:
+            self.flat = ''.join(self.parts[:self.n] if self.n < len(self.parts) else self.parts)
+            self.parts, self.n = [self.flat], 1     # the pieces may be dropped
+        return self.flat
+    def __len__(self):
+        return len(str(self))
+    def __eq__(self, other):
+        return str(self) == (str(other) if type(other) is StrBuilder else other)
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash(str(self))
+    def __mul__(self, n):
+        return str(self) * n
+    def __mod__(self, args):
+        return str(self) % args
+
+def concat(l, r):
+    'l + r of Lox strings, str or StrBuilder'
+    if type(l) is StrBuilder:
+        parts = l.parts
+        if len(parts) != l.n: parts = parts[:l.n]   # appended by another concatenation
+        parts.append(r if type(r) is str else str(r))
+        return StrBuilder(parts)
+    if type(r) is StrBuilder: r = str(r)
+    if len(l) + len(r) < StrBuilder.MinSize: return l + r
+    return StrBuilder([l, r])
+
 def checkArity(name, n, args):
     if len(args) != n:
         raise LoxFuncArgc(0, 'funcion {} takes {} args, got {}'.format(name, n, len(args)))
@@ -26,7 +64,7 @@ def checkArity(name, n, args):
 def loxfn_printf(interp, args):
     if len(args) < 1:
         checkArity('printf', '>1', args)    # hack: len(args) != '>1' is always true
-    fmt, arg = args[0], tuple(args[1:])
+    fmt, arg = args[0], tuple(str(a) if type(a) is StrBuilder else a for a in args[1:])
     print(fmt % arg, end='', flush=True)
 
 def loxfn_typeof(interp, args):
@@ -37,7 +75,7 @@ def loxfn_typeof(interp, args):
         str   : 'String',
     }
     tp = type(args[0])
-    return typenames.get(tp, tp.__name__)
+    return typenames.get(tp, getattr(tp, 'typename', tp.__name__))
 
 def loxfn_clock(interp, args):
     checkArity('clock', 0, args)
@@ -47,19 +85,25 @@ def loxfn_clock(interp, args):
 # user defined funtions
 class LoxFunc:
     ANONYMOUS = '<anonymous>'
-    def __init__(self, stmt, env=None):
+    def __init__(self, stmt, env=None, method=False, code=None):
+        'env: the local Frame the function is made in'
         self.name = stmt.name.lexeme if stmt.name else LoxFunc.ANONYMOUS
+        self.line = stmt.line
         self.params = [ p.lexeme for p in stmt.params ]
         self.block = stmt.block
-        self.env = env  # closure
+        self.nslots = stmt.block.nslots # frame size resolved by Resolver
+        self.method = method    # slot 0 is reserved for 'this'
+        self.arity = len(self.params)
+        self.padding = [UNDEFINED] * (self.nslots - self.arity - method)  # the slots after this and args
+        self.code = code    # compiled block, if the engine compiles
+        self.env = capture(stmt.captures, env)  # closure: the captured variables, None if none
     def __str__(self):
         return '<function {}>'.format(self.name)
-    def __call__(self, interp, args, **kw):
-        checkArity(self.name, len(self.params), args)
-        binding = [(k, v) for k, v in kw.items()]
-        binding.extend(zip(self.params, args))
-        with interp.subEnv(env=self.env, initial=binding):
-            return interp.visitProgram(self.block)
+    def __call__(self, interp, args, this=UNDEFINED):
+        return interp.callFunc(self, args, this)
+    def frame(self, args, this):
+        'the slot array of a call: this, the arguments and the undefined locals'
+        return [this, *args, *self.padding] if self.method else [*args, *self.padding]
 
 class LoxMethod:
     def __init__(self, obj, func):
@@ -67,27 +111,32 @@ class LoxMethod:
     def __str__(self):
         return '<method {} of {}>'.format(self.func.name, self.obj.cls.name)
     def __call__(self, interp, args):
-        return self.func(interp, args, this=self.obj)
+        return self.func(interp, args, self.obj)
 
 # user defined classes
 class LoxClassBase:
     def __init__(self):
         self.name = "Object"
         self.parent = None
-        self.methods = { 'init' : LoxClassBase.init }
+        self.methods = self.table = { 'init' : LoxClassBase.init }
     @staticmethod
     def init(interp, args, this, **kw):
         checkArity('<default constructor of {}>'.format(this.cls), 0, args)
 
 class LoxClass(LoxClassBase):
-    def __init__(self, stmt, env, lookup=None):
-        if stmt is None:
+    def __init__(self, name=None, parent=None, methods=None, line=0):
+        if name is None:
             return super().__init__()
-        self.name = stmt.name.lexeme
-        if lookup is None: lookup = (lambda name:  env.value(name.lexeme))
-        self.parent = lookup(stmt.parent) if stmt.parent else LoxClass.Object
-        env = Environment(env, [('super', self.parent)])
-        self.methods = { func.name.lexeme : LoxFunc(func, env) for func in stmt.members }
+        self.name, self.parent, self.methods, self.line = name, parent, methods, line
+        # methods are fixed once the class is defined: the inherited ones are flattened into one table
+        self.table = dict(parent.table) if parent else {}
+        self.table.update(methods)
+    @classmethod
+    def fromStmt(cls, stmt, env, lookup, func=LoxFunc):
+        parent = lookup(stmt.parent) if stmt.parent else LoxClass.Object
+        env = Frame(env, [parent])   # holds 'super'
+        methods = { method.name.lexeme : func(method, env, method=True) for method in stmt.members }
+        return cls(stmt.name.lexeme, parent, methods, stmt.name.line)
     def __str__(self):
         return '<class {}>'.format(self.name)
     def __call__(self, interp, args):
@@ -96,26 +145,49 @@ class LoxClass(LoxClassBase):
         cstr(interp, args)
         return object
     def getattr(self, name, default=KeyError):
-        fn = self.methods.get(name)
-        if not fn and self.parent:
-            fn = self.parent.getattr(name, default)
+        fn = self.table.get(name)
         if fn: return fn
         if default != KeyError: return default
         raise KeyError(name)
-LoxClass.Object = LoxClass(None, None)
+LoxClass.Object = LoxClass()
+
+class Shape:
+    """layout of the fields of instances, shared by the instances which got the same fields in the
+    same order: fields maps a name to its index in LoxInstance.values, a new field moves an instance
+    to the shape of transitions[name], made once and shared too"""
+    __slots__ = ('fields', 'transitions')
+    def __init__(self, fields):
+        self.fields, self.transitions = fields, {}
+    def add(self, name):
+        shape = self.transitions.get(name)
+        if shape is None:
+            fields = dict(self.fields)
+            fields[name] = len(fields)
+            shape = self.transitions[name] = Shape(fields)
+        return shape
+Shape.EMPTY = Shape({})
 
 class LoxInstance:
-    def __init__(self, cls, attr=None):
-        self.cls = cls
-        self.attr = attr if attr is not None else {}
+    __slots__ = ('cls', 'shape', 'values')
+    def __init__(self, cls):
+        self.cls, self.shape, self.values = cls, Shape.EMPTY, []
     def __str__(self):
         return '<instance of class {}>'.format(self.cls.name)
     def super(self, superClass):
-        'shift self to a super class object'
-        return LoxInstance(superClass, self.attr)
+        'self seen from a super class, for a bare super; super.name is got by superattr'
+        return LoxSuper(self, superClass)
+    def superattr(self, cls, name, default=KeyError):
+        'super.name in a method of a subclass of cls: a field of self, then the method of cls bound to self'
+        i = self.shape.fields.get(name)
+        if i is not None: return self.values[i]
+        fn = cls.table.get(name)
+        if fn: return LoxMethod(self, fn)
+        if default != KeyError: return default
+        raise KeyError(name)
     def getattr(self, name, default=KeyError):
-        # 1) obj.attr
-        if name in self.attr: return self.attr[name]
+        # 1) obj.field
+        i = self.shape.fields.get(name)
+        if i is not None: return self.values[i]
         # 2) cls.method
         fn = self.cls.getattr(name, None)
         if fn: return LoxMethod(self, fn)
@@ -124,7 +196,31 @@ class LoxInstance:
         # 4) report error
         raise KeyError(name)
     def setattr(self, name, value):
-        self.attr[name] = value
+        i = self.shape.fields.get(name)
+        if i is not None:
+            self.values[i] = value
+        else:
+            self.shape = self.shape.add(name)
+            self.values.append(value)
+    def hasattr(self, name):
+        try:
+            self.getattr(name)
+            return True
+        except KeyError:
+            return False
+
+class LoxSuper:
+    'instance this seen from its super class cls: the fields of this, then the methods of cls bound to this'
+    typename = 'LoxInstance'
+    __slots__ = ('this', 'cls')
+    def __init__(self, this, cls):
+        self.this, self.cls = this, cls
+    def __str__(self):
+        return '<instance of class {}>'.format(self.cls.name)
+    def getattr(self, name, default=KeyError):
+        return self.this.superattr(self.cls, name, default)
+    def setattr(self, name, value):
+        self.this.setattr(name, value)
     def hasattr(self, name):
         try:
             self.getattr(name)
@@ -1,10 +1,18 @@
-from contextlib import contextmanager
+import operator
 import Expr
 from Scanner import *
 from LoxError import *
 from Functions import *
 from Resolver import Resolver
-from Environment import Environment
+from Environment import Frame, Cell, UNDEFINED
+
+
+class Flow:
+    '''completion signal of break/continue/return statements, returned instead of raised;
+    a LoxFlowCtrl error is only made if it escapes to where it is not expected'''
+    __slots__ = ('type', 'token', 'value')
+    def __init__(self, token, value=None):
+        self.type, self.token, self.value = token.type, token, value
 
 
 class InterpType:
@@ -32,9 +40,61 @@ class InterpType:
         return InterpType.INV
     @staticmethod
     def String(v):
-        if isinstance(v, str): return v
+        if isinstance(v, (str, StrBuilder)): return v
         return InterpType.INV
 
+def lineOf(expr):
+    'line number of an expression, for error reporting'
+    while isinstance(expr, Expr.Grouping): expr = expr.expression
+    if isinstance(expr, (Expr.Literal, Expr.Identifier)): return expr.value.line
+    if isinstance(expr, (Expr.Binary, Expr.Unary)): return expr.operator.line
+    if isinstance(expr, Expr.Attrib): return expr.dot.line
+    if isinstance(expr, Expr.Call): return expr.paran.line
+    return None
+
+def lookupField(expr, obj):
+    '''index in obj.values of the field of instance obj named by the Attrib expr, None if missing;
+    cached on expr by shape, which maps the same names to the same indexes for all its instances'''
+    shape, cache = obj.shape, expr.field
+    if cache is not None and cache[0] is shape: return cache[1]
+    i = shape.fields.get(expr.attribute.lexeme)
+    if i is not None: expr.field = shape, i
+    return i
+
+def storeField(expr, obj, value):
+    '''set the field of instance obj named by the Attrib expr; cached on expr as (shape, index, next shape),
+    a new field is appended and moves obj to the next shape without looking up the transition'''
+    shape, cache = obj.shape, expr.field
+    if cache is None or cache[0] is not shape:
+        obj.setattr(expr.attribute.lexeme, value)
+        i = obj.shape.fields[expr.attribute.lexeme]
+        expr.field = shape, i, obj.shape
+        return
+    values, i = obj.values, cache[1]
+    if i < len(values):
+        values[i] = value
+    else:
+        values.append(value)
+        obj.shape = cache[2]
+
+def lookupMethod(expr, obj, cls=None):
+    '''method of instance obj named by the Attrib expr, looked up in cls (obj.cls if None, the parent
+    class for super), None if obj is not an instance, or the name is a field or missing; cached on
+    expr by class, which is valid as the method table of a class never changes, and fields, which
+    may shadow methods any time, are looked up first'''
+    if type(obj) is not LoxInstance: return None
+    name = expr.attribute.lexeme
+    if name in obj.shape.fields: return None
+    if cls is None: cls = obj.cls
+    cache = expr.method
+    if cache is not None and cache[0] is cls: return cache[1]
+    fn = cls.table.get(name)
+    expr.method = cls, fn
+    return fn
+
+def isSuper(expr):
+    return type(expr) is Expr.Identifier and expr.value.type == TokenType.SUPER
+
 class Interpreter(Expr.Visitor):
     BinFns = {
         TokenType.EQUAL_EQUAL   :   [(InterpType.Any, InterpType.Any, lambda l, r: l == r)],
@@ -45,8 +105,8 @@ class Interpreter(Expr.Visitor):
         TokenType.LESS_EQUAL    :   [(InterpType.Number, InterpType.Number, lambda l, r: l <= r)],
         TokenType.MINUS         :   [(InterpType.Number, InterpType.Number, lambda l, r: l - r)],
         TokenType.PLUS          :   [(InterpType.Number, InterpType.Number, lambda l, r: l + r),
-                                     (InterpType.String, InterpType.Any, lambda l, r: l + stringify(r)),
-                                     (InterpType.Any, InterpType.String, lambda l, r: stringify(l) + r)],
+                                     (InterpType.String, InterpType.Any, lambda l, r: concat(l, stringify(r))),
+                                     (InterpType.Any, InterpType.String, lambda l, r: concat(stringify(l), r))],
         TokenType.SLASH         :   [(InterpType.Number, InterpType.Number, lambda l, r: l / r)],
         TokenType.STAR          :   [(InterpType.Number, InterpType.Number, lambda l, r: l * r),
                                      (InterpType.String, InterpType.Number, lambda l, r: l * int(r))],
@@ -54,6 +114,20 @@ class Interpreter(Expr.Visitor):
         # TokenType.AND           :   [(InterpType.Boolean, InterpType.Boolean, lambda l, r: l and r)],
         # TokenType.OR            :   [(InterpType.Boolean, InterpType.Boolean, lambda l, r: l or r)],
     }
+    # type feedback of visitBinaryExpr: (operator, left type, right type) => what BinFns computes for
+    # operands of these types, which need no coercion
+    FastFns = {
+        **{ (op, float, float) : fn for op, fn in (
+            (TokenType.EQUAL_EQUAL, operator.eq), (TokenType.BANG_EQUAL, operator.ne),
+            (TokenType.GREATER, operator.gt), (TokenType.GREATER_EQUAL, operator.ge),
+            (TokenType.LESS, operator.lt), (TokenType.LESS_EQUAL, operator.le),
+            (TokenType.MINUS, operator.sub), (TokenType.PLUS, operator.add),
+            (TokenType.SLASH, operator.truediv), (TokenType.STAR, operator.mul)) },
+        (TokenType.PLUS, str, str)          : concat,
+        (TokenType.PLUS, StrBuilder, str)   : concat,
+        (TokenType.EQUAL_EQUAL, str, str)   : operator.eq,
+        (TokenType.BANG_EQUAL, str, str)    : operator.ne,
+    }
     UniFns = {
         TokenType.MINUS         :   [(InterpType.Number, lambda v: -v)],
         TokenType.BANG          :   [(InterpType.Boolean, lambda v: not v)],
@@ -61,84 +135,120 @@ class Interpreter(Expr.Visitor):
     
     def __init__(self):
         super().__init__()
-        self.env = self.globalEnv = Environment(initial=lox_builtins)
-        self.ids = None
+        self.globals = dict(lox_builtins)   # global vars, looked up by name
+        self.env = None     # local Frame, None at global level
+        self.resolver = None
 
-    def interpret(self, ast, ids=None):
-        self.ids = ids
-        if self.ids is None:
-            self.getval, self.setval = self.getval0, self.setval0
-        else:
-            self.getval, self.setval = self.getval1, self.setval1
-        return self.visit(ast)
-
-    @contextmanager
-    def subEnv(self, env=None, initial=None):
-        if env is None: env = self.env
-        saved = self.env    # save
-        self.env = Environment(env, initial)    # extend
+    def interpret(self, ast, resolved=False):
+        if not resolved:    # not resolved by caller
+            if self.resolver is None: self.resolver = Resolver()
+            errors = self.resolver.resolve(ast)
+            if errors: raise errors[0]
+        rlt = ast.accept(self)     # nodes are visited by node.accept(self), a python call less than self.visit
+        if type(rlt) is Flow:
+            raise LoxFlowCtrl(rlt.token, rlt.value)
+        return rlt
+
+    def callFunc(self, func, args, this=UNDEFINED):
+        if len(args) != func.arity:
+            checkArity(func.name, func.arity, args)
+        saved, self.env = self.env, Frame(func.env, func.frame(args, this))
         try:
-            yield   # run user code
+            rlt = self.visitProgram(func.block)
         finally:
-            self.env = saved    # recover
+            self.env = saved
+        if type(rlt) is Flow:
+            if rlt.type is TokenType.RETURN: return rlt.value
+            raise LoxFlowCtrl(rlt.token, rlt.value)
+        return rlt
+
+    @staticmethod
+    def errUndeclared(name):
+        if name.type == TokenType.IDENTIFIER:
+            return InterpError(name.line, "var {} used without being declared".format(name.lexeme))
+        else:
+            return InterpError(name.line, "keyword '{}' should be used inside a class".format(name.lexeme))
+
+    def define(self, name, where, value, redefine=False):
+        depth, slot = where
+        if depth < 0:
+            table, slot = self.globals, name.lexeme
+            declared = slot in table
+        else:
+            table = self.env.values
+            cell = table[slot]
+            if type(cell) is Cell: table, slot = None, cell   # captured before its value, see Resolver.Local
+            declared = (cell.value if table is None else cell) is not UNDEFINED
+        if declared and not redefine:
+            raise InterpError(name.line, "duplicated declaration of var {}".format(name.lexeme))
+        if table is None: slot.value = value
+        else: table[slot] = value
 
     def setval0(self, name, valueExpr):
-        env = self.env
-        if not env.defined(name.lexeme):
-            raise InterpError(name.line, "var {} used without being declared".format(name.lexeme))
-        return env.assign(name.lexeme, self.visit(valueExpr))
+        'fallback: lookup global var by name'
+        if name.lexeme not in self.globals:
+            raise self.errUndeclared(name)
+        self.globals[name.lexeme] = valueExpr.accept(self)
 
     def getval0(self, name):
-        env = self.env
-        if not env.defined(name.lexeme):
-            if name.type == TokenType.IDENTIFIER:
-                raise InterpError(name.line, "var {} used without being declared".format(name.lexeme))
-            else:
-                raise InterpError(name.line, "keyword '{}' should be used inside a class".format(name.lexeme))
-        if name.type == TokenType.SUPER: # trick here
-            parent = env.value('super')    # super class
-            if not env.defined('this'): return parent    # class method
-            return env.value('this').super(parent)
-        return env.value(name.lexeme)
-
-    def setval1(self, name, valueExpr):
-        depth = self.ids[name]
-        env = self.globalEnv if depth[0] == -1 else self.env
-        if not env.defined(name.lexeme, depth=depth):
-            raise InterpError(name.line, "var {} used without being declared".format(name.lexeme))
-        return env.assign(name.lexeme, self.visit(valueExpr), depth=depth)
-
-    def getval1(self, name):
-        depth = self.ids[name]
-        env = self.globalEnv if depth[0] == -1 else self.env
-        if not env.defined(name.lexeme, depth=depth):
-            if name.type == TokenType.IDENTIFIER:
-                raise InterpError(name.line, "var {} used without being declared".format(name.lexeme))
-            else:
-                raise InterpError(name.line, "keyword '{}' should be used inside a class".format(name.lexeme))
-        if name.type == TokenType.SUPER: # trick here
-            parent = env.value('super', depth=depth)    # super class
-            updepth = depth[0] - 1
-            if not env.defined('this', depth=updepth): return parent    # class method
-            return env.value('this', depth=(updepth, 0)).super(parent)
-        return env.value(name.lexeme, depth=depth)
+        'fallback: lookup global var by name'
+        try:
+            return self.globals[name.lexeme]
+        except KeyError:
+            raise self.errUndeclared(name)
+
+    def setval(self, name, where, valueExpr):
+        depth, slot = where
+        if depth < 0: return self.setval0(name, valueExpr)
+        values = self.env.up(depth).values
+        value = values[slot]
+        if (value.value if type(value) is Cell else value) is UNDEFINED:
+            raise self.errUndeclared(name)
+        value = valueExpr.accept(self)  # which may make a closure boxing the slot
+        if type(values[slot]) is Cell: values[slot].value = value
+        else: values[slot] = value
+
+    def getval(self, name, where):
+        if name.type == TokenType.SUPER:
+            this, parent = self.superOf(name, where)
+            return parent if this is UNDEFINED else this.super(parent)     # class method, or a bare super
+        depth, slot = where
+        if depth < 0: return self.getval0(name)
+        value = self.env.up(depth).values[slot]
+        if type(value) is Cell: value = value.value
+        if value is UNDEFINED:
+            raise self.errUndeclared(name)
+        return value
+
+    def superOf(self, name, where):
+        '''returns (this, parent class) of super, this is UNDEFINED in a class method;
+        super and this are never assigned, so never boxed'''
+        depth, slot, thisDepth, thisSlot = where
+        parent = self.env.up(depth).values[slot]
+        if parent is UNDEFINED:
+            raise self.errUndeclared(name)
+        return self.env.up(thisDepth).values[thisSlot], parent    # 'this' of the method
 
     def visitProgram(self, prog):
         rlt = None
         for stmt in prog:
-            rlt = self.visit(stmt)
+            rlt = stmt.accept(self)
+            if type(rlt) is Flow: return rlt
         return rlt
 
     def visitScopeStmt(self, stmt):
-        with self.subEnv():
+        saved, self.env = self.env, Frame(self.env, [UNDEFINED] * stmt.nslots)
+        try:
             return self.visitProgram(stmt)
+        finally:
+            self.env = saved
 
     def visitPrintStmt(self, stmt):
-        value = self.visit(stmt.expr)
+        value = stmt.expr.accept(self)
         print(stringify(value))
 
     def visitAssertStmt(self, stmt):
-        value = InterpType.Boolean(self.visit(stmt.expr))
+        value = InterpType.Boolean(stmt.expr.accept(self))
         if value == InterpType.INV:
             raise InterpError(stmt.op.line, "assert statement requires a boolean condition")
         if not value:
@@ -148,111 +258,134 @@ class Interpreter(Expr.Visitor):
             raise AssertError(stmt.op.line, "assertion {} failed".format(sp))
 
     def visitExprStmt(self, stmt):
-        value = self.visit(stmt.expr)
+        value = stmt.expr.accept(self)
         return None if stmt.semicolon else value
 
     def visitVarStmt(self, stmt):
-        name = stmt.name
-        if not self.env.define(name.lexeme):
-            raise InterpError(name.line, "duplicated declaration of var {}".format(name.lexeme))
+        self.define(stmt.name, stmt.where, None)
         if stmt.initial is not None:
-            self.env.assign(name.lexeme, self.visit(stmt.initial), depth=0)
+            self.define(stmt.name, stmt.where, stmt.initial.accept(self), redefine=True)
 
     def visitFuncStmt(self, stmt):
         func = LoxFunc(stmt, env=self.env)  # lexical scope
         if func.name != LoxFunc.ANONYMOUS:
-            self.env.define(func.name)    # allow function redefine
-            self.env.assign(func.name, func, depth=0)
+            self.define(stmt.name, stmt.where, func, redefine=True)   # allow function redefine
         return func
 
     def visitClassStmt(self, stmt):
-        self.env.define(stmt.name.lexeme)
-        cls = LoxClass(stmt, env=self.env, lookup=self.getval)
-        self.env.assign(cls.name, cls, depth=0)
+        cls = LoxClass.fromStmt(stmt, self.env, lookup=lambda parent: self.getval(parent, stmt.parent_where))
+        self.define(stmt.name, stmt.where, cls, redefine=True)
         return cls
 
     def visitIfStmt(self, stmt):
-        condition = InterpType.Boolean(self.visit(stmt.condition))
+        condition = InterpType.Boolean(stmt.condition.accept(self))
         if condition == InterpType.INV:
-            raise InterpError(stmt.condition.line, "if statement requires a boolean condition")
+            raise InterpError(lineOf(stmt.condition), "if statement requires a boolean condition")
         if condition:
-            return self.visit(stmt.then_branch)
+            return stmt.then_branch.accept(self)
         else:
             if not stmt.else_branch: return None
-            return self.visit(stmt.else_branch)
+            return stmt.else_branch.accept(self)
 
     def visitWhileStmt(self, stmt):
         while True:
-            try:
-                condition = InterpType.Boolean(self.visit(stmt.condition))
+            if stmt.condition is not None:  # None: while (true), see Optimizer
+                condition = InterpType.Boolean(stmt.condition.accept(self))
                 if condition == InterpType.INV:
-                    raise InterpError(stmt.condition.line, "while statement requires a boolean condition")
+                    raise InterpError(lineOf(stmt.condition), "while statement requires a boolean condition")
                 if not condition: break
-                self.visit(stmt.loop)
-            except LoxFlowCtrl as ex:
-                if ex.type == TokenType.BREAK:
-                    break
-                elif ex.type == TokenType.CONTINUE:
-                    pass    # goto stmt.iteration
-                else:
-                    raise ex
+            rlt = stmt.loop.accept(self)
+            if type(rlt) is Flow:
+                if rlt.type is TokenType.BREAK: break
+                if rlt.type is TokenType.RETURN: return rlt
+                # continue: goto stmt.iteration
             if stmt.iteration:
-                self.visit(stmt.iteration)
+                stmt.iteration.accept(self)
 
     def visitFlowStmt(self, stmt):
-        raise LoxFlowCtrl(stmt.type, stmt.value and self.visit(stmt.value))
+        return Flow(stmt.type, stmt.value and stmt.value.accept(self))
 
     def visitBinaryExpr(self, expr):
         if expr.operator.type == TokenType.EQUAL:
             return self._visitAssignExpr(expr)
         if expr.operator.type in (TokenType.AND, TokenType.OR):
             return self._visitAndOrExpr(expr)
-        left, right = self.visit(expr.left), self.visit(expr.right)
+        left, right = expr.left.accept(self), expr.right.accept(self)
+        fast = expr.fast
+        if fast is not None and type(left) is fast[0] and type(right) is fast[1]:
+            try:
+                return fast[2](left, right)
+            except ZeroDivisionError:   # reported by the generic path
+                pass
         for tl, tr, fn in self.BinFns[expr.operator.type]:
             l, r = tl(left), tr(right)
             if l == InterpType.INV or r == InterpType.INV: continue
             try:
-                return fn(l, r)
+                value = fn(l, r)
             except Exception as ex:
                 raise RunningError(expr.operator.line, str(ex))
+            types = type(left), type(right)
+            fn = self.FastFns.get((expr.operator.type, *types))
+            if fn is not None: expr.fast = (*types, fn)     # guarded by the types of the next operands
+            return value
         else:
             raise InterpError(expr.operator.line, "invalid operand(s) for operator {}".format(expr.operator))
 
     def visitAttribExpr(self, expr):
+        object = expr.object
+        if type(object) is Expr.Identifier and object.value.type == TokenType.SUPER:
+            return self._visitGetSuperAttrib(expr, *self.superOf(object.value, object.where))
         return self._visitGetAttribExpr(expr)
 
     def _visitAssignExpr(self, expr):
         if isinstance(expr.left, Expr.Identifier):
-            name = expr.left.value
-            return self.setval(name, expr.right)
+            return self.setval(expr.left.value, expr.left.where, expr.right)
         if isinstance(expr.left, Expr.Attrib):
             return self._visitSetAttribExpr(expr.left, expr.right)
         raise InterpError(expr.operator.line, "left value required before operator {}".format(expr.operator))
 
-    def _visitGetAttribExpr(self, expr):
-        object = self.visit(expr.object)
+    def _visitGetAttribExpr(self, expr, object=UNDEFINED):
+        if object is UNDEFINED: object = expr.object.accept(self)
+        if type(object) is LoxInstance:
+            i = lookupField(expr, object)
+            if i is not None: return object.values[i]
+        fn = lookupMethod(expr, object)
+        if fn is not None: return LoxMethod(object, fn)
         getter = getattr(object, 'getattr', None)
         if not getter:
-            raise InterpError(expr.operator.line, "left of operator '.' should be a gettable object")
+            raise InterpError(expr.dot.line, "left of operator '.' should be a gettable object")
         attr = expr.attribute.lexeme
         try:
             return getter(attr)
         except KeyError:
-            raise InterpError(expr.operator.line, "{} doesn't have attr '{}'".format(object, attr))
+            raise InterpError(expr.dot.line, "{} doesn't have attr '{}'".format(object, attr))
+
+    def _visitGetSuperAttrib(self, expr, this, parent):
+        'super.name, without a LoxSuper: a field of this, then the method of parent bound to this'
+        if this is UNDEFINED: return self._visitGetAttribExpr(expr, parent)    # class method
+        i = lookupField(expr, this)
+        if i is not None: return this.values[i]
+        fn = lookupMethod(expr, this, parent)
+        if fn is not None: return LoxMethod(this, fn)
+        raise InterpError(expr.dot.line, "{} doesn't have attr '{}'".format(this.super(parent), expr.attribute.lexeme))
 
     def _visitSetAttribExpr(self, expr, valueExpr):
-        object = self.visit(expr.object)
+        if isSuper(expr.object):    # the field of this
+            this, parent = self.superOf(expr.object.value, expr.object.where)
+            object = parent if this is UNDEFINED else this
+        else:
+            object = expr.object.accept(self)
         setter = getattr(object, 'setattr', None)
         if not setter:
-            raise InterpError(expr.operator.line, "left of operator '.' should be a settable object")
-        attr = expr.attribute.lexeme
-        value = self.visit(valueExpr)
-        setter(attr, value)
+            raise InterpError(expr.dot.line, "left of operator '.' should be a settable object")
+        value = valueExpr.accept(self)
+        if type(object) is LoxInstance: return storeField(expr, object, value)
+        setter(expr.attribute.lexeme, value)
 
     def _visitAndOrExpr(self, expr):
         shortcircuit = (expr.operator.type == TokenType.OR) # or short-circuited by True, and by False
         for opd in (expr.left, expr.right):
-            v = InterpType.Boolean(self.visit(opd))
+            v = InterpType.Boolean(opd.accept(self))
             if v == shortcircuit:
                 return shortcircuit
             if v == InterpType.INV:
@@ -260,10 +393,10 @@ class Interpreter(Expr.Visitor):
         return not shortcircuit
 
     def visitGroupingExpr(self, expr):
-        return self.visit(expr.expression)
+        return expr.expression.accept(self)
 
     def visitUnaryExpr(self, expr):
-        val = self.visit(expr.right)
+        val = expr.right.accept(self)
         for tp, fn in self.UniFns[expr.operator.type]:
             v = tp(val)
             if v == InterpType.INV: continue
@@ -280,19 +413,33 @@ class Interpreter(Expr.Visitor):
         raise InterpError(tok.line, "unsupported literal {}".format(repr(tok)))
 
     def visitIdentifierExpr(self, expr):
-        return self.getval(expr.value)
+        return self.getval(expr.value, expr.where)
 
     def visitCallExpr(self, expr):
-        callee = self.visit(expr.callee)
+        this = UNDEFINED
+        if type(expr.callee) is Expr.Attrib:    # obj.method(), called without making a LoxMethod
+            attrib = expr.callee
+            if isSuper(attrib.object):  # super.method(), called on this
+                object, parent = self.superOf(attrib.object.value, attrib.object.where)
+                callee = lookupMethod(attrib, object, parent)
+                if type(callee) is LoxFunc: this = object
+                else: callee = self._visitGetSuperAttrib(attrib, object, parent)
+            else:
+                object = attrib.object.accept(self)
+                callee = lookupMethod(attrib, object)
+                if type(callee) is LoxFunc: this = object
+                else: callee = self._visitGetAttribExpr(attrib, object)
+        else:
+            callee = expr.callee.accept(self)
         if not callable(callee):
             raise InterpError(expr.paran.line, "need a callable object before '(', got {}".format(stringify(callee)))
-        args = [self.visit(v) for v in expr.args]
+        args = [v.accept(self) for v in expr.args]
         try:
+            if this is not UNDEFINED or type(callee) is LoxFunc: return self.callFunc(callee, args, this)
             return callee(self, args)
         except LoxFuncArgc as ex:
-            ex.line = expr.paran.line
-            raise ex
-        except LoxFlowCtrl as ex:
-            if ex.type == TokenType.RETURN:
-                return ex.ret
+            if not ex.args[0]:  # raised by the callee itself
+                ex.args = (expr.paran.line, ex.args[1])
             raise ex
+        except RecursionError:  # out of python stack, the vm engine is not
+            raise LoxStackOverflow(expr.paran.line, 'stack overflow') from None
@@ -10,7 +10,13 @@ class LoxError(RuntimeError):
             return '%s: %s' % (self.__class__.__name__, message)
 
 class ParserError(LoxError):
-    pass
+    def __init__(self, line, message, column=None):
+        super().__init__(line, message)
+        self.column = column
+    def __str__(self):
+        if self.column is None: return super().__str__()
+        line, message = self.args
+        return '[line %d:%d] %s: %s' % (line, self.column, self.__class__.__name__, message)
 
 class InterpError(LoxError):
     pass
@@ -18,6 +24,9 @@ class InterpError(LoxError):
 class ResolveError(LoxError):
     pass
 
+class CompileError(LoxError):
+    pass
+
 class RunningError(LoxError):
     pass
 
@@ -27,6 +36,9 @@ class AssertError(RunningError):
 class LoxFuncArgc(RunningError):
     pass
 
+class LoxStackOverflow(RunningError):
+    pass
+
 class LoxFlowCtrl(RunningError):
     def __init__(self, token, ret=None):
         self.type = token.type
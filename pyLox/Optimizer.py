@@ -0,0 +1,200 @@
+import Expr
+from Scanner import *
+from Functions import stringify, StrBuilder
+from Interpreter import Interpreter, InterpType, lineOf
+
+class Optimizer(Expr.Visitor):
+    """rewrites a resolved ast in place: folds constant expressions, drops unreachable statements
+    and the condition of while (true). Only what can not fail is folded, so the runtime errors and
+    their lines stay as they were; visit returns the replacing node, None for a dropped statement"""
+    MaxString = 1024    # longer folded strings are left to the runtime
+
+    def optimize(self, ast):
+        self.visit(ast)
+        return ast
+
+    def statements(self, stmts):
+        'optimize a statement list in place, the value of the last statement is kept'
+        result = []
+        for i, stmt in enumerate(stmts):
+            new = self.visit(stmt)
+            if new is None:     # a dropped last statement was valued nil
+                if result and i == len(stmts) - 1: result.append(self.void(stmt))
+                continue
+            result.append(new)
+            if isinstance(new, Expr.FlowStmt): break    # the rest is unreachable
+        stmts[:] = result
+
+    def statement(self, stmt):
+        'optimize a statement which can not be dropped'
+        new = self.visit(stmt)
+        return self.void(stmt) if new is None else new
+
+    @staticmethod
+    def void(stmt):
+        'the void statement replacing a dropped one'
+        line = lineOf(stmt.condition) if isinstance(stmt, (Expr.IfStmt, Expr.WhileStmt)) else None
+        return Expr.Literal(Token(TokenType.NIL, 'nil', None, line))
+
+    @staticmethod
+    def declares(stmt):
+        'a declaration in the enclosing scope, which is kept even if unreachable'
+        return isinstance(stmt, (Expr.VarStmt, Expr.FuncStmt, Expr.ClassStmt))
+
+    @staticmethod
+    def constant(expr):
+        'returns (True, value) of a literal expression, (False, None) otherwise'
+        if not isinstance(expr, Expr.Literal): return False, None
+        tok = expr.value
+        if tok.type in (TokenType.TRUE, TokenType.FALSE): return True, tok.type == TokenType.TRUE
+        if tok.type in (TokenType.STRING, TokenType.NUMBER, TokenType.NIL): return True, tok.literal
+        return False, None
+
+    def literal(self, value, line):
+        'literal expression of a folded value, or None if it can not be one'
+        if value is None:
+            return Expr.Literal(Token(TokenType.NIL, 'nil', None, line))
+        if type(value) is bool:
+            return Expr.Literal(Token(TokenType.TRUE, 'true', None, line) if value else
+                                Token(TokenType.FALSE, 'false', None, line))
+        if type(value) is float:
+            return Expr.Literal(Token(TokenType.NUMBER, stringify(value), value, line))
+        if type(value) is StrBuilder: value = str(value)
+        if type(value) is str and len(value) <= self.MaxString:
+            return Expr.Literal(Token(TokenType.STRING, '"{}"'.format(value), value, line))
+        return None
+
+    def truth(self, expr):
+        'boolean value of a constant condition, None if not constant or not a boolean'
+        const, value = self.constant(expr)
+        if not const: return None
+        value = InterpType.Boolean(value)
+        return None if value == InterpType.INV else value
+
+    # statements
+    def visitProgram(self, prog):
+        self.statements(prog)
+        return prog
+
+    def visitScopeStmt(self, stmt):
+        self.statements(stmt)
+        return stmt
+
+    def visitPrintStmt(self, stmt):
+        stmt.expr = self.visit(stmt.expr)
+        return stmt
+
+    def visitAssertStmt(self, stmt):
+        return stmt     # kept as written, the failure message prints the expression
+
+    def visitExprStmt(self, stmt):
+        stmt.expr = self.visit(stmt.expr)
+        return stmt
+
+    def visitVarStmt(self, stmt):
+        if stmt.initial is not None:
+            stmt.initial = self.visit(stmt.initial)
+        return stmt
+
+    def visitFuncStmt(self, stmt):
+        self.visit(stmt.block)
+        return stmt
+
+    def visitClassStmt(self, stmt):
+        for method in stmt.members: self.visit(method)
+        return stmt
+
+    def visitIfStmt(self, stmt):
+        stmt.condition = self.visit(stmt.condition)
+        stmt.then_branch = self.statement(stmt.then_branch)
+        if stmt.else_branch: stmt.else_branch = self.visit(stmt.else_branch)
+        truth = self.truth(stmt.condition)
+        if truth is None: return stmt
+        branch, dead = (stmt.then_branch, stmt.else_branch) if truth else (stmt.else_branch, stmt.then_branch)
+        if dead and self.declares(dead): return stmt
+        return branch
+
+    def visitWhileStmt(self, stmt):
+        if stmt.condition is not None:
+            stmt.condition = self.visit(stmt.condition)
+        stmt.loop = self.statement(stmt.loop)
+        if stmt.iteration: stmt.iteration = self.visit(stmt.iteration)
+        truth = True if stmt.condition is None else self.truth(stmt.condition)
+        if truth is True:
+            stmt.condition = None   # not tested
+        elif truth is False and not self.declares(stmt.loop):
+            return None
+        return stmt
+
+    def visitFlowStmt(self, stmt):
+        if stmt.value is not None:
+            stmt.value = self.visit(stmt.value)
+        return stmt
+
+    # expressions
+    def visitBinaryExpr(self, expr):
+        op = expr.operator
+        if op.type == TokenType.EQUAL:  # the target is kept as written, (a) = 1 is still an error
+            if isinstance(expr.left, Expr.Attrib): expr.left.object = self.visit(expr.left.object)
+            expr.right = self.visit(expr.right)
+            return expr
+        expr.left, expr.right = self.visit(expr.left), self.visit(expr.right)
+        if op.type in (TokenType.AND, TokenType.OR):
+            return self.andOr(expr)
+        (lconst, left), (rconst, right) = self.constant(expr.left), self.constant(expr.right)
+        if not (lconst and rconst): return expr
+        for tl, tr, fn in Interpreter.BinFns[op.type]:
+            l, r = tl(left), tr(right)
+            if l == InterpType.INV or r == InterpType.INV: continue
+            try:
+                if self.tooLong(op.type, l, r): return expr
+                value = fn(l, r)
+            except Exception:   # raised again at runtime
+                return expr
+            return self.literal(value, op.line) or expr
+        return expr
+
+    def tooLong(self, op, l, r):
+        'whether op makes a string over MaxString of the operands l and r, known before it is built'
+        if op == TokenType.STAR and type(l) is str:
+            return len(l) * int(r) > self.MaxString
+        if op == TokenType.PLUS and str in (type(l), type(r)):
+            return len(stringify(l)) + len(stringify(r)) > self.MaxString
+        return False
+
+    def andOr(self, expr):
+        'folds the operands as Interpreter._visitAndOrExpr evaluates them'
+        shortcircuit = (expr.operator.type == TokenType.OR)
+        for opd in (expr.left, expr.right):
+            v = self.truth(opd)
+            if v is None: return expr
+            if v == shortcircuit: return self.literal(shortcircuit, expr.operator.line)
+        return self.literal(not shortcircuit, expr.operator.line)
+
+    def visitGroupingExpr(self, expr):
+        return self.visit(expr.expression)
+
+    def visitLiteralExpr(self, expr):
+        return expr
+
+    def visitIdentifierExpr(self, expr):
+        return expr
+
+    def visitAttribExpr(self, expr):
+        expr.object = self.visit(expr.object)
+        return expr
+
+    def visitUnaryExpr(self, expr):
+        expr.right = self.visit(expr.right)
+        const, value = self.constant(expr.right)
+        if not const: return expr
+        for tp, fn in Interpreter.UniFns[expr.operator.type]:
+            v = tp(value)
+            if v == InterpType.INV: continue
+            return self.literal(fn(v), expr.operator.line) or expr
+        return expr
+
+    def visitCallExpr(self, expr):
+        expr.callee = self.visit(expr.callee)
+        expr.args = [self.visit(arg) for arg in expr.args]
+        return expr
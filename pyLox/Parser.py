@@ -5,12 +5,24 @@ from Functions import *
 
 class Parser(object):
 
-    def __init__(self, tokens):
-        self.tokens = tokens
-        self.current = 0
+    def __init__(self, tokens, columns=None):
+        '''tokens: a list, or an iterator (RegexScanner.iterTokens) consumed as parsing goes;
+        columns: Scanner.columns of the tokens, for the column of the errors'''
+        self.tokens = iter(tokens)
+        self.columns, self.index = columns, -1  # index of curr in tokens
+        self.last, self.scanError = None, None
+        self.curr = self.advance()
+
+    def advance(self):
+        try:
+            self.index += 1
+            return next(self.tokens)
+        except LoxError as ex:  # scanning error, not recoverable by synchronize()
+            self.scanError = ex
+            raise
 
     def currToken(self):
-        return self.tokens[self.current]
+        return self.curr
 
     def match(self, *args):
         tok = self.currToken()
@@ -25,20 +37,21 @@ class Parser(object):
             return None
 
     def lastToken(self):
-        return self.tokens[self.current-1]
+        return self.last
 
     def nextToken(self):
-        tok = self.currToken()
-        self.current += 1
+        tok = self.curr
+        if tok.type != TokenType.EOF:
+            self.last, self.curr = tok, self.advance()
         return tok
 
     def isAtEnd(self):
-        return self.current >= len(self.tokens) - 1
-        # return self.currToken().type == TokenType.EOF
+        return self.curr.type == TokenType.EOF
 
     def errUnexpToken(self, exp):
         tok = self.currToken()
-        return ParserError(tok.line, "expect {}, got {}".format(exp, tok))
+        column = self.columns[self.index] if self.columns and self.index < len(self.columns) else None
+        return ParserError(tok.line, "expect {}, got {}".format(exp, tok), column)
 
     def synchronize(self):
         "skip until next ';' or '}' or EOF when encounter error"
@@ -52,6 +65,7 @@ class Parser(object):
             try:
                 stmts.append(self.statement())
             except ParserError as ex:
+                if self.scanError: raise
                 errors.append(ex)
                 self.synchronize()
         return stmts, errors
@@ -105,8 +119,9 @@ class Parser(object):
         return self.funExpr(name)
 
     def funExpr(self, name=None):
+        line = self.lastToken().line
         if self.consume(TokenType.SEMICOLON): # early declaration
-            return Expr.FuncStmt(name, [], [])
+            return Expr.FuncStmt(name, [], Expr.ScopeStmt(), line)
         self.consume(TokenType.LEFT_PAREN, exp='(')
         params = []
         if not self.consume(TokenType.RIGHT_PAREN):
@@ -116,7 +131,7 @@ class Parser(object):
                 self.consume(TokenType.COMMA, exp=',')
         self.consume(TokenType.LEFT_BRACE, exp='{')
         block = self.scopeStmt()
-        return Expr.FuncStmt(name, params, block)
+        return Expr.FuncStmt(name, params, block, line)
 
     def clsStmt(self):
         name = self.identifier()
@@ -156,7 +171,7 @@ class Parser(object):
         if not self.match(TokenType.SEMICOLON):
             condition = self.expression()
         else:
-            condition = Expr.Literal(self.currToken()._replace(type=TokenType.TRUE, lexeme='true', literal=None))
+            condition = Expr.Literal(Token(TokenType.TRUE, 'true', None, self.currToken().line))
         self.consume(TokenType.SEMICOLON, exp=';')
         iteration = self.expression() if not self.match(TokenType.RIGHT_PAREN) else None
         self.consume(TokenType.RIGHT_PAREN, exp=')')
@@ -171,7 +186,7 @@ class Parser(object):
         return Expr.FlowStmt(tok, value)
 
     def voidStmt(self):
-        return Expr.Literal(self.lastToken()._replace(type=TokenType.NIL, lexeme='nil', literal=None))
+        return Expr.Literal(Token(TokenType.NIL, 'nil', None, self.lastToken().line))
 
     def exprStmt(self):
         ast = self.expression()
@@ -0,0 +1,244 @@
+'''peephole optimizer of the byte code made by Compiler, run before StackVM decodes it'''
+from bisect import bisect_left, bisect_right
+from StackVM import StackVM, FuncProto
+
+class Peephole:
+    """rewrites the code a Compiler appended from pc start, in place: threads jumps landing on
+    a JMP (or on a boolean LOAD and a conditional jump), turns a conditional jump over a JMP into
+    the inverse jump, drops jumps to the next instruction, unreachable code, DUP; POP, LOAD; POP
+    and the DUP and POP around SET_LOCAL, SET_UPVALUE and SET_GLOBAL; then lays out the code
+    again, moving the jumps (widened when too far for 16 bits), lines, notes and function entries
+    along. Only what runs the same is rewritten, so the output and the runtime errors stay as they were"""
+    Ends = { StackVM.JMP, StackVM.RETURN, StackVM.TERM, StackVM.ASSERT }   # never fall through
+    Stores = { StackVM.SET_LOCAL, StackVM.SET_UPVALUE, StackVM.SET_GLOBAL } # pop what they store
+    Inverse = { StackVM.JZ : StackVM.JNZ, StackVM.JNZ : StackVM.JZ }
+
+    def __init__(self, compiler):
+        self.compiler = compiler
+
+    def optimize(self, start=0):
+        code = self.compiler.code
+        self.start, self.end = start, len(code)
+        self.ins = self.decode()    # [pc, op, operand, pc of op] of each instruction, op None if dropped
+        if self.ins is None: return     # hand written code, with targets unknown
+        self.pcs = [ins[0] for ins in self.ins]
+        self.at = { pc : i for i, pc in enumerate(self.pcs) }
+        while self.rewrite() | self.dropUnreachable(): pass
+        self.layout()
+
+    def decode(self):
+        'the instructions from start, an EXTENDED_ARG prefix is part of its instruction; None if not compiled'
+        code, ins, pc = self.compiler.code, [], self.start
+        while pc < self.end:
+            head, extended = pc, None
+            while code[pc] == StackVM.EXTENDED_ARG:
+                opd = code[pc+1] | code[pc+2] << 8
+                if extended is None: extended = opd - 0x10000 if opd & 0x8000 else opd
+                else: extended = extended << 16 | opd
+                pc += 3
+            op = code[pc]
+            if op == StackVM.JMPTO or op == StackVM.SAVE: return None
+            if op not in StackVM.Operand:
+                ins.append([head, op, None, pc])
+                pc += 1
+                continue
+            opd = code[pc+1] | code[pc+2] << 8
+            if extended is not None: opd |= extended << 16
+            elif opd & 0x8000: opd -= 0x10000
+            if op in StackVM.Jumps: opd += pc + 3     # the target pc
+            ins.append([head, op, opd, pc])
+            pc += 3
+        return ins
+
+    # instructions by index
+    def live(self, i):
+        'index of the first kept instruction from index i, len(ins) at the end'
+        ins = self.ins
+        while i < len(ins) and ins[i][1] is None: i += 1
+        return i
+
+    def follow(self, pc):
+        'index of the instruction running first from pc'
+        return self.live(self.at.get(pc, len(self.ins)))
+
+    def pcOf(self, i):
+        return self.ins[i][0] if i < len(self.ins) else self.end
+
+    def entries(self):
+        'indexes of the function entries in the code'
+        return [self.follow(d.entry) for d in self.compiler.data
+                if type(d) is FuncProto and self.start <= d.entry < self.end]
+
+    def targets(self):
+        'indexes of the instructions jumped to or entered'
+        targets = { self.live(0), *self.entries() }
+        targets.update(self.follow(ins[2]) for ins in self.ins if ins[1] in StackVM.Jumps)
+        return targets
+
+    def constant(self, ins):
+        'the boolean loaded by ins, None if not a boolean LOAD'
+        if ins[1] != StackVM.LOAD: return None
+        value = self.compiler.data[ins[2]]
+        return value if type(value) is bool else None
+
+    def decide(self, i, value):
+        'pc the conditional jump at index i goes to with value'
+        jump = self.ins[i]
+        taken = (value is False) if jump[1] == StackVM.JZ else (value is True)
+        return jump[2] if taken else self.pcOf(self.live(i + 1))
+
+    # rewrites
+    def rewrite(self):
+        'one pass of the rewrites, returns whether anything changed'
+        ins, n, changed = self.ins, len(self.ins), False
+        targets = self.targets()
+        JMP, LOAD, DUP, POP = StackVM.JMP, StackVM.LOAD, StackVM.DUP, StackVM.POP
+        for i in range(n):
+            op = ins[i][1]
+            if op is None: continue
+            if op in StackVM.Jumps:
+                target = self.thread(ins[i])
+                if target != ins[i][2]:
+                    ins[i][2], changed = target, True
+                    targets.add(self.follow(target))
+            k = self.live(i + 1)
+            if op == JMP and self.follow(ins[i][2]) == k:   # to the next instruction
+                ins[i][1], changed = None, True
+                continue
+            if k == n or k in targets: continue     # the rewrites below take ins[i] and ins[k] as a pair
+            nextOp = ins[k][1]
+            if op in self.Inverse and nextOp == JMP and self.follow(ins[i][2]) == self.live(k + 1):   # JZ over JMP: JNZ
+                ins[i][1:3], ins[k][1] = [self.Inverse[op], ins[k][2]], None
+            elif self.constant(ins[i]) is not None and nextOp in self.Inverse:     # LOAD true; JZ
+                target = self.decide(k, self.constant(ins[i]))
+                if target == self.pcOf(self.live(k + 1)): ins[k][1] = None
+                else: ins[k][1:3] = [JMP, target]
+                ins[i][1] = None
+            elif self.constant(ins[i]) is not None and nextOp == JMP:   # LOAD true; JMP to JZ
+                j = self.follow(ins[k][2])
+                if j == n or ins[j][1] not in self.Inverse: continue
+                target = self.decide(j, self.constant(ins[i]))
+                ins[k][2], ins[i][1] = target, None
+                targets.add(self.follow(target))
+            elif (op == DUP or op == LOAD) and nextOp == POP:
+                ins[i][1] = ins[k][1] = None
+            elif op == DUP and nextOp in self.Stores:   # DUP; SET_LOCAL; POP
+                j = self.live(k + 1)
+                if j == n or j in targets or ins[j][1] != POP: continue
+                ins[i][1] = ins[j][1] = None
+            else:
+                continue
+            changed = True
+        return changed
+
+    def thread(self, jump):
+        'the final target of jump, through the JMPs and the decided conditional jumps it lands on'
+        target, seen = jump[2], set()
+        while target not in seen:
+            seen.add(target)
+            i = self.follow(target)
+            if i == len(self.ins): break
+            ins = self.ins[i]
+            if ins[1] == StackVM.JMP:
+                new = ins[2]
+            elif self.constant(ins) is not None and self.live(i + 1) < len(self.ins) and \
+                    self.ins[self.live(i + 1)][1] in self.Inverse:
+                new = self.decide(self.live(i + 1), self.constant(ins))
+            else:
+                break
+            target = new
+        return target
+
+    def dropUnreachable(self):
+        'drop the instructions no path reaches, returns whether any was dropped'
+        ins, n = self.ins, len(self.ins)
+        reached, todo = set(), [self.live(0), *self.entries()]
+        while todo:
+            i = todo.pop()
+            if i >= n or i in reached: continue
+            reached.add(i)
+            op = ins[i][1]
+            if op in StackVM.Jumps: todo.append(self.follow(ins[i][2]))
+            if op not in self.Ends: todo.append(self.live(i + 1))
+        dropped = [i for i in range(n) if ins[i][1] is not None and i not in reached]
+        for i in dropped: ins[i][1] = None
+        return bool(dropped)
+
+    # layout
+    @staticmethod
+    def encode(op, opd, wide=False):
+        'bytes of an instruction, with the EXTENDED_ARG prefixes of a wide operand, see Compiler.append'
+        if opd is None: return bytes((op,))
+        prefix = b''
+        if wide or not -0x8000 <= opd < 0x8000:
+            prefix = Peephole.encode(StackVM.EXTENDED_ARG, opd >> 16)
+            opd = (opd & 0x7fff) - (opd & 0x8000)
+        return prefix + bytes((op, opd & 0xff, opd >> 8 & 0xff))
+
+    def layout(self):
+        'write the kept instructions back from start, move the jumps, lines, notes and entries'
+        compiler, ins, n = self.compiler, self.ins, len(self.ins)
+        kept = [i for i in range(n) if ins[i][1] is not None]
+        jumps = [i for i in kept if ins[i][1] in StackVM.Jumps]
+        wide = set()    # jumps too far for 16 bits, with an EXTENDED_ARG; more of them only make code longer
+        while True:
+            newPc, size, pc = {}, {}, self.start
+            for i in kept:
+                op = ins[i][1]
+                size[i] = (6 if i in wide else 3) if op in StackVM.Jumps else len(self.encode(op, ins[i][2]))
+                newPc[i], pc = pc, pc + size[i]
+            newPc[n] = pc
+            dist = { i : newPc[self.follow(ins[i][2])] - (newPc[i] + size[i]) for i in jumps }
+            far = { i for i in jumps if i not in wide and not -0x8000 <= dist[i] < 0x8000 }
+            if not far: break
+            wide |= far
+        code = bytearray()
+        for i in kept:
+            op, opd = ins[i][1:3]
+            code += self.encode(op, dist[i], i in wide) if op in StackVM.Jumps else self.encode(op, opd)
+        entries = { d.entry for d in compiler.data if type(d) is FuncProto and self.start <= d.entry < self.end }
+        compiler.code[self.start:] = code
+
+        def moved(pc):  # new pc of the code from old pc on
+            return newPc[self.live(bisect_left(self.pcs, pc))]
+        lines = [entry for entry in compiler.lines if entry[0] < self.start]
+        for pc, line in compiler.lines[len(lines):]:
+            pc = moved(pc)
+            if lines and lines[-1][0] == pc: lines.pop()
+            if not lines or lines[-1][1] != line: lines.append((pc, line))
+        compiler.lines[:] = lines
+        notes = {}
+        for pc, note in compiler.notes.items():
+            if pc < self.start:
+                notes[pc] = note
+                continue
+            i = bisect_right(self.pcs, pc) - 1     # the instruction, with its prefixes, holding pc
+            if ins[i][3] == pc and ins[i][1] is not None:   # at the op, past the prefixes it has now
+                notes[newPc[i] + size[i] - (3 if ins[i][1] in StackVM.Operand else 1)] = note
+        compiler.notes.clear()
+        compiler.notes.update(notes)
+        for k, d in enumerate(compiler.data):
+            if type(d) is FuncProto and d.entry in entries:
+                compiler.data[k] = d._replace(entry=moved(d.entry))
+                compiler.dataSlots[compiler.key(compiler.data[k])] = compiler.dataSlots.pop(compiler.key(d))
+
+
+if __name__ == "__main__":
+    import sys
+    from Scanner import RegexScanner
+    from Parser import Parser
+    from Resolver import Resolver
+    from Optimizer import Optimizer
+    from Compiler import Compiler
+    if len(sys.argv) != 2:
+        sys.exit('usage: python Peephole.py file.lox: prints the byte code before and after')
+    with open(sys.argv[1]) as f:
+        ast, errors = Parser(RegexScanner(f.read()).iterTokens()).parse()
+    errors = errors or Resolver().resolve(ast)
+    if errors: sys.exit('\n'.join(map(str, errors)))
+    compiler = Compiler()
+    compiler.compile(Optimizer().optimize(ast))
+    for title in ('before', 'after'):
+        if title == 'after': Peephole(compiler).optimize()
+        print('; {}: {} bytes'.format(title, len(compiler.code)))
+        StackVM(compiler.code, compiler.data, compiler.names).print()
@@ -0,0 +1,196 @@
+'''deterministic call profiler of Lox functions, classes and builtins, on every engine'''
+import sys, marshal
+from time import perf_counter
+from contextlib import contextmanager
+from functools import wraps
+from Functions import *
+from Environment import UNDEFINED
+from StackVM import StackVM, LoxClosure
+
+class Profiler:
+    '''counts calls, own (exclusive) and cumulative (inclusive) time of each callee, keyed as
+    pstats does by (filename, line, name); builtins are ('~', 0, '<built-in name>')'''
+    def __init__(self, filename='<stdin>', timer=perf_counter):
+        self.filename = filename
+        self.timer = timer
+        self.stats = {}     # key => [primitive calls, calls, own time, cumulative time, {caller key => same}]
+        self.folded = {}    # call path => own time
+        self.paths = {}     # (parent path, key) => call path, an index of self.nodes, -1 is the root
+        self.nodes = []     # call path => (parent path, key), flat: deep recursion makes deep paths
+        self.stack = []     # [key, path, start time, time of children] of running calls
+        self.active = {}    # key => its calls on self.stack, a recursive call is not primitive
+        self.frames = []    # number of keys entered by each vm frame, left by RETURN
+
+    def key(self, callee):
+        if type(callee) is LoxFunc:
+            return self.filename, callee.line, callee.name
+        if type(callee) is LoxClosure:
+            return self.filename, callee.proto.line, callee.proto.name
+        if isinstance(callee, LoxClass):
+            if not getattr(callee, 'line', 0): return '~', 0, '<class {}>'.format(callee.name)
+            return self.filename, callee.line, 'class {}'.format(callee.name)
+        name = getattr(callee, '__name__', None) or str(callee)
+        return '~', 0, '<built-in {}>'.format(name.split('loxfn_', 1)[-1])
+
+    def enter(self, key):
+        node = (self.stack[-1][1] if self.stack else -1, key)
+        path = self.paths.get(node)
+        if path is None:
+            path = self.paths[node] = len(self.nodes)
+            self.nodes.append(node)
+        self.active[key] = self.active.get(key, 0) + 1
+        self.stack.append([key, path, self.timer(), 0.0])
+
+    def leave(self):
+        key, path, start, children = self.stack.pop()
+        total = self.timer() - start
+        own = total - children
+        self.active[key] -= 1
+        primitive = not self.active[key]
+        stat = self.stats.get(key)
+        if stat is None: stat = self.stats[key] = [0, 0, 0.0, 0.0, {}]
+        stats = [stat]
+        if self.stack:
+            caller = self.stack[-1]
+            caller[3] += total
+            byCaller = stat[4].get(caller[0])
+            if byCaller is None: byCaller = stat[4][caller[0]] = [0, 0, 0.0, 0.0]
+            stats.append(byCaller)
+        for s in stats:
+            s[1] += 1
+            s[2] += own
+            if primitive:
+                s[0] += 1
+                s[3] += total
+        self.folded[path] = self.folded.get(path, 0.0) + own
+
+    def unwind(self):
+        'leave the calls left running by an error'
+        while self.stack: self.leave()
+        self.frames.clear()
+
+    @contextmanager
+    def hooked(self, engine):
+        'profile the calls made by engine, an Interpreter, ClosureCompiler or StackVM, in the with block'
+        if isinstance(engine, StackVM):
+            with self.hookedVM(engine): yield
+            return
+        # LoxFunc and LoxMethod calls go through engine.callFunc, the ClosureCompiler calls it directly
+        callFunc, classCall = engine.callFunc, LoxClass.__call__
+        def profiledCall(func, args, this=UNDEFINED):
+            self.enter(self.key(func))
+            try:
+                return callFunc(func, args, this)
+            finally:
+                self.leave()
+        def profiledNew(cls, interp, args):
+            self.enter(self.key(cls))
+            try:
+                return classCall(cls, interp, args)
+            finally:
+                self.leave()
+        builtins = { name : self.wrap(fn) for name, fn in engine.globals.items() if type(fn) is type(stringify) }
+        engine.callFunc, LoxClass.__call__ = profiledCall, profiledNew
+        engine.globals.update(builtins)
+        try:
+            yield
+        finally:
+            del engine.callFunc
+            LoxClass.__call__ = classCall
+            for name, fn in builtins.items():
+                if engine.globals.get(name) is fn: engine.globals[name] = fn.__wrapped__
+
+    def wrap(self, fn):
+        key = self.key(fn)
+        @wraps(fn)
+        def profiled(*args, **kw):
+            self.enter(key)
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.leave()
+        return profiled
+
+    @contextmanager
+    def hookedVM(self, vm):
+        'swaps the call and RETURN handlers of vm, which is decoded again'
+        funcs = list(StackVM.Funcs)
+        ret, recover = funcs[StackVM.RETURN][1], vm.recover
+        def profiled(call, calleeOf):
+            def opCall(s, x):
+                keys = self.keys(calleeOf(s.stack, x))
+                for key in keys: self.enter(key)
+                depth = len(s.frames)
+                try:
+                    call(s, x)
+                except BaseException:
+                    for key in keys: self.leave()
+                    raise
+                if len(s.frames) > depth:   # a closure runs in its frame until RETURN
+                    self.frames.append(len(keys))
+                else:
+                    for key in keys: self.leave()
+            return opCall
+        def methodOf(stack, x):     # see StackVM.opGetMethod
+            return stack[-x-1] if stack[-x-1] is not None else stack[-x-2]
+        def opReturn(s, x):
+            ret(s, x)
+            for i in range(self.frames.pop()): self.leave()
+        def profiledRecover():
+            self.unwind()
+            recover()
+        funcs[StackVM.CALL] = ('CALL', profiled(funcs[StackVM.CALL][1], lambda stack, x: stack[-x-1]))
+        funcs[StackVM.CALL_METHOD] = ('CALL_METHOD', profiled(funcs[StackVM.CALL_METHOD][1], methodOf))
+        # tail calls are profiled as calls, each in a frame of its own
+        funcs[StackVM.TAIL_CALL] = ('TAIL_CALL', funcs[StackVM.CALL][1])
+        funcs[StackVM.TAIL_CALL_METHOD] = ('TAIL_CALL_METHOD', funcs[StackVM.CALL_METHOD][1])
+        funcs[StackVM.RETURN] = ('RETURN', opReturn)
+        vm.Funcs, vm.decoded, vm.recover = funcs, [], profiledRecover
+        try:
+            yield
+        finally:
+            del vm.Funcs, vm.recover
+            vm.decoded = []
+
+    def keys(self, callee):
+        'keys entered by the vm calling callee: a class is entered, then its init'
+        if type(callee) is LoxMethod:
+            callee = callee.func
+        if type(callee) is LoxClass:
+            init = callee.getattr('init')
+            return (self.key(callee), self.key(init)) if type(init) is LoxClosure else (self.key(callee),)
+        if type(callee) is LoxClosure or callable(callee):
+            return (self.key(callee),)
+        return ()
+
+    # output
+    def report(self, file=None, limit=None):
+        'print the stats sorted by own time, in the columns of pstats'
+        file = file or sys.stderr
+        stats = sorted(self.stats.items(), key=lambda item: item[1][2], reverse=True)
+        calls = sum(stat[1] for key, stat in stats)
+        total = sum(stat[2] for key, stat in stats)
+        print('{} calls in {:.3f} seconds\n'.format(calls, total), file=file)
+        print('{:>12s} {:>9s} {:>9s} {:>9s} {:>9s}  {}'.format(
+              'ncalls', 'tottime', 'percall', 'cumtime', 'percall', 'filename:lineno(function)'), file=file)
+        for (filename, line, name), (cc, nc, tt, ct, callers) in stats[:limit]:
+            ncalls = str(nc) if nc == cc else '{}/{}'.format(nc, cc)
+            print('{:>12s} {:9.3f} {:9.3f} {:9.3f} {:9.3f}  {}:{}({})'.format(
+                  ncalls, tt, tt / nc, ct, ct / cc if cc else 0.0, filename, line, name), file=file)
+
+    def dump(self, path):
+        '''save the stats to path: as collapsed stacks with own microseconds for flame graphs,
+        if path ends with .folded, otherwise in the marshal format of pstats.Stats'''
+        if path.endswith('.folded'):
+            with open(path, 'w') as f:
+                for path, own in self.folded.items():
+                    frames = []
+                    while path >= 0:
+                        path, (filename, line, name) = self.nodes[path]
+                        frames.append('{}:{}'.format(name, line) if line else name)
+                    f.write('{} {}\n'.format(';'.join(reversed(frames)), round(own * 1e6)))
+        else:
+            stats = { key : (cc, nc, tt, ct, { caller : tuple(s) for caller, s in callers.items() })
+                      for key, (cc, nc, tt, ct, callers) in self.stats.items() }
+            with open(path, 'wb') as f:
+                marshal.dump(stats, f)
@@ -5,23 +5,72 @@ from LoxError import *
 from Functions import *
 from Environment import *
 
+class Local:
+    """a variable of a local scope, kept in its [name, initialized, Local] entry: closures copy it,
+    unless it is boxed: assigned after its declaration, or captured before it gets its value"""
+    __slots__ = ('ready', 'boxed', 'captured')
+    def __init__(self):
+        self.ready, self.boxed, self.captured = True, False, False
+
+class Closure:
+    """the variables of enclosing functions captured by a function, whose frame is env"""
+    def __init__(self, env, enclosing):
+        self.env, self.enclosing = env, enclosing
+        self.captures = []  # (depth, slot, Local) from where the function is made
+        self.indexes = {}   # Local => its index in captures, the slot in the closure Frame
+
+    def capture(self, where, kv):
+        local = kv[2]
+        local.captured = True
+        if not local.ready: local.boxed = True
+        i = self.indexes.get(local)
+        if i is None:
+            i = self.indexes[local] = len(self.captures)
+            self.captures.append((*where, local))
+        return i
+
 class Resolver(Expr.Visitor):
-    """resolve variables"""
+    """resolve variables, (depth, slot) is stored in `where` of the Identifier/declaring node.
+    A function closes over the variables it uses of enclosing functions only: they are at
+    depth + 1 past its frame, in the closure Frame made from the `captures` of its FuncStmt"""
     def __init__(self):
         self.env = Environment(initial=[(k, True) for k, v in lox_builtins])
-        self.ids = {}
         self.errors = []
         self.currentLoop = self.currentFunction = 0
+        self.closure = None     # Closure of the function being resolved
+        self.closures = []      # (FuncStmt, Closure) resolved, captures are set when all is resolved
 
     @contextmanager
     def subEnv(self, initial=None):
         saved = self.env
         self.env = Environment(parent=self.env, initial=initial)
+        for kv in self.env.vars: kv.append(Local())
         try:
-            yield
+            yield self.env
         finally:
             self.env = saved
 
+    def find(self, name, env, closure):
+        '''returns (depth, slot), kv of name from env in the function of closure: a variable of an
+        enclosing function is captured by closure, and of all the functions between'''
+        depth = 0
+        while env.parent:   # local
+            i = env.vars.lookup(name)
+            if i >= 0: return (depth, i), env.vars[i]
+            if closure and env is closure.env:
+                where, kv = self.find(name, env.parent, closure.enclosing)
+                if where[0] < 0: return where, kv
+                return (depth + 1, closure.capture(where, kv)), kv
+            env, depth = env.parent, depth + 1
+        i = env.vars.lookup(name)
+        if i < 0: raise KeyError(name)
+        return (-1, i), env.vars[i]     # global env => -1
+
+    @staticmethod
+    def cells(env):
+        'slots of the scope env shared with closures in a Cell: captured and boxed'
+        return tuple(i for i, kv in enumerate(env.vars) if kv[2].captured and kv[2].boxed)
+
     def defineVar(self, name, inited=False, check=True):
         succeed = self.env.define(name.lexeme, inited)
         if not succeed:
@@ -29,28 +78,38 @@ class Resolver(Expr.Visitor):
                 raise ResolveError(name.line, "duplicated declaration of var {}".format(name.lexeme))
             else:
                 self.env.assign(name.lexeme, inited)
-
-    def resolveGet(self, name):
+        kv = self.env.vars[name.lexeme]
+        if self.env.parent:
+            if succeed: kv.append(Local())
+            else: kv[2].boxed = True    # declared again: assigned
+        # declared in current env: depth 0, or -1 for global env
+        return (0 if self.env.parent else -1, self.env.vars.lookup(name.lexeme))
+
+    def lookup(self, name):
         try:
-            pos, kv = self.env.index(name.lexeme)
+            return self.find(name.lexeme, self.env, self.closure)
         except KeyError:
             raise ResolveError(name.line, "var {} used without being defined".format(name.lexeme))
+
+    def resolveGet(self, name):
+        pos, kv = self.lookup(name)
         if not kv[1]:
             raise ResolveError(name.line, "var {} used without being initialized".format(name.lexeme))
         return pos
 
-    def resolveSet(self, name):
-        try:
-            pos, kv = self.env.index(name.lexeme)
-        except KeyError:
-            raise ResolveError(name.line, "var {} used without being defined".format(name.lexeme))
+    def resolveSet(self, name, initial=False):
+        'initial: the initializer of a declaration, not an assignment'
+        pos, kv = self.lookup(name)
+        if not initial and pos[0] >= 0: kv[2].boxed = True
         kv[1] = True
         return pos
 
     def resolve(self, ast):
-        self.errors = []
+        self.errors, self.closures = [], []
         self.visit(ast)
-        return self.ids, self.errors # return ids and errors
+        for stmt, closure in self.closures:
+            stmt.captures = tuple((depth, slot, local.boxed) for depth, slot, local in closure.captures)
+        return self.errors
 
     def visitProgram(self, prog):
         for stmt in prog:
@@ -60,47 +119,62 @@ class Resolver(Expr.Visitor):
                 self.errors.append(ex)
 
     def visitScopeStmt(self, stmt):
-        with self.subEnv():
+        with self.subEnv() as env:
             self.visitProgram(stmt)
+        stmt.nslots = len(env.vars)   # frame size of the scope
+        stmt.cells = self.cells(env)
 
     def visitVarStmt(self, stmt):
-        self.defineVar(stmt.name)
+        stmt.where = self.defineVar(stmt.name)
         if stmt.initial is not None:
             self.visit(stmt.initial)
-            self.resolveSet(stmt.name)
+            self.resolveSet(stmt.name, initial=True)
 
     def visitFuncStmt(self, stmt, isMethod=False):
+        local = None
         if stmt.name:
-            self.defineVar(stmt.name, inited=True, check=False)
-        with self.subEnv(initial=([('this',True)] if isMethod else [])):
+            stmt.where = self.defineVar(stmt.name, inited=True, check=False)
+            if stmt.where[0] >= 0:  # gets the function once it is made
+                local = self.env.vars[stmt.name.lexeme][2]
+                local.ready = False
+        with self.subEnv(initial=([('this',True)] if isMethod else [])) as env:
+            enclosing = self.closure
+            self.closure = Closure(env, enclosing)
+            self.closures.append((stmt, self.closure))
             for p in stmt.params: self.defineVar(p, inited=True)
             self.currentFunction += 1
             self.visitProgram(stmt.block)
             self.currentFunction -= 1
+            self.closure = enclosing
+        if local: local.ready = True
+        stmt.block.nslots = len(env.vars)   # frame size of the function, including this & params
+        stmt.block.cells = self.cells(env)
 
     def visitClassStmt(self, stmt):
-        self.defineVar(stmt.name, inited=False, check=False)
+        stmt.where = self.defineVar(stmt.name, inited=False, check=False)
         if stmt.parent:
-            self.ids[stmt.parent] = self.resolveGet(stmt.parent)
-        self.resolveSet(stmt.name)
+            stmt.parent_where = self.resolveGet(stmt.parent)
+        self.resolveSet(stmt.name, initial=True)
+        local = self.env.vars[stmt.name.lexeme][2] if stmt.where[0] >= 0 else None
+        if local: local.ready = False   # gets the class once its methods are made
         with self.subEnv(initial=[('super',True)]):
             for method in stmt.members:
                 self.visitFuncStmt(method, isMethod=True)
+        if local: local.ready = True
 
     def visitAttribExpr(self, expr):
         self.visit(expr.object)
         # for now, we know nothing about expr.attribute
 
     def visitIdentifierExpr(self, expr):
-        tok = expr.value
-        self.ids[tok] = self.resolveGet(tok)
-        return
+        expr.where = self.resolveGet(expr.value)
+        if expr.value.type == TokenType.SUPER:   # and where this is: (depth, slot, this depth, this slot)
+            expr.where += self.find('this', self.env, self.closure)[0]
 
     def _visitAssignExpr(self, expr):
         if isinstance(expr.left, Expr.Identifier):
             self.visit(expr.right)
-            tok = expr.left.value
-            self.ids[tok] = self.resolveSet(tok)
+            expr.left.where = self.resolveSet(expr.left.value)
         elif isinstance(expr.left, Expr.Attrib):
             self.visit(expr.left)
             self.visit(expr.right)
@@ -1,5 +1,6 @@
+import re, gc, sys, codecs
+from array import array
 from enum import Enum
-from collections import namedtuple
 from LoxError import *
 
 class TokenType(Enum):
@@ -26,7 +27,13 @@ TokenType.Keys = (
     )
 TokenType.KeyMap = { k : TokenType(i) for i, k in enumerate(TokenType.Keys) }
 
-class Token(namedtuple("Token", "type,lexeme,literal,line,char")):
+class Token:
+    """compared by identity, a resolution keyed by the token is one of its occurrence;
+    lexemes are interned by RegexScanner, and the line is shared by the tokens in it;
+    the column is kept aside, in Scanner.columns"""
+    __slots__ = ('type', 'lexeme', 'literal', 'line')
+    def __init__(self, type, lexeme, literal, line):
+        self.type, self.lexeme, self.literal, self.line = type, lexeme, literal, line
     def __repr__(self):
         return '<{}: {}>'.format(self.type.name, str(self))
     def __str__(self):
@@ -40,14 +47,21 @@ class Scanner:
     def __init__(self, source):
         self.source = source
         self.start = self.current = 0
-        self.line, self.linebeg = 1, -1
+        self.line, self.linebeg = 1, -1     # linebeg: index of the last newline
         self.tokens = []
+        self.columns = array('I')   # column of each token scanned, by its index in the token stream
 
     def curToken(self):
         return self.source[self.start:self.current]
 
     def addToken(self, type, literal=None):
-        self.tokens.append(Token(type, self.curToken(), literal, self.line, self.start - self.linebeg))
+        self.tokens.append(Token(type, self.curToken(), literal, self.line))
+        self.columns.append(self.column())
+
+    def column(self):
+        'column of the token scanned, from 1'
+        if self.linebeg < self.start: return self.start - self.linebeg
+        return self.start - self.source.rfind('\n', 0, self.start)   # the token went on to the next lines
 
     def scanTokens(self):
         while not self.isAtEnd():
@@ -96,7 +110,7 @@ class Scanner:
         try:
             v = float(s)
         except ValueError:
-            raise ParserError(self.line, 'parse "{}" as number failed'.format(s))
+            raise ParserError(self.line, 'parse "{}" as number failed'.format(s), self.column())
         self.addToken(TokenType.NUMBER, v)
 
     def scanString(self):
@@ -114,12 +128,12 @@ class Scanner:
             else:
                 escape = False  # escape only one char
         if not ended:
-            raise ParserError(self.line, 'string terminated at unexpected position')
+            raise ParserError(self.line, 'string terminated at unexpected position', self.column())
         s = self.curToken()
         try:
             v = eval(s) # evaluate string as python string
         except SyntaxError:
-            raise ParserError(self.line, 'parse "{}" as string failed'.format(s))
+            raise ParserError(self.line, 'parse "{}" as string failed'.format(s), self.column())
         self.addToken(TokenType.STRING, v)
 
     def scanSymbol(self):
@@ -142,7 +156,7 @@ class Scanner:
         s = self.curToken()
         key = TokenType.KeyMap.get(s)
         if key is None:
-            raise ParserError(self.line, 'unexpected character "{}"'.format(s))
+            raise ParserError(self.line, 'unexpected character "{}"'.format(s), self.column())
         self.addToken(key)
 
     def isAtEnd(self):
@@ -156,8 +170,7 @@ class Scanner:
     def advance(self):
         c = self.source[self.current]
         if c == '\n':
-            self.line += 1
-            self.linebeg = self.current
+            self.line, self.linebeg = self.line + 1, self.current
         self.current += 1
         return c
 
@@ -167,10 +180,142 @@ class Scanner:
     @staticmethod
     def checkParen(tokens):
         '''returns: =0: left/right paren match; >0: left > right; <0: left < right(error)'''
-        checking = (TokenType.LEFT_PAREN, TokenType.RIGHT_PAREN, TokenType.LEFT_BRACE, TokenType.RIGHT_BRACE)
-        counter = { k : 0 for k in checking }
+        paren, brace = Scanner.countParens(tokens)
+        return paren or brace
+
+    @staticmethod
+    def countParens(tokens, counter=(0, 0)):
+        '''returns counter (paren, brace) plus the unclosed parens and braces in tokens,
+        so a running balance is updated by the new tokens only'''
+        paren, brace = counter
         for tok in tokens:
-            if tok.type in checking:
-                counter[tok.type] += 1
-        return ((counter[TokenType.LEFT_PAREN] - counter[TokenType.RIGHT_PAREN]) or
-                (counter[TokenType.LEFT_BRACE] - counter[TokenType.RIGHT_BRACE]))
+            t = tok.type
+            if t == TokenType.LEFT_PAREN: paren += 1
+            elif t == TokenType.RIGHT_PAREN: paren -= 1
+            elif t == TokenType.LEFT_BRACE: brace += 1
+            elif t == TokenType.RIGHT_BRACE: brace -= 1
+        return paren, brace
+
+
+class RegexScanner(Scanner):
+    """Scanner matching whole tokens with one master regex, emits the same tokens"""
+    Pattern = re.compile(r"""
+        [^\S\n]*        # spaces before the token, in the same line
+        (?:
+             (?P<ident>[^\W\d]\w*)
+            |(?P<symbol>[!=<>]=?|[(){},.\-+;*]|/(?![/*]))
+            |(?P<number>\d+(?:\.\d+)?)
+            |(?P<string>"(?:[^"\\]|\\.)*")
+            |(?P<space>\s+)
+            |(?P<comment>//[^\n]*\n?|/\*(?:/|.*?\*/))
+            |(?P<error>/\*|"|.)
+        )""", re.VERBOSE | re.DOTALL)
+    Escape = re.compile(r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|[0-7]{1,3}|N\{[^}]*\}|.)', re.DOTALL)
+    Escapes = { 'n': '\n', 't': '\t', 'r': '\r', 'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v',
+                '\\': '\\', '"': '"', "'": "'", '\n': '' }
+
+    def scanTokens(self):
+        enabled = gc.isenabled()
+        gc.disable()    # tokens are acyclic, don't let the collector rescan them while growing
+        try:
+            self.tokens.extend(self.iterTokens())
+            return self.tokens
+        finally:
+            if enabled: gc.enable()
+
+    def iterTokens(self, chunks=None):
+        '''yields the tokens of source, then of chunks (an iterable of str, see chunksOf) read lazily,
+        only the unscanned tail of the input is kept in memory'''
+        source, pos, line, keys = self.source, self.current, self.line, TokenType.KeyMap
+        linebeg, addColumn = self.linebeg, self.columns.append     # linebeg is relative to source, moved with it
+        more = iter(chunks) if chunks is not None else None
+        intern, numbers = sys.intern, {}    # lexemes and values shared by equal tokens
+        IDENTIFIER, NUMBER, STRING = TokenType.IDENTIFIER, TokenType.NUMBER, TokenType.STRING
+        while True:
+            # a token ending near the end of the buffer may go on in the next chunk ("12" + ".5", "!" + "=")
+            limit = len(source) - 2 if more else len(source)
+            for m in RegexScanner.Pattern.finditer(source, pos):
+                end, kind = m.end(), m.lastgroup
+                if end > limit: break
+                if kind == 'ident':
+                    lexeme = intern(m[kind])
+                    addColumn(m.start(kind) - linebeg)
+                    yield Token(keys.get(lexeme, IDENTIFIER), lexeme, None, line)
+                elif kind == 'symbol':
+                    lexeme = intern(m[kind])
+                    addColumn(m.start(kind) - linebeg)
+                    yield Token(keys[lexeme], lexeme, None, line)
+                elif kind == 'space' or kind == 'comment':
+                    start = m.start(kind)
+                    n = source.count('\n', start, end)
+                    if n: line, linebeg = line + n, source.rindex('\n', start, end)
+                elif kind == 'number':
+                    lexeme = m[kind]
+                    number = numbers.get(lexeme)
+                    if number is None: number = numbers[lexeme] = lexeme, float(lexeme)
+                    addColumn(m.start(kind) - linebeg)
+                    yield Token(NUMBER, number[0], number[1], line)
+                elif kind == 'string':
+                    lexeme, start = m[kind], m.start(kind)
+                    addColumn(start - linebeg)
+                    n = lexeme.count('\n')
+                    if n: line, linebeg = line + n, source.rindex('\n', start, end)
+                    yield Token(STRING, lexeme, self.unescape(lexeme, line), line)
+                else:   # error
+                    lexeme, start = m[kind], m.start(kind)
+                    if lexeme == '"' or lexeme == '/*':
+                        if more: break  # may be terminated in the next chunks
+                        raise ParserError(line + source.count('\n', start),
+                            'string terminated at unexpected position' if lexeme == '"' else 'unterminated block comment',
+                            start - linebeg)
+                    raise ParserError(line, 'unexpected character "{}"'.format(lexeme), start - linebeg)
+                pos = end
+            else:
+                if not more: break
+            # read at least as much as the unfinished tail, so that a long token is rescanned O(1) times
+            tail, parts, size = source[pos:], [], 0
+            while size <= len(tail):
+                chunk = next(more, None)
+                if chunk is None:
+                    more = None
+                    break
+                parts.append(chunk)
+                size += len(chunk)
+            source, pos, linebeg = tail + ''.join(parts), 0, linebeg - pos
+        self.line, self.linebeg = line, linebeg - pos
+        self.source, self.start = source[pos:], 0
+        self.current = len(self.source)
+        addColumn(self.current - self.linebeg)
+        yield Token(TokenType.EOF, '', None, line)
+
+    @staticmethod
+    def chunksOf(file, size=1 << 16):
+        'yields the content of a text or binary file, or a mmap, as str chunks of about size characters'
+        decode = codecs.getincrementaldecoder('utf-8')().decode
+        while True:
+            data = file.read(size)
+            chunk = data if isinstance(data, str) else decode(data, final=not data)
+            if chunk: yield chunk
+            if not data: return
+
+    @staticmethod
+    def unescape(lexeme, line):
+        'value of a string literal, escapes decoded as python does'
+        s = lexeme[1:-1]
+        if '\\' not in s and '\n' not in s: return s
+        if '\n' in RegexScanner.Escape.sub('', s):  # raw newline
+            raise ParserError(line, 'parse "{}" as string failed'.format(lexeme))
+        def decode(m):
+            e = m.group(1)
+            if e in RegexScanner.Escapes: return RegexScanner.Escapes[e]
+            if e[0] in '01234567': return chr(int(e, 8))
+            try:
+                if len(e) > 1 and e[0] in 'xuU': return chr(int(e[1:], 16))
+                if len(e) > 1 and e[0] == 'N':
+                    import unicodedata
+                    return unicodedata.lookup(e[2:-1])
+            except (KeyError, ValueError):
+                pass
+            if e[0] not in 'xuUN': return m.group()     # unknown escape is kept
+            raise ParserError(line, 'parse "{}" as string failed'.format(lexeme))
+        return RegexScanner.Escape.sub(decode, s)
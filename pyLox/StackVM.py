@@ -1,3 +1,69 @@
+import gc, sys, operator
+from contextlib import redirect_stdout
+from bisect import bisect_right
+from collections import namedtuple
+from Scanner import TokenType
+from LoxError import *
+from Functions import *
+from Environment import UNDEFINED
+from Interpreter import Interpreter, InterpType
+
+# prototypes kept in the constant pool, made by Compiler
+FuncProto = namedtuple('FuncProto', 'name, arity, entry, upvalues, method, line')    # upvalues: ((isLocal, index), ...)
+ClassProto = namedtuple('ClassProto', 'name, methods, line')  # methods: names of the closures on stack
+
+class LoxUpvalue:
+    'a captured variable: a stack slot while open, its own value after closed'
+    __slots__ = ('stack', 'index', 'value')
+    def __init__(self, stack, index):
+        self.stack, self.index, self.value = stack, index, None
+    def get(self):
+        return self.value if self.stack is None else self.stack[self.index]
+    def set(self, value):
+        if self.stack is None: self.value = value
+        else: self.stack[self.index] = value
+    def close(self):
+        self.value = self.stack[self.index]
+        self.stack = None
+
+class LoxClosure:
+    typename = 'LoxFunc'
+    __slots__ = ('proto', 'upvalues')
+    def __init__(self, proto, upvalues):
+        self.proto, self.upvalues = proto, upvalues
+    @property
+    def name(self):
+        return self.proto.name
+    def __str__(self):
+        return '<function {}>'.format(self.proto.name)
+
+class MethodCache:
+    '''inline cache of a GET_METHOD, SUPER_METHOD or GET_SUPER site: the method of the last class seen
+    there, where: how SUPER_METHOD, GET_SUPER and SET_SUPER find this, as the operand of SUPER'''
+    __slots__ = ('name', 'where', 'cls', 'method')
+    def __init__(self, name, where=None):
+        self.name, self.where, self.cls, self.method = name, where, None, None
+    def __repr__(self):
+        return repr(self.name)
+
+class FieldCache:
+    '''inline cache of a GET_ATTR or SET_ATTR site: the shape of the last instance seen there and the
+    index of the field, next: the shape after SET_ATTR, which added the field if index is past the end'''
+    __slots__ = ('name', 'shape', 'index', 'next')
+    def __init__(self, name):
+        self.name, self.shape, self.index, self.next = name, None, None, None
+    def __repr__(self):
+        return repr(self.name)
+
+class Fused:
+    '''a superinstruction at pc: the decoded entries of the plain instructions it runs at once, which
+    are run one by one when its fast path can not, see StackVM.replay'''
+    __slots__ = ('name', 'pc', 'parts')
+    def __init__(self, name, pc, parts):
+        self.name, self.pc, self.parts = name, pc, parts
+
+class Halt(Exception):
+    'raised by the sentinel after the last instruction'
 
 class StackVM:
     # operators
@@ -8,49 +74,61 @@ class StackVM:
     EQUAL, NOT_EQUAL,                               \
     GREATER, GREATER_EQUAL, LESS, LESS_EQUAL,       \
     PRINT, TERM,                                    \
-    OPS_COUNT_N = range(25)
-    # functions
-    Funcs = [
-        ('NOP', lambda s: None),
-        ('JMPTO', lambda s: s.jump(s.pop())),
-        ('JMP', lambda s: s.access('jump')),
-        ('JZ', lambda s: s.access(s.pop() and 'none' or 'jump')),
-        ('JNZ', lambda s: s.access(s.pop() and 'jump' or 'none')),
-        ('LOAD', lambda s: s.access('load')),
-        ('SAVE', lambda s: s.access('save')),
-        ('INST', lambda s: s.access('inst')),
-        ('DUP', lambda s: s.push(s.value())),
-        ('POP', lambda s: s.pop()),
-        ('NOT', lambda s: s.push(s.pop() == 0)),
-        ('NEGATIVE', lambda s: s.push(-s.pop())),
-        ('PLUS', lambda s: s.push(s.pop() + s.pop())),
-        ('MINUS', lambda s: s.push(s.pop() - s.pop())),
-        ('MULTIPLY', lambda s: s.push(s.pop() * s.pop())),
-        ('DIVIDE', lambda s: s.push(s.pop() / s.pop())),
-        ('EQUAL', lambda s: s.push(s.pop() == s.pop())),
-        ('NOT_EQUAL', lambda s: s.push(s.pop() != s.pop())),
-        ('GREATER', lambda s: s.push(s.pop() > s.pop())),
-        ('GREATER_EQUAL', lambda s: s.push(s.pop() >= s.pop())),
-        ('LESS', lambda s: s.push(s.pop() < s.pop())),
-        ('LESS_EQUAL', lambda s: s.push(s.pop() <= s.pop())),
-        ('PRINT', lambda s: print(s.pop())),
-        ('TERM', lambda s: s.term()),
-    ]
+    GET_LOCAL, SET_LOCAL, GET_UPVALUE, SET_UPVALUE, \
+    GET_GLOBAL, SET_GLOBAL, DEF_GLOBAL, REDEF_GLOBAL, \
+    RESERVE, DISCARD,                               \
+    CLOSURE, CALL, RETURN,                          \
+    INHERIT, CLASS, GET_ATTR, SET_ATTR, SUPER,      \
+    ASSERT, GET_METHOD, CALL_METHOD, SUPER_METHOD,  \
+    TAIL_CALL, TAIL_CALL_METHOD, EXTENDED_ARG,      \
+    GET_SUPER, SET_SUPER,                           \
+    OPS_COUNT_N = range(52)
+    # operators followed by a 2-byte operand; EXTENDED_ARG holds the bits above 16 of the next operand
+    Operand = { JMP, JZ, JNZ, LOAD, SAVE, INST, EXTENDED_ARG,
+                GET_LOCAL, SET_LOCAL, GET_UPVALUE, SET_UPVALUE,
+                GET_GLOBAL, SET_GLOBAL, DEF_GLOBAL, REDEF_GLOBAL,
+                RESERVE, DISCARD, CLOSURE, CALL, CLASS, GET_ATTR, SET_ATTR, SUPER, ASSERT,
+                GET_METHOD, CALL_METHOD, SUPER_METHOD, TAIL_CALL, TAIL_CALL_METHOD, GET_SUPER, SET_SUPER }
+    # operands decoded to a jump target, or to the (read only) constant or name they refer,
+    # or to a cache of the site
+    Jumps = { JMP, JZ, JNZ }
+    Refs = { CLOSURE, CLASS, ASSERT }
+    Names = { GET_GLOBAL, SET_GLOBAL, DEF_GLOBAL, REDEF_GLOBAL }
+    Caches = { GET_ATTR : FieldCache, SET_ATTR : FieldCache, GET_METHOD : MethodCache,
+               SUPER_METHOD : lambda name: MethodCache(*name),     # name of SUPER_METHOD: (name, where)
+               GET_SUPER : lambda name: MethodCache(*name), SET_SUPER : lambda name: MethodCache(*name) }
+    MaxDepth = 200000   # nested calls, the frames are on the heap: about 170 bytes each
 
-    def __init__(self, code=b'', data=[]):
+    def __init__(self, code=b'', data=(), names=()):
         self.code = bytearray(code)
-        self.data = data
+        self.data = list(data)      # constants
+        self.names = list(names)    # names of globals, attributes and methods
+        self.lines = []     # [(pc, line)], where source lines change
+        self.notes = {}     # pc => token or statement kind, for error messages
+        self.decoded = []   # pc => (handler, operand, next pc), None inside operands
+        self.globals = dict(lox_builtins)
         self.stack = []
+        self.frames = []    # saved (pc, base, closure, ctor) of callers
+        self.quickening = True  # fuse superinstructions when decoding, see quicken()
+        self.fused = {}     # pc => Fused, of the superinstructions in decoded
+        self.maxDepth = StackVM.MaxDepth    # len(frames) raising a stack overflow
+        self.base = 0       # slot 0 of current frame
+        self.closure = None # running LoxClosure, None at top level
+        self.upvalues = {}  # stack index => open LoxUpvalue
         self.pc = 0
         self.error = ""
 
-    def extend(self, code, data=[]):
+    def extend(self, code, data=[], names=[]):
         self.code.extend(code)
         self.data.extend(data)
+        self.names.extend(names)
 
-    def replace(self, code, data=[]):
+    def replace(self, code, data=[], lines=[], notes={}, names=[]):
         self.code.extend(code[len(self.code):])
         self.data.extend(data[len(self.data):])
+        self.names.extend(names[len(self.names):])
+        self.lines.extend(lines[len(self.lines):])
+        self.notes.update(notes)
 
     def terminated(self):
         if self.error: return True
@@ -59,6 +137,15 @@ class StackVM:
 
     def term(self, msg="user terminated"):
         self.error = msg
+        self.pc = len(self.code)
+
+    def recover(self):
+        'drop all frames after an error, so the next program can run'
+        self.closeUpvalues(0)
+        self.stack.clear()
+        self.frames.clear()
+        self.base, self.closure = 0, None
+        self.pc, self.error = len(self.code), ""
 
     def operand(self, pc):
         end = pc + 2
@@ -66,28 +153,95 @@ class StackVM:
             raise IndexError("operand", pc)
         return int.from_bytes(self.code[pc:end], 'little', signed=True)
 
-    def access(self, op, value=None):
-        '"load" or "save" value at operand'
-        end = self.pc + 2
-        if end > len(self.code):
-            return self.term("{} without operands".format(op))
-        idx = int.from_bytes(self.code[self.pc:end], 'little', signed=True)
-        self.pc = end
-        if op == 'load':
-            if not 0 <= idx < len(self.data): return self.term("wrong address to {}".format(op))
-            self.push(self.data[idx])
-        elif op == 'save':
-            if not 0 <= idx < len(self.data): return self.term("wrong address to {}".format(op))
-            self.data[idx] = self.pop()
-        elif op == 'inst':
-            self.push(idx)
-        elif op == 'jump':
-            self.jump(self.pc + idx)
-        else:   # 'none'
-            pass
+    def decode(self):
+        'decode code appended since last run into (handler, operand, next pc)'
+        enabled = gc.isenabled()
+        gc.disable()    # entries are acyclic, don't let the collector rescan them while growing
+        try:
+            self._decode()
+        finally:
+            if enabled: gc.enable()
+
+    def _decode(self):
+        code, decoded, data, names = self.code, self.decoded, self.data, self.names
+        if decoded: decoded.pop()   # the sentinel
+        else: self.fused = {}
+        pc, end = len(decoded), len(code)
+        start = pc
+        decoded.extend([None] * (end - pc))
+        funcs, operand, jumps, refs, caches = self.Funcs, StackVM.Operand, StackVM.Jumps, StackVM.Refs, StackVM.Caches
+        named = StackVM.Names
+        head, extended = None, None     # pc of the EXTENDED_ARG before pc, and the bits it holds
+        while pc < end:
+            op = code[pc]
+            if op not in operand:
+                entry = (funcs[op][-1], None, pc + 1) if op < StackVM.OPS_COUNT_N else \
+                        (StackVM.opTerm, "unknown operator {}".format(op), pc + 1)
+            elif pc + 3 > end:
+                entry = (StackVM.opTerm, "{} without operands".format(funcs[op][0]), end)
+            else:
+                opd = code[pc+1] | code[pc+2] << 8
+                if extended is not None: opd |= extended << 16
+                elif opd & 0x8000: opd -= 0x10000
+                if op == StackVM.EXTENDED_ARG:     # decoded with the next instruction, see below
+                    decoded[pc] = (StackVM.opTerm, "EXTENDED_ARG without instruction", pc + 3)
+                    if head is None: head = pc
+                    extended = opd
+                    pc += 3
+                    continue
+                if op in jumps:
+                    opd += pc + 3
+                elif op in refs:
+                    opd = data[opd]
+                elif op in named:
+                    opd = names[opd]
+                elif op in caches:
+                    opd = caches[op](names[opd])
+                if (op == StackVM.LOAD or op == StackVM.SAVE) and not 0 <= opd < len(data):
+                    entry = (StackVM.opTerm, "wrong address to {}".format(funcs[op][0]), pc + 3)
+                else:
+                    entry = (funcs[op][-1], opd, pc + 3)
+            decoded[pc] = entry
+            if head is not None:    # the prefixed instruction runs from its prefix on
+                decoded[head] = entry
+                head = extended = None
+            pc = entry[-1]
+        decoded.append((StackVM.opHalt, None, end))
+        if self.quickening: self.quicken(start)
+
+    def quicken(self, start):
+        '''replace the sequences of StackVM.Fusions among the instructions decoded from start by
+        superinstructions; a sequence is fused only if no jump lands inside it'''
+        code, decoded, funcs, fusions = self.code, self.decoded, self.Funcs, StackVM.Fusions
+        pcs, pc, end = [], start, len(code)
+        while pc < end:
+            pcs.append(pc)
+            pc = decoded[pc][-1]
+        ops = [code[pc] for pc in pcs]
+        if StackVM.JMPTO in ops or StackVM.SAVE in ops: return     # hand written code, with targets unknown
+        targets = { d.entry for d in self.data if type(d) is FuncProto }
+        targets.update(decoded[pc][1] for pc, op in zip(pcs, ops) if op in StackVM.Jumps)
+        i = 0
+        while i < len(pcs):
+            for pattern, make in fusions.get(ops[i], ()):
+                n = len(pattern)
+                if tuple(ops[i:i+n]) != pattern or any(pc in targets for pc in pcs[i+1:i+n]): continue
+                parts = [decoded[pc] for pc in pcs[i:i+n]]
+                if any(entry[0] is not funcs[op][-1] for op, entry in zip(pattern, parts)): continue
+                site = Fused('+'.join(funcs[op][0] for op in pattern), pcs[i], parts)
+                fused = make(self, site, [entry[1] for entry in parts])
+                if fused is None: continue
+                decoded[pcs[i]] = (*fused, parts[-1][-1])
+                self.fused[pcs[i]] = site
+                i += n - 1
+                break
+            i += 1
 
-    def jump(self, pc):
-        self.pc = pc
+    def dequicken(self):
+        'turn quickening off, back to the plain instructions'
+        self.quickening = False
+        for pc, site in self.fused.items(): self.decoded[pc] = site.parts[0]
+        self.fused = {}
 
     def push(self, value):
         self.stack.append(value)
@@ -98,33 +252,719 @@ class StackVM:
     def value(self):
         return self.stack[-1] if self.stack else None
 
+    # errors
+    @property
+    def ins(self):
+        'pc of the running instruction, which ends at pc unless it jumped'
+        for pc in (self.pc - 1, self.pc - 3):
+            entry = self.decoded[pc] if pc >= 0 else None
+            if pc in self.fused: entry = self.fused[pc].parts[0]     # replayed, see replay()
+            if entry and entry[-1] == self.pc: return pc
+        return self.pc
+
+    def line(self, pc=None):
+        'source line of instruction at pc'
+        i = bisect_right(self.lines, (self.ins if pc is None else pc, float('inf')))
+        return self.lines[i-1][1] if i else None
+
+    def fail(self, errtype, message):
+        raise errtype(self.line(), message)
+
+    def overflow(self):
+        self.fail(LoxStackOverflow, 'stack overflow: more than {} nested calls'.format(self.maxDepth))
+
+    def undeclared(self):
+        raise Interpreter.errUndeclared(self.notes[self.ins])
+
+    # operators
+    def opNop(s, x):
+        pass
+
+    def opHalt(s, x):
+        raise Halt()
+
+    def opTerm(s, x):
+        s.term(x) if x else s.term()
+
+    def opJmpTo(s, x):
+        s.pc = s.stack.pop()
+
+    def opJmp(s, x):
+        s.pc = x
+
+    def opJz(s, x):
+        v = s.stack.pop()
+        if v is True: return
+        if v is False or not s.truth(v): s.pc = x
+
+    def opJnz(s, x):
+        v = s.stack.pop()
+        if v is False: return
+        if v is True or s.truth(v): s.pc = x
+
+    def truth(self, v):
+        'boolean value of a condition for jumps'
+        v = InterpType.Boolean(v)
+        if v == InterpType.INV:
+            kind = self.notes[self.ins]
+            if kind in ('and', 'or'):
+                self.fail(InterpError, "invalid operand(s) for operator {}".format(kind))
+            self.fail(InterpError, "{} statement requires a boolean condition".format(kind))
+        return v
+
+    def opLoad(s, x):
+        s.stack.append(s.data[x])
+
+    def opSave(s, x):
+        s.data[x] = s.stack.pop()
+
+    def opInst(s, x):
+        s.stack.append(float(x))
+
+    def opDup(s, x):
+        s.stack.append(s.value())
+
+    def opPop(s, x):
+        s.stack.pop()
+
+    def opNot(s, x):
+        v = s.stack[-1]
+        if v is True or v is False: s.stack[-1] = not v
+        else: s.unary(TokenType.BANG)
+
+    def opNegative(s, x):
+        if type(s.stack[-1]) is float: s.stack[-1] = -s.stack[-1]
+        else: s.unary(TokenType.MINUS)
+
+    def unary(self, op):
+        val = self.pop()
+        for tp, fn in Interpreter.UniFns[op]:
+            v = tp(val)
+            if v == InterpType.INV: continue
+            return self.push(fn(v))
+        self.fail(InterpError, "invalid operand(s) for operator {}".format(TokenType.Keys[op.value]))
+
+    def binary(self, op):
+        right, left = self.pop(), self.pop()
+        for tl, tr, fn in Interpreter.BinFns[op]:
+            l, r = tl(left), tr(right)
+            if l == InterpType.INV or r == InterpType.INV: continue
+            try:
+                return self.push(fn(l, r))
+            except Exception as ex:
+                self.fail(RunningError, str(ex))
+        self.fail(InterpError, "invalid operand(s) for operator {}".format(TokenType.Keys[op.value]))
+
+    # fast paths for numbers (and strings for +), others go through binary()
+    def opPlus(s, x):
+        stack = s.stack
+        tp, tl = type(stack[-1]), type(stack[-2])
+        if tp is float and tl is float:
+            r = stack.pop(); stack[-1] += r
+        elif tp is str and (tl is str or tl is StrBuilder):
+            r = stack.pop(); stack[-1] = concat(stack[-1], r)
+        else: s.binary(TokenType.PLUS)
+
+    def opMinus(s, x):
+        stack = s.stack
+        if type(stack[-1]) is float and type(stack[-2]) is float:
+            r = stack.pop(); stack[-1] -= r
+        else: s.binary(TokenType.MINUS)
+
+    def opMultiply(s, x):
+        stack = s.stack
+        if type(stack[-1]) is float and type(stack[-2]) is float:
+            r = stack.pop(); stack[-1] *= r
+        else: s.binary(TokenType.STAR)
+
+    def opDivide(s, x):
+        s.binary(TokenType.SLASH)
+
+    def opEqual(s, x):
+        stack = s.stack
+        r = stack.pop(); stack[-1] = stack[-1] == r
+
+    def opNotEqual(s, x):
+        stack = s.stack
+        r = stack.pop(); stack[-1] = stack[-1] != r
+
+    def opGreater(s, x):
+        stack = s.stack
+        if type(stack[-1]) is float and type(stack[-2]) is float:
+            r = stack.pop(); stack[-1] = stack[-1] > r
+        else: s.binary(TokenType.GREATER)
+
+    def opGreaterEqual(s, x):
+        stack = s.stack
+        if type(stack[-1]) is float and type(stack[-2]) is float:
+            r = stack.pop(); stack[-1] = stack[-1] >= r
+        else: s.binary(TokenType.GREATER_EQUAL)
+
+    def opLess(s, x):
+        stack = s.stack
+        if type(stack[-1]) is float and type(stack[-2]) is float:
+            r = stack.pop(); stack[-1] = stack[-1] < r
+        else: s.binary(TokenType.LESS)
+
+    def opLessEqual(s, x):
+        stack = s.stack
+        if type(stack[-1]) is float and type(stack[-2]) is float:
+            r = stack.pop(); stack[-1] = stack[-1] <= r
+        else: s.binary(TokenType.LESS_EQUAL)
+
+    def opPrint(s, x):
+        print(stringify(s.stack.pop()))
+
+    # variables
+    def opGetLocal(s, x):
+        v = s.stack[s.base + x]
+        if v is UNDEFINED: s.undeclared()
+        s.stack.append(v)
+
+    def opSetLocal(s, x):
+        s.stack[s.base + x] = s.stack.pop()
+
+    def opGetUpvalue(s, x):
+        v = s.closure.upvalues[x].get()
+        if v is UNDEFINED: s.undeclared()
+        s.stack.append(v)
+
+    def opSetUpvalue(s, x):
+        s.closure.upvalues[x].set(s.stack.pop())
+
+    def opGetGlobal(s, x):
+        try:
+            s.stack.append(s.globals[x])
+        except KeyError:
+            s.undeclared()
+
+    def opSetGlobal(s, x):
+        if x not in s.globals: s.undeclared()
+        s.globals[x] = s.stack.pop()
+
+    def opDefGlobal(s, x):
+        if x in s.globals:
+            s.fail(InterpError, "duplicated declaration of var {}".format(x))
+        s.globals[x] = s.stack.pop()
+
+    def opRedefGlobal(s, x):
+        s.globals[x] = s.stack.pop()
+
+    def opReserve(s, x):
+        s.stack.extend([UNDEFINED] * x)
+
+    def opDiscard(s, x):
+        'pop locals of a finished scope'
+        top = len(s.stack) - x
+        if s.upvalues: s.closeUpvalues(top)
+        del s.stack[top:]
+
+    def captureUpvalue(self, index):
+        upvalue = self.upvalues.get(index)
+        if upvalue is None:
+            upvalue = self.upvalues[index] = LoxUpvalue(self.stack, index)
+        return upvalue
+
+    def closeUpvalues(self, top):
+        for index in [i for i in self.upvalues if i >= top]:
+            self.upvalues.pop(index).close()
+
+    # functions
+    def opClosure(s, x):
+        upvalues = [ s.captureUpvalue(s.base + index) if isLocal else s.closure.upvalues[index]
+                     for isLocal, index in x.upvalues ]
+        s.stack.append(LoxClosure(x, upvalues))
+
+    def opCall(s, x):
+        stack = s.stack
+        callee = stack[-x-1]
+        this, ctor = UNDEFINED, False
+        if type(callee) is LoxMethod:
+            this, callee = callee.obj, callee.func
+        elif type(callee) is LoxClass:
+            this, ctor = LoxInstance(callee), True
+            callee = callee.getattr('init')
+        if type(callee) is LoxClosure:
+            proto = callee.proto
+            if x != proto.arity:
+                s.fail(LoxFuncArgc, 'funcion {} takes {} args, got {}'.format(proto.name, proto.arity, x))
+            if len(s.frames) >= s.maxDepth: s.overflow()
+            s.frames.append((s.pc, s.base, s.closure, ctor))
+            s.base = base = len(stack) - x - 1
+            stack[base] = this if proto.method else callee  # slot 0
+            s.closure = callee
+            s.pc = proto.entry
+        elif callable(callee):
+            args = stack[len(stack)-x:]
+            del stack[len(stack)-x-1:]
+            try:
+                rlt = callee(s, args) if this is UNDEFINED else callee(s, args, this=this)
+            except LoxFuncArgc as ex:
+                if not ex.args[0]:  # raised by the callee itself
+                    ex.args = (s.line(), ex.args[1])
+                raise ex
+            stack.append(this if ctor else rlt)
+        else:
+            s.fail(InterpError, "need a callable object before '(', got {}".format(stringify(callee)))
+
+    def opReturn(s, x):
+        stack = s.stack
+        rlt = stack.pop()
+        if s.upvalues: s.closeUpvalues(s.base)
+        s.pc, base, s.closure, ctor = s.frames.pop()
+        if ctor: rlt = stack[s.base]    # the new instance
+        del stack[s.base:]
+        s.base = base
+        stack.append(rlt)
+
+    # classes
+    def opInherit(s, x):
+        parent = s.stack.pop()
+        if parent is None: parent = LoxClass.Object
+        if not isinstance(parent, LoxClass):
+            s.fail(InterpError, "can not inherit from {}".format(stringify(parent)))
+        s.stack.append(parent)  # as local var 'super'
+
+    def opClass(s, x):
+        stack, n = s.stack, len(x.methods)
+        methods = dict(zip(x.methods, stack[len(stack)-n:]))
+        del stack[len(stack)-n:]
+        stack.append(LoxClass(x.name, stack[-1], methods, x.line))
+
+    def opSuper(s, x):
+        'a bare super: this, which is local slot 0 (x == 0) or upvalue x-1, seen from its parent class'
+        parent = s.stack.pop()
+        this = s.stack[s.base] if x == 0 else s.closure.upvalues[x-1].get()
+        s.stack.append(parent if this is UNDEFINED else this.super(parent))    # class method
+
+    def opGetAttr(s, x):
+        stack = s.stack
+        obj = stack[-1]
+        if type(obj) is LoxInstance:
+            shape = obj.shape
+            if shape is not x.shape:
+                i = shape.fields.get(x.name)
+                if i is None: return s.getAttr(x.name)
+                x.shape, x.index = shape, i
+            stack[-1] = obj.values[x.index]
+        else:
+            s.getAttr(x.name)
+
+    def getAttr(s, x):
+        'obj => obj.x, of any gettable object'
+        object = s.stack.pop()
+        getter = getattr(object, 'getattr', None)
+        if not getter:
+            s.fail(InterpError, "left of operator '.' should be a gettable object")
+        try:
+            s.stack.append(getter(x))
+        except KeyError:
+            s.fail(InterpError, "{} doesn't have attr '{}'".format(object, x))
+
+    def opSetAttr(s, x):
+        stack = s.stack
+        obj = stack[-2]
+        if type(obj) is not LoxInstance: return s.setAttr(x.name)
+        value = stack.pop()
+        shape = obj.shape
+        if shape is not x.shape:
+            obj.setattr(x.name, value)
+            x.shape, x.index, x.next = shape, obj.shape.fields[x.name], obj.shape
+        elif x.index < len(obj.values):
+            obj.values[x.index] = value
+        else:   # a new field
+            obj.values.append(value)
+            obj.shape = x.next
+        stack[-1] = value
+
+    def setAttr(s, x):
+        'obj, value => value, set obj.x of any settable object'
+        value, object = s.stack.pop(), s.stack.pop()
+        setter = getattr(object, 'setattr', None)
+        if not setter:
+            s.fail(InterpError, "left of operator '.' should be a settable object")
+        setter(x, value)
+        s.stack.append(value)
+
+    def opGetMethod(s, x):
+        '''obj => obj, method: if x.name is a method (closure) of instance obj, called by CALL_METHOD
+        with obj as this; otherwise => attribute, None, called by CALL_METHOD as CALL does'''
+        stack = s.stack
+        obj = stack[-1]
+        if type(obj) is LoxInstance and x.name not in obj.shape.fields:   # fields shadow methods
+            cls = obj.cls
+            if cls is not x.cls:    # the method table of a class never changes
+                x.cls, x.method = cls, cls.table.get(x.name)
+            if type(x.method) is LoxClosure:
+                return stack.append(x.method)
+        s.getAttr(x.name)
+        stack.append(None)
+
+    def opSuperMethod(s, x):
+        '''parent => this, method: if x.name is a method (closure) of the parent class, called by CALL_METHOD
+        on this of the running method, found as by SUPER; otherwise => super.name, None, as GET_METHOD does'''
+        stack = s.stack
+        parent = stack[-1]
+        this = stack[s.base] if x.where == 0 else s.closure.upvalues[x.where-1].get()
+        if type(this) is LoxInstance and x.name not in this.shape.fields:
+            if parent is not x.cls:
+                x.cls, x.method = parent, parent.table.get(x.name)
+            if type(x.method) is LoxClosure:
+                stack[-1] = this
+                return stack.append(x.method)
+        s.superAttr(x.name, this)
+        stack.append(None)
+
+    def opGetSuper(s, x):
+        'parent => super.name: a field of this, or the method of the parent class bound to this'
+        stack = s.stack
+        this = stack[s.base] if x.where == 0 else s.closure.upvalues[x.where-1].get()
+        if type(this) is LoxInstance:
+            i = this.shape.fields.get(x.name)
+            if i is not None:
+                stack[-1] = this.values[i]
+                return
+            parent = stack[-1]
+            if parent is not x.cls:
+                x.cls, x.method = parent, parent.table.get(x.name)
+            if x.method:
+                stack[-1] = LoxMethod(this, x.method)
+                return
+        s.superAttr(x.name, this)
+
+    def superAttr(s, x, this):
+        'parent => super.x, without a LoxSuper; the attribute of the parent class in a class method'
+        if this is UNDEFINED: return s.getAttr(x)
+        parent = s.stack.pop()
+        try:
+            s.stack.append(this.superattr(parent, x))
+        except KeyError:
+            s.fail(InterpError, "{} doesn't have attr '{}'".format(this.super(parent), x))
+
+    def opSetSuper(s, x):
+        'parent, value => value, set super.name: the field of this, or of the parent class in a class method'
+        this = s.stack[s.base] if x.where == 0 else s.closure.upvalues[x.where-1].get()
+        if this is not UNDEFINED: s.stack[-2] = this
+        s.setAttr(x.name)
+
+    def opCallMethod(s, x):
+        stack = s.stack
+        callee = stack[-x-1]
+        if callee is None:  # not a method, see opGetMethod
+            del stack[-x-1]
+            return s.opCall(x)
+        proto = callee.proto
+        if x != proto.arity:
+            s.fail(LoxFuncArgc, 'funcion {} takes {} args, got {}'.format(proto.name, proto.arity, x))
+        if len(s.frames) >= s.maxDepth: s.overflow()
+        s.frames.append((s.pc, s.base, s.closure, False))
+        s.base = base = len(stack) - x - 2
+        del stack[base + 1]     # the method, this is slot 0
+        s.closure = callee
+        s.pc = proto.entry
+
+    # tail calls: return f(...) runs f in the frame of the returning function, followed by a RETURN
+    # run only when it falls back to CALL: a builtin or class callee, at top level, or in an init,
+    # whose frame must return the new instance
+    def opTailCall(s, x):
+        stack, frames = s.stack, s.frames
+        callee = stack[-x-1]
+        this = UNDEFINED
+        if type(callee) is LoxMethod:
+            this, callee = callee.obj, callee.func
+        if type(callee) is not LoxClosure or not frames or frames[-1][3]:
+            return s.opCall(x)
+        proto = callee.proto
+        if x != proto.arity:
+            s.fail(LoxFuncArgc, 'funcion {} takes {} args, got {}'.format(proto.name, proto.arity, x))
+        s.reuseFrame(this if proto.method else callee, callee, x)
+
+    def opTailCallMethod(s, x):
+        stack, frames = s.stack, s.frames
+        callee = stack[-x-1]
+        if callee is None:  # not a method, see opGetMethod
+            del stack[-x-1]
+            return s.opTailCall(x)
+        if not frames or frames[-1][3]:
+            return s.opCallMethod(x)
+        proto = callee.proto
+        if x != proto.arity:
+            s.fail(LoxFuncArgc, 'funcion {} takes {} args, got {}'.format(proto.name, proto.arity, x))
+        s.reuseFrame(stack[-x-2], callee, x)
+
+    def reuseFrame(s, slot0, callee, x):
+        'run closure callee in the running frame, with slot0 and the x arguments on stack top'
+        stack, base = s.stack, s.base
+        if s.upvalues: s.closeUpvalues(base)
+        stack[base+1:] = stack[len(stack)-x:]
+        stack[base] = slot0
+        s.closure = callee
+        s.pc = callee.proto.entry
+
+    def opAssert(s, x):
+        s.fail(AssertError, x)
+
+    # superinstructions, see quicken(): x is (operands..., Fused site); numbers are guessed to be floats
+    def replay(s, site):
+        'run the plain instructions of superinstruction site, as loop() would'
+        for fn, opd, s.pc in site.parts: fn(s, opd)
+
+    def deopt(s, site):
+        'the guess of superinstruction site failed: run its plain instructions, now and from now on'
+        s.decoded[site.pc] = site.parts[0]
+        del s.fused[site.pc]
+        s.replay(site)
+
+    def opLocalConstCompareJz(s, x):
+        'GET_LOCAL a; LOAD k; LESS (or another comparison); JZ t'
+        slot, k, compare, target, site = x
+        v = s.stack[s.base + slot]
+        if type(v) is not float: return s.deopt(site)
+        if not compare(v, k): s.pc = target
+
+    def opLocal2CompareJz(s, x):
+        'GET_LOCAL a; GET_LOCAL b; LESS (or another comparison); JZ t'
+        a, b, compare, target, site = x
+        stack, base = s.stack, s.base
+        u, v = stack[base + a], stack[base + b]
+        if type(u) is not float or type(v) is not float: return s.deopt(site)
+        if not compare(u, v): s.pc = target
+
+    def opCompareJz(s, x):
+        'LESS (or another comparison); JZ t'
+        compare, target, site = x
+        stack = s.stack
+        l, r = stack[-2], stack[-1]
+        if type(l) is not float or type(r) is not float: return s.deopt(site)
+        del stack[-2:]
+        if not compare(l, r): s.pc = target
+
+    # the same with JNZ t, as Peephole inverts a JZ over a JMP
+    def opLocalConstCompareJnz(s, x):
+        slot, k, compare, target, site = x
+        v = s.stack[s.base + slot]
+        if type(v) is not float: return s.deopt(site)
+        if compare(v, k): s.pc = target
+
+    def opLocal2CompareJnz(s, x):
+        a, b, compare, target, site = x
+        stack, base = s.stack, s.base
+        u, v = stack[base + a], stack[base + b]
+        if type(u) is not float or type(v) is not float: return s.deopt(site)
+        if compare(u, v): s.pc = target
+
+    def opCompareJnz(s, x):
+        compare, target, site = x
+        stack = s.stack
+        l, r = stack[-2], stack[-1]
+        if type(l) is not float or type(r) is not float: return s.deopt(site)
+        del stack[-2:]
+        if compare(l, r): s.pc = target
+
+    def opLocalConstBinary(s, x):
+        'GET_LOCAL a; LOAD k; PLUS (or another arithmetic or comparison)'
+        slot, k, binary, site = x
+        v = s.stack[s.base + slot]
+        if type(v) is not float: return s.deopt(site)
+        s.stack.append(binary(v, k))
+
+    def opLocal2Binary(s, x):
+        'GET_LOCAL a; GET_LOCAL b; PLUS (or another arithmetic or comparison)'
+        a, b, binary, site = x
+        stack, base = s.stack, s.base
+        u, v = stack[base + a], stack[base + b]
+        if type(u) is not float or type(v) is not float: return s.deopt(site)
+        stack.append(binary(u, v))
+
+    def opConstBinary(s, x):
+        'LOAD k; PLUS (or another arithmetic or comparison)'
+        k, binary, site = x
+        stack = s.stack
+        if type(stack[-1]) is not float: return s.deopt(site)
+        stack[-1] = binary(stack[-1], k)
+
+    def opGetLocal2(s, x):
+        'GET_LOCAL a; GET_LOCAL b'
+        a, b, site = x
+        stack, base = s.stack, s.base
+        u, v = stack[base + a], stack[base + b]
+        if u is UNDEFINED or v is UNDEFINED: return s.replay(site)
+        stack.append(u)
+        stack.append(v)
+
+    def opGetLocalLoad(s, x):
+        'GET_LOCAL a; LOAD k'
+        slot, k, site = x
+        v = s.stack[s.base + slot]
+        if v is UNDEFINED: return s.replay(site)
+        s.stack.append(v)
+        s.stack.append(k)
+
+    def opGetLocalAttr(s, x):
+        'GET_LOCAL a; GET_ATTR, hit in the cache of GET_ATTR'
+        slot, cache, site = x
+        obj = s.stack[s.base + slot]
+        if type(obj) is not LoxInstance or obj.shape is not cache.shape: return s.replay(site)
+        s.stack.append(obj.values[cache.index])
+
+    def opSetAttrPop(s, x):
+        'SET_ATTR; POP, hit in the cache of SET_ATTR on a field set before'
+        cache, site = x
+        stack = s.stack
+        obj = stack[-2]
+        if type(obj) is not LoxInstance or obj.shape is not cache.shape or cache.index >= len(obj.values):
+            return s.replay(site)
+        obj.values[cache.index] = stack.pop()
+        stack.pop()
+
+    def opSetGlobalPop(s, x):
+        'DUP; SET_GLOBAL; POP'
+        name, site = x
+        if name not in s.globals: return s.replay(site)
+        s.globals[name] = s.stack.pop()
+
+    # handlers, called with the decoded operand
+    Funcs = [
+        ('NOP', opNop),
+        ('JMPTO', opJmpTo),
+        ('JMP', opJmp),
+        ('JZ', opJz),
+        ('JNZ', opJnz),
+        ('LOAD', opLoad),
+        ('SAVE', opSave),
+        ('INST', opInst),
+        ('DUP', opDup),
+        ('POP', opPop),
+        ('NOT', opNot),
+        ('NEGATIVE', opNegative),
+        ('PLUS', opPlus),
+        ('MINUS', opMinus),
+        ('MULTIPLY', opMultiply),
+        ('DIVIDE', opDivide),
+        ('EQUAL', opEqual),
+        ('NOT_EQUAL', opNotEqual),
+        ('GREATER', opGreater),
+        ('GREATER_EQUAL', opGreaterEqual),
+        ('LESS', opLess),
+        ('LESS_EQUAL', opLessEqual),
+        ('PRINT', opPrint),
+        ('TERM', opTerm),
+        ('GET_LOCAL', opGetLocal),
+        ('SET_LOCAL', opSetLocal),
+        ('GET_UPVALUE', opGetUpvalue),
+        ('SET_UPVALUE', opSetUpvalue),
+        ('GET_GLOBAL', opGetGlobal),
+        ('SET_GLOBAL', opSetGlobal),
+        ('DEF_GLOBAL', opDefGlobal),
+        ('REDEF_GLOBAL', opRedefGlobal),
+        ('RESERVE', opReserve),
+        ('DISCARD', opDiscard),
+        ('CLOSURE', opClosure),
+        ('CALL', opCall),
+        ('RETURN', opReturn),
+        ('INHERIT', opInherit),
+        ('CLASS', opClass),
+        ('GET_ATTR', opGetAttr),
+        ('SET_ATTR', opSetAttr),
+        ('SUPER', opSuper),
+        ('ASSERT', opAssert),
+        ('GET_METHOD', opGetMethod),
+        ('CALL_METHOD', opCallMethod),
+        ('SUPER_METHOD', opSuperMethod),
+        ('TAIL_CALL', opTailCall),
+        ('TAIL_CALL_METHOD', opTailCallMethod),
+        ('EXTENDED_ARG', opNop),    # merged into the next instruction by decoding
+        ('GET_SUPER', opGetSuper),
+        ('SET_SUPER', opSetSuper),
+    ]
+    JumpFuncs = { opJmp, opJz, opJnz }
+
     def runOnce(self):
         if self.terminated():
             return False
-        op = self.code[self.pc]
-        self.pc += 1
-        StackVM.Funcs[op][-1](self)
+        fn, opd, self.pc = self.decoded[self.pc]
+        fn(self, opd)
         return True
 
-    def run(self, debug=False):
-        while True:
-            if debug: self.printOnce(self.pc)
-            if not self.runOnce(): break
+    def loop(self):
+        'the fast path of run()'
+        decoded = self.decoded
+        pc = self.pc
+        try:
+            while True:
+                fn, opd, self.pc = decoded[pc]
+                fn(self, opd)
+                pc = self.pc
+        except Halt:
+            pass
+
+    def loopStats(self, stats):
+        'loop() counting the executions of each pc, and the taken backward jumps, into stats'
+        decoded, counts, backJumps, jumps = self.decoded, stats.counts, stats.backJumps, StackVM.JumpFuncs
+        counts.extend([0] * (len(decoded) - len(counts)))
+        pc = self.pc
+        try:
+            while True:
+                fn, opd, self.pc = decoded[pc]
+                counts[pc] += 1
+                fn(self, opd)
+                if self.pc <= pc and fn in jumps:
+                    edge = pc, self.pc
+                    backJumps[edge] = backJumps.get(edge, 0) + 1
+                pc = self.pc
+        except Halt:
+            counts[pc] -= 1     # the sentinel, replaced by the code appended next
 
-    def printOnce(self, pc):
+    def run(self, debug=False, stats=None):
+        '''run to the end of code, returns the value left by the program
+        debug: print each instruction; stats: a VMStats counting the executions'''
+        self.decode()
+        try:
+            if stats is not None:
+                self.loopStats(stats)
+            elif not debug:
+                self.loop()
+            else:
+                while True:
+                    self.printOnce(self.pc)
+                    if not self.runOnce(): break
+        except LoxError:
+            self.recover()
+            raise
+        rlt = self.stack[-1] if self.stack else None
+        self.recover()
+        return rlt
+
+    def printOnce(self, pc, indent='', extended=None):
+        '''print the instruction at pc, a superinstruction with its plain ones; returns the next pc
+        extended: higher bits of the operand, from the EXTENDED_ARG before pc'''
         if not 0 <= pc < len(self.code): return pc
+        site = self.fused.get(pc) if not indent else None
+        if site:
+            print('%04d' % pc, site.name, sep='\t')
+            for entry in site.parts: pc = self.printOnce(pc, indent='  ')
+            return pc
         op = self.code[pc]
-        contents = [ '%04d' % pc, StackVM.Funcs[op][0] ]
+        contents = [ indent + '%04d' % pc, StackVM.Funcs[op][0] ]
         pc += 1
-        if op in (StackVM.JMP, StackVM.JZ, StackVM.JNZ, StackVM.LOAD, StackVM.SAVE, StackVM.INST):
+        if op in StackVM.Operand:
             opd = self.operand(pc)
+            if extended is not None: opd = extended << 16 | opd & 0xffff
             pc += 2
-            if op in (StackVM.JMP, StackVM.JZ, StackVM.JNZ):
+            if op == StackVM.EXTENDED_ARG:
+                print(indent + '%04d' % (pc - 3), StackVM.Funcs[op][0], '%d' % opd, sep='\t')
+                return self.printOnce(pc, indent, extended=opd)
+            if op in StackVM.Jumps:
                 contents.append('%+d(=%04d)' % (opd, pc + opd))
-            elif op in (StackVM.LOAD, StackVM.SAVE):
+            elif op in (StackVM.INST, StackVM.RESERVE, StackVM.DISCARD, StackVM.CALL, StackVM.CALL_METHOD, StackVM.SUPER):
+                contents.append('%d' % opd)
+            elif op in (StackVM.GET_LOCAL, StackVM.SET_LOCAL, StackVM.GET_UPVALUE, StackVM.SET_UPVALUE):
+                note = self.notes.get(pc - 3)
+                contents.append('%d(%s)' % (opd, note.lexeme) if note else '%d' % opd)
+            elif op in StackVM.Names or op in StackVM.Caches:
+                contents.append('@%d(%s)' % (opd, repr(self.names[opd])))
+            else:
                 contents.append('#%d(%s)' % (opd, repr(self.data[opd])))
-            else: # if op in (StackVM.INST,):
-                contents.append('%d(0x%x)' % (opd, opd))
         print(*contents, sep='\t')
         return pc
 
@@ -136,9 +976,164 @@ class StackVM:
         print('.DATA')
         for i, d in enumerate(self.data):
             print('%04d' % i, d, sep='\t')
+        print('.NAMES')
+        for i, name in enumerate(self.names):
+            print('%04d' % i, name, sep='\t')
 
 assert(len(StackVM.Funcs) == StackVM.OPS_COUNT_N)
 
+def fusions():
+    '''StackVM.Fusions: first opcode => [(opcodes, make)], longer first; make(m, site, operands) returns
+    (handler, operand) of the superinstruction for the StackVM m, or None if it does not apply'''
+    vm = StackVM
+    compares = { vm.LESS : operator.lt, vm.LESS_EQUAL : operator.le, vm.GREATER : operator.gt, vm.GREATER_EQUAL : operator.ge }
+    binaries = { vm.PLUS : operator.add, vm.MINUS : operator.sub, vm.MULTIPLY : operator.mul,
+                 vm.EQUAL : operator.eq, vm.NOT_EQUAL : operator.ne, **compares }
+    def number(m, k):
+        return type(m.data[k]) is float
+    table = []
+    jumps = { vm.JZ : (vm.opLocalConstCompareJz, vm.opLocal2CompareJz, vm.opCompareJz),
+              vm.JNZ : (vm.opLocalConstCompareJnz, vm.opLocal2CompareJnz, vm.opCompareJnz) }
+    for jump, (localConst, local2, compare) in jumps.items():
+        for op, fn in compares.items():
+            table.append(((vm.GET_LOCAL, vm.LOAD, op, jump), lambda m, site, x, fn=fn, handler=localConst:
+                          (handler, (x[0], m.data[x[1]], fn, x[3], site)) if number(m, x[1]) else None))
+            table.append(((vm.GET_LOCAL, vm.GET_LOCAL, op, jump), lambda m, site, x, fn=fn, handler=local2:
+                          (handler, (x[0], x[1], fn, x[3], site))))
+            table.append(((op, jump), lambda m, site, x, fn=fn, handler=compare: (handler, (fn, x[1], site))))
+    for op, fn in binaries.items():
+        table.append(((vm.GET_LOCAL, vm.LOAD, op), lambda m, site, x, fn=fn:
+                      (vm.opLocalConstBinary, (x[0], m.data[x[1]], fn, site)) if number(m, x[1]) else None))
+        table.append(((vm.GET_LOCAL, vm.GET_LOCAL, op), lambda m, site, x, fn=fn:
+                      (vm.opLocal2Binary, (x[0], x[1], fn, site))))
+    for op, fn in binaries.items():
+        table.append(((vm.LOAD, op), lambda m, site, x, fn=fn:
+                      (vm.opConstBinary, (m.data[x[0]], fn, site)) if number(m, x[0]) else None))
+    table += [
+        ((vm.DUP, vm.SET_LOCAL, vm.POP), lambda m, site, x: (vm.opSetLocal, x[1])),
+        ((vm.DUP, vm.SET_UPVALUE, vm.POP), lambda m, site, x: (vm.opSetUpvalue, x[1])),
+        ((vm.DUP, vm.SET_GLOBAL, vm.POP), lambda m, site, x: (vm.opSetGlobalPop, (x[1], site))),
+        ((vm.SET_ATTR, vm.POP), lambda m, site, x: (vm.opSetAttrPop, (x[0], site))),
+        ((vm.GET_LOCAL, vm.GET_ATTR), lambda m, site, x: (vm.opGetLocalAttr, (x[0], x[1], site))),
+        ((vm.GET_LOCAL, vm.GET_LOCAL), lambda m, site, x: (vm.opGetLocal2, (x[0], x[1], site))),
+        ((vm.GET_LOCAL, vm.LOAD), lambda m, site, x: (vm.opGetLocalLoad, (x[0], m.data[x[1]], site))),
+    ]
+    byFirst = {}
+    for pattern, make in sorted(table, key=lambda fusion: -len(fusion[0])):
+        byFirst.setdefault(pattern[0], []).append((pattern, make))
+    return byFirst
+StackVM.Fusions = fusions()
+
+class VMStats:
+    '''executions per opcode and per pc of the runs of vm with stats, loop headers
+    (targets of backward jumps) with their trip counts, and the hottest basic blocks'''
+    def __init__(self, vm):
+        self.vm = vm
+        vm.dequicken()      # the plain instructions are counted
+        self.counts = []    # pc => executions
+        self.backJumps = {} # (pc of jump, target) => times taken
+
+    def instructions(self):
+        'pcs of the instructions in code order'
+        pc, decoded, end = 0, self.vm.decoded, len(self.vm.code)
+        while pc < end:
+            yield pc
+            pc = decoded[pc][-1]
+
+    def count(self, pc):
+        return self.counts[pc] if pc < len(self.counts) else 0
+
+    def opcode(self, pc):
+        'opcode of the instruction at pc, past its EXTENDED_ARG prefixes'
+        code = self.vm.code
+        while code[pc] == StackVM.EXTENDED_ARG and pc + 3 < len(code): pc += 3
+        return code[pc]
+
+    def opcodes(self):
+        'opcode name => executions, most executed first'
+        counts = [0] * StackVM.OPS_COUNT_N
+        for pc in self.instructions():
+            op = self.opcode(pc)
+            if op < StackVM.OPS_COUNT_N: counts[op] += self.count(pc)
+        return { StackVM.Funcs[op][0] : n for n, op in sorted(((n, op) for op, n in enumerate(counts) if n), reverse=True) }
+
+    def blocks(self):
+        '''basic blocks [(start pc, [pcs])]: a block starts at pc 0, a function entry,
+        a jump target or after a jump or return, and runs through'''
+        vm, starts = self.vm, {0}
+        starts.update(d.entry for d in vm.data if type(d) is FuncProto)
+        for pc in self.instructions():
+            op, (fn, opd, next) = self.opcode(pc), vm.decoded[pc]
+            if op in StackVM.Jumps: starts.update((opd, next))
+            elif op in (StackVM.JMPTO, StackVM.RETURN, StackVM.TERM): starts.add(next)
+        blocks = []
+        for pc in self.instructions():
+            if pc in starts or not blocks: blocks.append((pc, []))
+            blocks[-1][1].append(pc)
+        return blocks
+
+    def hotBlocks(self):
+        '[(instructions executed, entries, start pc, [pcs])] of the executed blocks, hottest first'
+        hot = [(sum(self.count(pc) for pc in pcs), self.count(start), start, pcs) for start, pcs in self.blocks()]
+        return sorted((b for b in hot if b[0]), key=lambda b: (-b[0], b[2]))
+
+    def pairs(self):
+        '(opcode name, next opcode name) => executions, of successive instructions inside blocks'
+        names, pairs = StackVM.Funcs, {}
+        for start, pcs in self.blocks():
+            for a, b in zip(pcs, pcs[1:]):
+                n, a, b = self.count(b), self.opcode(a), self.opcode(b)
+                if n and a < StackVM.OPS_COUNT_N and b < StackVM.OPS_COUNT_N:
+                    pair = names[a][0], names[b][0]
+                    pairs[pair] = pairs.get(pair, 0) + n
+        return dict(sorted(pairs.items(), key=lambda item: -item[1]))
+
+    def loops(self):
+        '[(header pc, trips, [pcs of the backward jumps])], most trips first'
+        loops = {}
+        for (pc, target), n in self.backJumps.items():
+            loop = loops.setdefault(target, [target, 0, []])
+            loop[1] += n
+            loop[2].append(pc)
+        return sorted((tuple(loop) for loop in loops.values()), key=lambda loop: (-loop[1], loop[0]))
+
+    def asdict(self, limit=None):
+        'the stats as JSON serializable data, limit: number of blocks'
+        vm = self.vm
+        return {
+            'instructions' : sum(self.counts),
+            'opcodes' : self.opcodes(),
+            'pairs' : [ [a, b, n] for (a, b), n in self.pairs().items() ],
+            'pcs' : [ [pc, self.count(pc)] for pc in self.instructions() if self.count(pc) ],
+            'loops' : [ { 'header' : pc, 'line' : vm.line(pc), 'trips' : trips, 'back_jumps' : sorted(jumps) }
+                        for pc, trips, jumps in self.loops() ],
+            'blocks' : [ { 'start' : start, 'end' : vm.decoded[pcs[-1]][-1], 'line' : vm.line(start),
+                           'entries' : entries, 'executed' : executed }
+                         for executed, entries, start, pcs in self.hotBlocks()[:limit] ],
+        }
+
+    def report(self, file=None, limit=10):
+        'print the most executed opcodes and pairs, the loops and the disassembly of the hottest blocks'
+        file, vm = file or sys.stderr, self.vm
+        total = sum(self.counts) or 1
+        print('{} instructions executed'.format(sum(self.counts)), file=file)
+        print('\nopcodes:', file=file)
+        for name, n in list(self.opcodes().items())[:limit]:
+            print('{:>12d} {:5.1f}%  {}'.format(n, 100 * n / total, name), file=file)
+        print('\npairs:', file=file)
+        for (a, b), n in list(self.pairs().items())[:limit]:
+            print('{:>12d} {:5.1f}%  {} {}'.format(n, 100 * n / total, a, b), file=file)
+        print('\nloops:', file=file)
+        for pc, trips, jumps in self.loops()[:limit]:
+            print('{:>12d} trips  header {:04d} [line {}]'.format(trips, pc, vm.line(pc)), file=file)
+        print('\nhottest blocks:', file=file)
+        with redirect_stdout(file):
+            for executed, entries, start, pcs in self.hotBlocks()[:limit]:
+                print('{:5.1f}% entered {} times [line {}]'.format(100 * executed / total, entries, vm.line(start)))
+                for pc in pcs:
+                    print('{:>12d}'.format(self.count(pc)), end='\t')
+                    vm.printOnce(pc)
+
 if __name__ == "__main__":
     vm = StackVM([StackVM.INST, 3, 0,
                   StackVM.INST, 2, 0,
@@ -159,7 +1154,7 @@ if __name__ == "__main__":
                   StackVM.PRINT,
                   # terminate
                   StackVM.TERM,
-                  ], [3, 2, 5, 0, 'true', 'false'])
+                  ], [3., 2., 5., 0., 'true', 'false'])
     print("Disassemble:")
     vm.print()
     print("Running:")
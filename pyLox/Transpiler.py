@@ -0,0 +1,761 @@
+'''Transpiler: translate the resolved AST into python source, compiled by compile() into one code
+object. Lox functions become python functions, Lox variables python variables, and an operator the
+python operator behind a type test, so code on numbers runs as the same python would; what fails
+the test goes through the helpers below, which do what the Interpreter does.'''
+
+import re, math, marshal
+from importlib.util import MAGIC_NUMBER
+from contextlib import contextmanager
+from io import StringIO
+import Expr
+from Scanner import *
+from LoxError import *
+from Functions import *
+from Resolver import Resolver
+from Environment import Cell, UNDEFINED
+from Interpreter import Interpreter, InterpType, lineOf, isSuper
+from AstPrinter import LispPrinter
+from Compiler import writeAtomic
+
+
+class PyFunc:
+    'a Lox function transpiled into the python function fn, which takes the arguments'
+    typename = 'LoxFunc'
+    __slots__ = ('name', 'fn', 'arity', 'line')
+    def __init__(self, name, fn, arity, line):
+        self.name, self.fn, self.arity, self.line = name, fn, arity, line
+    def __str__(self):
+        return '<function {}>'.format(self.name)
+    def __call__(self, interp, args, this=UNDEFINED):
+        if len(args) != self.arity:
+            checkArity(self.name, self.arity, args)
+        return self.fn(*args)
+
+class PyMethod(PyFunc):
+    'a method, fn takes this before the arguments, UNDEFINED if called on the class'
+    __slots__ = ()
+    def __call__(self, interp, args, this=UNDEFINED):
+        if len(args) != self.arity:
+            checkArity(self.name, self.arity, args)
+        return self.fn(this, *args)
+
+# helpers of the transpiled code, for what its inline paths don't do
+def binary(op, left, right, line):
+    'left op right, as Interpreter.visitBinaryExpr computes it'
+    for tl, tr, fn in Interpreter.BinFns[TokenType.KeyMap[op]]:
+        l, r = tl(left), tr(right)
+        if l == InterpType.INV or r == InterpType.INV: continue
+        try:
+            return fn(l, r)
+        except Exception as ex:
+            raise RunningError(line, str(ex))
+    raise InterpError(line, "invalid operand(s) for operator {}".format(op))
+
+def plus(left, right, line):
+    'left + right, two strings are concatenated without the generic path'
+    if (type(left) is str or type(left) is StrBuilder) and type(right) is str:
+        return concat(left, right)
+    return binary('+', left, right, line)
+
+def unary(op, value, line):
+    for tp, fn in Interpreter.UniFns[TokenType.KeyMap[op]]:
+        v = tp(value)
+        if v == InterpType.INV: continue
+        return fn(v)
+    raise InterpError(line, "invalid operand(s) for operator {}".format(op))
+
+def truth(value, line, message):
+    'value as a condition, which is not a boolean: nil is false, a number is true unless 0'
+    v = InterpType.Boolean(value)
+    if v == InterpType.INV: raise InterpError(line, message)
+    return v
+
+def getAttr(obj, name, line):
+    'obj.name, as Interpreter._visitGetAttribExpr gets it'
+    if type(obj) is LoxInstance:
+        i = obj.shape.fields.get(name)
+        if i is not None: return obj.values[i]
+        fn = obj.cls.table.get(name)
+        if fn is not None: return LoxMethod(obj, fn)
+    getter = getattr(obj, 'getattr', None)
+    if not getter:
+        raise InterpError(line, "left of operator '.' should be a gettable object")
+    try:
+        return getter(name)
+    except KeyError:
+        raise InterpError(line, "{} doesn't have attr '{}'".format(obj, name)) from None
+
+def settable(obj, line):
+    if not hasattr(obj, 'setattr'):
+        raise InterpError(line, "left of operator '.' should be a settable object")
+    return obj
+
+def checkCallable(callee, line):
+    if not callable(callee):
+        raise InterpError(line, "need a callable object before '(', got {}".format(stringify(callee)))
+    return callee
+
+def method(obj, name, dot, paren):
+    '''the callee of obj.name(...): the PyMethod called with obj as this, or (the value of obj.name,)
+    called as it is; looked up before the arguments are evaluated, as Interpreter.visitCallExpr does'''
+    if type(obj) is LoxInstance and name not in obj.shape.fields:
+        fn = obj.cls.table.get(name)
+        if type(fn) is PyMethod: return fn
+    return (checkCallable(getAttr(obj, name, dot), paren),)
+
+def superMethod(this, parent, name, dot, paren):
+    'the callee of super.name(...), as method(): this is UNDEFINED in a class method'
+    if type(this) is LoxInstance and name not in this.shape.fields:
+        fn = parent.table.get(name)
+        if type(fn) is PyMethod: return fn
+    return (checkCallable(superAttr(this, parent, name, dot), paren),)
+
+def superAttr(this, parent, name, line):
+    'super.name without a LoxSuper: the attribute of the parent class in a class method'
+    if this is UNDEFINED: return getAttr(parent, name, line)
+    try:
+        return this.superattr(parent, name)
+    except KeyError:
+        raise InterpError(line, "{} doesn't have attr '{}'".format(this.super(parent), name)) from None
+
+def superOf(parent, this):
+    'a bare super: the parent class in a class method'
+    return parent if this is UNDEFINED else this.super(parent)
+
+def setCell(cell, value):
+    cell.value = value
+
+def undeclared(name, line):
+    raise Interpreter.errUndeclared(Token(TokenType.KeyMap.get(name, TokenType.IDENTIFIER), name, None, line))
+
+def duplicated(name, line):
+    raise InterpError(line, "duplicated declaration of var {}".format(name))
+
+def flow(keyword, line):
+    'a break or continue in a function, out of the loops of its caller'
+    raise LoxFlowCtrl(Token(TokenType.KeyMap[keyword], keyword, None, line))
+
+def unmangle(name):
+    'Lox name of a python name of the transpiled code'
+    return re.sub(r'_\d*$', '', name)
+
+
+class Var:
+    '''a local variable of the program: py is its python name; cell: shared with closures in a Cell;
+    checked: declared under a condition, it is UNDEFINED until it is, and read with a test, as this is'''
+    __slots__ = ('py', 'cell', 'checked', 'param')
+    def __init__(self, py, cell, param=False):
+        self.py, self.cell, self.checked, self.param = py, cell, False, param
+
+class Scope:
+    '''the Vars of a local scope by slot, made when the scope is entered: in out at index at'''
+    def __init__(self, cells, out, indent):
+        self.vars, self.cells = {}, set(cells)
+        self.out, self.at, self.indent = out, len(out), indent
+
+class Function:
+    '''a python function being written: captures are the Vars of its closure, by index;
+    globals: the globals it assigns; loops: (iteration, number of scopes) of the loops it is in'''
+    def __init__(self, captures=(), module=False):
+        self.scopes, self.captures, self.module = [], list(captures), module
+        self.globals, self.loops, self.temps = set(), [], 0
+
+class Py:
+    '''python expression of a Lox expression: kind is float, bool or str if its value always is one;
+    simple if it can be written again to read the value again; assigns: it assigns variables'''
+    __slots__ = ('src', 'kind', 'simple', 'literal', 'assigns')
+    def __init__(self, src, kind=None, simple=False, literal=False, parts=()):
+        self.src, self.kind, self.simple, self.literal = src, kind, simple, literal
+        self.assigns = any(p.assigns for p in parts)
+
+
+class Transpiler(Expr.Visitor):
+    VERSION = 2     # of the generated code, see loadCode
+    Comparisons = { '<', '<=', '>', '>=' }
+    Conditions = { what : '{} statement requires a boolean condition'.format(what) for what in ('if', 'while', 'assert') }
+
+    def __init__(self):
+        super().__init__()
+        self.resolver = None
+        self.globals = self.namespace()     # globals of the transpiled code, where Lox global x is x_
+        self.lineTables = {}    # file name of transpiled code => Lox line of each python line
+        self.declared = set()   # globals declared unconditionally by the programs run
+        self.pending = set()    # and by the program transpiled, once it runs
+        self.count = 0          # python names made
+        self.programs = 0
+
+    def namespace(self):
+        ns = { name + '_' : value for name, value in lox_builtins }
+        ns.update(_Func=PyFunc, _Method=PyMethod, _Class=LoxClass, _Object=LoxClass.Object, _Instance=LoxInstance,
+                  _Cell=Cell, _UNDEF=UNDEFINED, _str=stringify, _AssertError=AssertError,
+                  _binary=binary, _plus=plus, _unary=unary, _truth=truth, _getattr=getAttr, _settable=settable,
+                  _checkCallable=checkCallable, _method=method, _superMethod=superMethod, _superAttr=superAttr, _super=superOf,
+                  _setCell=setCell, _undeclared=undeclared, _duplicated=duplicated, _flow=flow,
+                  _call=self.call, _callMethod=self.callMethod)
+        return ns
+
+    def interpret(self, ast, resolved=False):
+        return self.run(*self.transpile(ast, resolved))
+
+    def transpile(self, ast, resolved=False):
+        'returns (code, lines): the code object of the program and the Lox line of each python line'
+        if not resolved:    # not resolved by caller
+            if self.resolver is None: self.resolver = Resolver()
+            errors = self.resolver.resolve(ast)
+            if errors: raise errors[0]
+        self.out, self.indent, self.line = [], 0, None    # out: (indent, text, Lox line) of the python lines
+        self.func, self.sink, self.bare = Function(module=True), None, False
+        self.emit('_result = None')
+        self.statements(ast, '_result = ')
+        source = '\n'.join('    ' * indent + text for indent, text, line in self.out)
+        lines = [None] + [line for indent, text, line in self.out]
+        self.programs += 1
+        try:
+            code = compile(source, '<lox {}>'.format(self.programs), 'exec')
+        except (SyntaxError, RecursionError, MemoryError) as ex:   # python limits, as nesting
+            line = lines[ex.lineno] if getattr(ex, 'lineno', None) else None
+            raise CompileError(line, 'too complex for python: {}'.format(getattr(ex, 'msg', None) or 'out of stack'))
+        return code, lines
+
+    def run(self, code, lines):
+        'runs the code of transpile(), returns the value of the program'
+        self.lineTables[code.co_filename] = lines
+        try:
+            exec(code, self.globals)
+        except RecursionError as ex:
+            raise LoxStackOverflow(self.lineOf(ex), 'stack overflow') from None
+        except NameError as ex:     # a global used before its declaration
+            if not ex.name or self.lineOf(ex) is None: raise
+            raise InterpError(self.lineOf(ex), "var {} used without being declared".format(unmangle(ex.name))) from None
+        finally:
+            self.declared |= self.pending
+            self.pending = set()
+        return self.globals.pop('_result', None)
+
+    def lineOf(self, ex):
+        'Lox line of the innermost transpiled code running when ex was raised'
+        line, tb = None, ex.__traceback__
+        while tb:
+            lines = self.lineTables.get(tb.tb_frame.f_code.co_filename)
+            if lines and tb.tb_lineno < len(lines): line = lines[tb.tb_lineno]
+            tb = tb.tb_next
+        return line
+
+    def call(self, callee, line, *args):
+        'callee(*args) of a callee which is not a PyFunc of that arity, as Interpreter.visitCallExpr'
+        try:
+            return callee(self, list(args))
+        except LoxFuncArgc as ex:
+            if not ex.args[0]:  # raised by the callee itself
+                ex.args = (line, ex.args[1])
+            raise ex
+
+    def callMethod(self, callee, this, line, *args):
+        'calls the callee of method(), which is not a PyMethod of that arity'
+        if type(callee) is tuple: return self.call(callee[0], line, *args)
+        try:
+            return callee(self, list(args), this)
+        except LoxFuncArgc as ex:
+            if not ex.args[0]: ex.args = (line, ex.args[1])
+            raise ex
+
+    # writing python
+
+    def emit(self, text, indent=0):
+        self.out.append((self.indent + indent, text, self.line))
+
+    def fresh(self, name):
+        'a python name for the local name, those of Lox globals end with _ and of the helpers start with _'
+        self.count += 1
+        return '{}_{}'.format(name, self.count)
+
+    def temp(self):
+        self.func.temps += 1
+        return '_t{}'.format(self.func.temps)
+
+    @contextmanager
+    def suite(self):
+        'an indented python block, pass if nothing is written in it'
+        self.indent += 1
+        start = len(self.out)
+        try:
+            yield
+        finally:
+            if len(self.out) == start: self.emit('pass')
+            self.indent -= 1
+
+    @contextmanager
+    def buffered(self):
+        'the lines written in the with block are kept in a list, to be placed by the caller'
+        saved, self.out = self.out, []
+        try:
+            yield self.out
+        finally:
+            self.out = saved
+
+    def place(self, lines, shift=0):
+        self.out.extend((indent + shift, text, line) for indent, text, line in lines)
+
+    @contextmanager
+    def scope(self, cells, params=()):
+        '''a local scope of the Resolver: its variables in cells are made Cells when it is entered,
+        and those declared under a condition are UNDEFINED'''
+        scope = Scope(cells, self.out, self.indent)
+        for slot, name in params:
+            scope.vars[slot] = Var(name, slot in scope.cells, param=True)
+        self.func.scopes.append(scope)
+        try:
+            yield scope
+        finally:
+            self.func.scopes.pop()
+        made = []
+        for var in scope.vars.values():
+            if var.cell: made.append('{0} = _Cell({1})'.format(var.py, var.py if var.param else '_UNDEF'))
+            elif var.checked and not var.param: made.append('{} = _UNDEF'.format(var.py))
+        scope.out[scope.at:scope.at] = [(scope.indent, text, self.line) for text in made]
+
+    def local(self, where):
+        'Var of the local at where, (depth, slot) from the current scope'
+        depth, slot = where[0], where[1]
+        scopes = self.func.scopes
+        if depth < len(scopes): return scopes[-1 - depth].vars[slot]
+        return self.func.captures[slot]    # closure of the function
+
+    def declare(self, name, where, bare):
+        'Var of the local declared by name at where, made by its first declaration'
+        scope = self.func.scopes[-1]
+        var = scope.vars.get(where[1])
+        if var is None:
+            var = scope.vars[where[1]] = Var(self.fresh(name.lexeme), where[1] in scope.cells)
+        if bare: var.checked = True
+        return var
+
+    def define(self, name, where, value, bare, check=False):
+        '''declares name with the value of python src value, bare: declared under a condition;
+        check: a var, which can not be declared twice'''
+        if where[0] < 0:
+            py = name.lexeme + '_'
+            if check and bare:
+                self.emit("{!r} not in globals() or _duplicated({!r}, {})".format(py, name.lexeme, name.line))
+            if not bare: self.pending.add(name.lexeme)
+            self.emit('{} = {}'.format(py, value))
+            return
+        var = self.declare(name, where, bare)
+        target = var.py + '.value' if var.cell else var.py
+        if check and bare:
+            self.emit('{} is _UNDEF or _duplicated({!r}, {})'.format(target, name.lexeme, name.line))
+        self.emit('{} = {}'.format(target, value))
+
+    def read(self, name, where):
+        'Py reading the variable name resolved to where'
+        if where[0] < 0: return Py(name.lexeme + '_')   # NameError if undeclared, see run()
+        var = self.local(where)
+        src = var.py + '.value' if var.cell else var.py
+        if var.checked:
+            t = self.temp()
+            return Py('({0} if ({0} := {1}) is not _UNDEF else _undeclared({2!r}, {3}))'.format(
+                      t, src, name.lexeme, name.line))
+        return Py(src, simple=not var.cell)
+
+    def expr(self, expr):
+        return expr.accept(self)
+
+    def truth(self, py, line, message):
+        'python bool of the value of py as a condition'
+        if py.kind == 'bool': return py.src
+        if py.simple and not py.literal:
+            t, first = py.src, py.src
+        else:
+            t = self.temp()
+            first = '({} := {})'.format(t, py.src)
+        return '({} is True or ({} is not False and _truth({}, {}, {!r})))'.format(first, t, t, line, message)
+
+    def condition(self, expr, what, line=None):
+        return self.truth(self.expr(expr), lineOf(expr) if line is None else line, self.Conditions[what])
+
+    def operand(self, py, later=None):
+        '''returns (ref, typed) of operand py of a binary operator: ref reads its value once evaluated,
+        typed evaluates it in the type test, None if it needs none; later: the operand evaluated after'''
+        if py.literal:
+            return py.src, None if py.kind == 'float' else py.src
+        if py.simple and not (later and later.assigns):
+            return py.src, py.src
+        t = self.temp()
+        return t, '{} := {}'.format(t, py.src)
+
+    # statements
+
+    def statements(self, stmts, sink):
+        'sink: how the value of the last statement is kept, None if dropped'
+        for i, stmt in enumerate(stmts):
+            self.statement(stmt, sink if i == len(stmts) - 1 else None)
+
+    def statement(self, stmt, sink=None, bare=False):
+        'bare: stmt is the branch of an if or the body of a loop, its declarations are conditional'
+        line = self.lineOfStmt(stmt)
+        if line is not None: self.line = line
+        self.sink, self.bare = sink, bare
+        if type(stmt) is Expr.FuncStmt:
+            self.funcStmt(stmt)
+        elif isinstance(stmt, (Expr.Literal, Expr.Binary, Expr.Unary, Expr.Grouping,
+                               Expr.Identifier, Expr.Attrib, Expr.Call)):
+            self.value(stmt, sink)  # a void statement, see Optimizer.void
+        else:
+            stmt.accept(self)
+
+    @staticmethod
+    def lineOfStmt(stmt):
+        if isinstance(stmt, (Expr.ExprStmt, Expr.PrintStmt)): return lineOf(stmt.expr)
+        if isinstance(stmt, (Expr.VarStmt, Expr.ClassStmt)): return stmt.name.line
+        if isinstance(stmt, Expr.FuncStmt): return stmt.line
+        if isinstance(stmt, (Expr.IfStmt, Expr.WhileStmt)): return lineOf(stmt.condition)
+        if isinstance(stmt, Expr.FlowStmt): return stmt.type.line
+        if isinstance(stmt, Expr.AssertStmt): return stmt.op.line
+        if isinstance(stmt, (Expr.ScopeStmt, Expr.Program)): return None
+        return lineOf(stmt)
+
+    def value(self, expr, sink):
+        'writes expr as a statement, its value kept by sink'
+        if sink is None or type(expr) is Expr.Binary and expr.operator.type == TokenType.EQUAL:
+            return self.effect(expr)    # an assignment is valued nil
+        self.emit(sink + self.expr(expr).src)
+
+    def effect(self, expr):
+        'writes expr as a statement, its value dropped'
+        if type(expr) is Expr.Binary and expr.operator.type == TokenType.EQUAL:
+            return self.assign(expr, statement=True)
+        py = self.expr(expr)
+        if not py.literal: self.emit(py.src)
+
+    def visitProgram(self, prog):
+        self.statements(prog, self.sink)
+
+    def visitScopeStmt(self, stmt):
+        sink = self.sink
+        with self.scope(stmt.cells):
+            self.statements(stmt, sink)
+
+    def visitPrintStmt(self, stmt):
+        self.emit('print(_str({}))'.format(self.expr(stmt.expr).src))
+
+    def visitAssertStmt(self, stmt):
+        cond = self.condition(stmt.expr, 'assert', stmt.op.line)
+        sp = LispPrinter(file=StringIO()).printProgram(stmt.expr, end='').getvalue()
+        self.emit('if not {}: raise _AssertError({}, {!r})'.format(cond, stmt.op.line, "assertion {} failed".format(sp)))
+
+    def visitExprStmt(self, stmt):
+        self.value(stmt.expr, None if stmt.semicolon else self.sink)
+
+    def visitVarStmt(self, stmt):
+        bare = self.bare
+        if stmt.initial is None:
+            return self.define(stmt.name, stmt.where, 'None', bare, check=True)
+        value = self.expr(stmt.initial).src
+        if stmt.where[0] < 0 and not isinstance(stmt.initial, (Expr.Literal, Expr.Identifier)):
+            # declared nil before the initializer runs, which may call a function reading it
+            self.define(stmt.name, stmt.where, 'None', bare, check=True)
+            self.emit('{}_ = {}'.format(stmt.name.lexeme, value))
+        else:
+            self.define(stmt.name, stmt.where, value, bare, check=True)
+
+    def funcStmt(self, stmt):
+        sink, bare = self.sink, self.bare
+        if stmt.name and stmt.where[0] >= 0:
+            self.declare(stmt.name, stmt.where, False)  # a cell if it calls itself
+        func = self.function(stmt)
+        if stmt.name is None:
+            if sink: self.emit(sink + func)
+            return
+        self.define(stmt.name, stmt.where, func, bare)
+        if sink: self.emit(sink + self.read(stmt.name, stmt.where).src)
+
+    def function(self, stmt, isMethod=False):
+        'writes the python def of function stmt, returns the python expression making its PyFunc'
+        name = stmt.name.lexeme if stmt.name else LoxFunc.ANONYMOUS
+        captures = [self.local(capture) for capture in stmt.captures]
+        params = [(0, self.fresh('this'))] if isMethod else []
+        params += [(slot, self.fresh(p.lexeme)) for slot, p in enumerate(stmt.params, len(params))]
+        py = self.fresh(stmt.name.lexeme if stmt.name else 'lambda')
+        saved, line = self.func, self.line
+        self.line = stmt.line
+        self.emit('def {}({}):'.format(py, ', '.join(
+            [p for slot, p in params] + (['*'] + ['{0}={0}'.format(var.py) for var in captures] if captures else []))))
+        self.func = Function(captures)
+        with self.suite():
+            start = len(self.out)
+            with self.scope(stmt.block.cells, params) as scope:
+                if isMethod: scope.vars[0].checked = True   # UNDEFINED in a class method
+                self.statements(stmt.block, 'return ')
+            if self.func.globals:
+                self.out.insert(start, (self.indent, 'global ' + ', '.join(sorted(self.func.globals)), stmt.line))
+        self.func, self.line = saved, line
+        return '{}({!r}, {}, {}, {})'.format('_Method' if isMethod else '_Func', name, py, len(stmt.params), stmt.line)
+
+    def visitFuncStmt(self, stmt):
+        'a lambda'
+        return Py(self.function(stmt))
+
+    def visitClassStmt(self, stmt):
+        sink, bare = self.sink, self.bare
+        parent = self.read(stmt.parent, stmt.parent_where).src if stmt.parent else '_Object'
+        if stmt.where[0] >= 0: self.declare(stmt.name, stmt.where, False)  # a cell if its methods use it
+        sup = self.fresh('super')
+        self.emit('{} = {}'.format(sup, parent))
+        with self.scope(()) as scope:   # holds super, see LoxClass.fromStmt
+            scope.vars[0] = Var(sup, False)
+            methods = ['{!r}: {}'.format(m.name.lexeme, self.function(m, isMethod=True)) for m in stmt.members]
+        self.define(stmt.name, stmt.where, '_Class({!r}, {}, {{{}}}, {})'.format(
+                    stmt.name.lexeme, sup, ', '.join(methods), stmt.name.line), bare)
+        if sink: self.emit(sink + self.read(stmt.name, stmt.where).src)
+
+    def visitIfStmt(self, stmt):
+        sink, keyword, nested = self.sink, 'if', 0
+        while True:
+            with self.buffered() as pre:
+                cond = self.condition(stmt.condition, 'if')
+            shift = 0
+            if pre and keyword == 'elif':   # made functions, run before the test
+                self.emit('else:')
+                self.indent, nested, keyword, shift = self.indent + 1, nested + 1, 'if', 1
+            self.place(pre, shift)
+            self.emit('{} {}:'.format(keyword, cond))
+            with self.suite():
+                self.statement(stmt.then_branch, sink, bare=True)
+            branch = stmt.else_branch
+            if type(branch) is Expr.IfStmt:
+                stmt, keyword = branch, 'elif'
+                if lineOf(stmt.condition) is not None: self.line = lineOf(stmt.condition)
+                continue
+            if branch is not None:
+                self.emit('else:')
+                with self.suite():
+                    self.statement(branch, sink, bare=True)
+            break
+        self.indent -= nested
+
+    def visitWhileStmt(self, stmt):
+        pre = None
+        if stmt.condition is None:  # while (true), see Optimizer
+            self.emit('while True:')
+        else:
+            with self.buffered() as pre:
+                cond = self.condition(stmt.condition, 'while')
+            self.emit('while {}:'.format('True' if pre else cond))
+        self.func.loops.append((stmt.iteration, len(self.func.scopes)))
+        with self.suite():
+            if pre:     # made functions, run before each test
+                self.place(pre, 1)
+                self.emit('if not {}: break'.format(cond))
+            self.statement(stmt.loop, bare=True)
+            self.iteration(*self.func.loops[-1])
+        self.func.loops.pop()
+
+    def iteration(self, expr, depth):
+        'writes the iteration of a for loop, resolved in the scope of depth scopes'
+        if expr is None: return
+        if lineOf(expr) is not None: self.line = lineOf(expr)
+        scopes = self.func.scopes
+        inner, scopes[depth:] = scopes[depth:], []
+        try:
+            self.effect(expr)
+        finally:
+            scopes.extend(inner)
+
+    def visitFlowStmt(self, stmt):
+        kind = stmt.type.type
+        if kind == TokenType.RETURN:
+            self.emit('return' if stmt.value is None else 'return ' + self.expr(stmt.value).src)
+        elif not self.func.loops:   # in a function in a loop
+            self.emit('_flow({!r}, {})'.format(stmt.type.lexeme, stmt.type.line))
+        elif kind == TokenType.BREAK:
+            self.emit('break')
+        else:
+            self.iteration(*self.func.loops[-1])
+            self.emit('continue')
+
+    # expressions
+
+    def visitLiteralExpr(self, expr):
+        tok = expr.value
+        if tok.type == TokenType.TRUE: return Py('True', 'bool', True, True)
+        if tok.type == TokenType.FALSE: return Py('False', 'bool', True, True)
+        if tok.type == TokenType.NIL: return Py('None', None, True, True)
+        if tok.type == TokenType.STRING: return Py(repr(tok.literal), 'str', True, True)
+        if tok.type == TokenType.NUMBER:
+            value = tok.literal
+            src = repr(value) if math.isfinite(value) else "float('{}')".format(value)
+            return Py('({})'.format(src) if src.startswith('-') else src, 'float', True, True)
+        raise InterpError(tok.line, "unsupported literal {}".format(repr(tok)))
+
+    def visitGroupingExpr(self, expr):
+        return self.expr(expr.expression)
+
+    def visitIdentifierExpr(self, expr):
+        name, where = expr.value, expr.where
+        if name.type == TokenType.SUPER:
+            return Py('_super({}, {})'.format(self.local(where[:2]).py, self.local(where[2:]).py))
+        return self.read(name, where)
+
+    def visitUnaryExpr(self, expr):
+        op, line = expr.operator.lexeme, expr.operator.line
+        right = self.expr(expr.right)
+        if op == '!' and right.kind == 'bool':
+            return Py('(not {})'.format(right.src), 'bool', parts=(right,))
+        ref, typed = self.operand(right)
+        kind = 'float' if op == '-' else 'bool'
+        fast = '-' + ref if op == '-' else 'not ' + ref
+        if typed is None: return Py('({})'.format(fast), kind, parts=(right,))
+        return Py('({} if type({}) is {} else _unary({!r}, {}, {}))'.format(
+                  fast, typed, kind, op, ref, line), kind, parts=(right,))
+
+    def visitBinaryExpr(self, expr):
+        kind = expr.operator.type
+        if kind == TokenType.EQUAL: return self.assign(expr, statement=False)
+        if kind == TokenType.AND or kind == TokenType.OR:
+            return self.andOr(expr)
+        op, line = expr.operator.lexeme, expr.operator.line
+        left, right = self.expr(expr.left), self.expr(expr.right)
+        if kind == TokenType.EQUAL_EQUAL or kind == TokenType.BANG_EQUAL:
+            return Py('({} {} {})'.format(left.src, op, right.src), 'bool', parts=(left, right))
+        lref, ltyped = self.operand(left, right)
+        rref, rtyped = self.operand(right)
+        typed = [t for t in (ltyped, rtyped) if t]
+        test = ' is '.join('type({})'.format(t) for t in typed) + ' is float' if typed else ''
+        if op == '/' and not (type(expr.right) is Expr.Literal and expr.right.value.literal):   # a number but 0
+            test = test + ' and ' + rref if test else rref
+        kind = 'bool' if op in self.Comparisons else 'float' if op != '+' and op != '*' or \
+               left.kind == right.kind == 'float' else None
+        fast = '{} {} {}'.format(lref, op, rref)
+        if not test: return Py('({})'.format(fast), kind, parts=(left, right))
+        slow = '_plus({}, {}, {})'.format(lref, rref, line) if op == '+' else \
+               '_binary({!r}, {}, {}, {})'.format(op, lref, rref, line)
+        return Py('({} if {} else {})'.format(fast, test, slow), kind, parts=(left, right))
+
+    def andOr(self, expr):
+        message = "invalid operand(s) for operator {}".format(expr.operator)
+        line = expr.operator.line
+        left, right = self.expr(expr.left), self.expr(expr.right)
+        return Py('({} {} {})'.format(self.truth(left, line, message), expr.operator.lexeme,
+                                      self.truth(right, line, message)), 'bool', parts=(left, right))
+
+    def assign(self, expr, statement):
+        '''writes the assignment expr as a statement, or returns it as an expression valued nil
+        (Interpreter.setval returns nothing)'''
+        target, line = expr.left, expr.operator.line
+        if type(target) is Expr.Attrib:
+            return self.setAttr(target, expr.right, statement)
+        name, where = target.value, target.where
+        value = self.expr(expr.right)
+        if where[0] < 0:
+            py, check = name.lexeme + '_', None
+            if name.lexeme not in self.declared and name.lexeme not in self.pending:   # declared under a condition
+                check = '{!r} in globals() or _undeclared({!r}, {})'.format(py, name.lexeme, name.line)
+            if not self.func.module: self.func.globals.add(py)
+        else:
+            var = self.local(where)
+            py = var.py + '.value' if var.cell else var.py
+            check = '{} is not _UNDEF or _undeclared({!r}, {})'.format(py, name.lexeme, name.line) if var.checked else None
+        if statement:
+            if check: self.emit(check)
+            self.emit('{} = {}'.format(py, value.src))
+            return
+        if where[0] >= 0 and var.cell:
+            src = '_setCell({}, {})'.format(var.py, value.src)
+        else:
+            src = '(({} := {}), None)[1]'.format(py, value.src)
+        if check: src = '({}, {})[1]'.format(check, src)
+        py = Py(src, parts=(value,))
+        py.assigns = True
+        return py
+
+    def setAttr(self, target, valueExpr, statement):
+        if isSuper(target.object):  # the field of this, or of the parent class in a class method
+            where = target.object.where
+            this, parent = self.local(where[2:]).py, self.local(where[:2]).py
+            obj = Py('({} if {} is _UNDEF else {})'.format(parent, this, this))
+        else:
+            obj = self.expr(target.object)
+        line = target.dot.line
+        value = self.expr(valueExpr)
+        name = repr(target.attribute.lexeme)
+        if not statement:
+            return Py('_settable({}, {}).setattr({}, {})'.format(obj.src, line, name, value.src), parts=(obj, value))
+        o, i = (obj.src, self.temp()) if obj.simple and not obj.literal and not value.assigns else (self.temp(), self.temp())
+        first = o if o == obj.src else '({} := {})'.format(o, obj.src)
+        self.emit('if type({}) is _Instance and ({} := {}.shape.fields.get({})) is not None: {}.values[{}] = {}'.format(
+                  first, i, o, name, o, i, value.src))
+        self.emit('else: _settable({}, {}).setattr({}, {})'.format(o, line, name, value.src))
+
+    def visitAttribExpr(self, expr):
+        line, name = expr.dot.line, repr(expr.attribute.lexeme)
+        if isSuper(expr.object):
+            where = expr.object.where
+            return Py('_superAttr({}, {}, {}, {})'.format(self.local(where[2:]).py, self.local(where[:2]).py, name, line))
+        obj = self.expr(expr.object)
+        if obj.simple and not obj.literal:
+            o, first = obj.src, obj.src
+        else:
+            o = self.temp()
+            first = '({} := {})'.format(o, obj.src)
+        i = self.temp()
+        return Py('({1}.values[{2}] if type({0}) is _Instance and ({2} := {1}.shape.fields.get({3})) is not None '
+                  'else _getattr({1}, {3}, {4}))'.format(first, o, i, name, line), parts=(obj,))
+
+    def visitCallExpr(self, expr):
+        line, callee = expr.paran.line, expr.callee
+        if type(callee) is Expr.Attrib:     # obj.method(), called without making a LoxMethod
+            name, dot, o, m = repr(callee.attribute.lexeme), callee.dot.line, self.temp(), self.temp()
+            if isSuper(callee.object):
+                where = callee.object.where
+                lookup = '_superMethod(({} := {}), {}, {}, {}, {})'.format(
+                         o, self.local(where[2:]).py, self.local(where[:2]).py, name, dot, line)
+                parts = ()
+            else:
+                obj = self.expr(callee.object)
+                lookup = '_method(({} := {}), {}, {}, {})'.format(o, obj.src, name, dot, line)
+                parts = (obj,)
+            args = [self.expr(arg) for arg in expr.args]
+            srcs = ''.join(', ' + arg.src for arg in args)
+            return Py('({0}.fn({1}{2}) if type({0} := {3}) is _Method and {0}.arity == {4} '
+                      'else _callMethod({0}, {1}, {5}{2}))'.format(m, o, srcs, lookup, len(args), line),
+                      parts=(*parts, *args))
+        func = self.expr(callee)
+        f = self.temp()
+        args = [self.expr(arg) for arg in expr.args]
+        return Py('({0}.fn({1}) if type({0} := {2}) is _Func and {0}.arity == {3} '
+                  'else _call(_checkCallable({0}, {4}), {4}{5}))'.format(
+                  f, ', '.join(arg.src for arg in args), func.src, len(args), line,
+                  ''.join(', ' + arg.src for arg in args)), parts=(func, *args))
+
+
+def loadCode(path, key):
+    'returns (code, lines) of transpile() cached for the source of sourceKey key, None if missing or stale'
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC_NUMBER)) != MAGIC_NUMBER: return None   # of another python
+            version, cachedKey, code, lines = marshal.load(f)
+        if version != Transpiler.VERSION or cachedKey != key:
+            return None
+        return code, lines
+    except Exception:   # missing, truncated or from an incompatible build
+        return None
+
+def saveCode(path, key, code, lines):
+    'written as a .pyc is: the magic number of python, then the marshalled code'
+    writeAtomic(path, MAGIC_NUMBER + marshal.dumps((Transpiler.VERSION, key, code, lines)))
+
+
+if __name__ == "__main__":
+    import sys
+    from Parser import Parser
+    from Optimizer import Optimizer
+    if len(sys.argv) != 2:
+        sys.exit('usage: python Transpiler.py file.lox: prints the python source of the program')
+    with open(sys.argv[1]) as f:
+        ast, errors = Parser(RegexScanner(f.read()).iterTokens()).parse()
+    errors = errors or Resolver().resolve(ast)
+    if errors: sys.exit('\n'.join(map(str, errors)))
+    transpiler = Transpiler()
+    transpiler.transpile(Optimizer().optimize(ast), resolved=True)
+    for indent, text, line in transpiler.out:
+        print('{:>4}  {}{}'.format(line or '', '    ' * indent, text))
@@ -0,0 +1,42 @@
+'''time return/break/continue heavy programs on the tree walking engines'''
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Scanner import RegexScanner
+from Parser import Parser
+from Interpreter import Interpreter
+from ClosureCompiler import ClosureCompiler
+
+Programs = {
+    'fib' : '''
+        fun fib(n) {{ if (n < 2) return n; return fib(n - 1) + fib(n - 2); }}
+        fib({n});
+        ''',
+    'loops' : '''
+        var s = 0;
+        for (var i = 0; i < {n}; i = i + 1) {{
+            for (var j = 0; true; j = j + 1) {{
+                if (j == 3) break;
+                if (j == 1) continue;
+                s = s + j;
+            }}
+        }}
+        ''',
+}
+Sizes = { 'fib' : 20, 'loops' : 10000 }
+
+def measure(engine, source, repeat=3):
+    best = None
+    for i in range(repeat):
+        ast, errors = Parser(RegexScanner(source).scanTokens()).parse()
+        assert not errors, errors
+        t = time.perf_counter()
+        engine().interpret(ast)
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best
+
+if __name__ == "__main__":
+    for engine in (Interpreter, ClosureCompiler):
+        for name, program in Programs.items():
+            dt = measure(engine, program.format(n=Sizes[name]))
+            print('{:16s} {:6s} n={:<6d} {:.3f}s'.format(engine.__name__, name, Sizes[name], dt))
@@ -0,0 +1,46 @@
+'''time method calls through a deep class hierarchy against plain function calls, on every engine'''
+import os, sys, time, contextlib
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_bench import prepare
+from pyLox import Lox
+
+Depth = 8   # classes between the instance and the class defining the method
+Programs = {
+    'function' : '''
+        fun get(x) {{ return x; }}
+        var s = 0;
+        for (var i = 0; i < {n}; i = i + 1) {{ s = s + get(i); }}
+        ''',
+    'method' : '''
+        class C0 {{ get(x) {{ return x; }} }}
+        var o = C0();
+        var s = 0;
+        for (var i = 0; i < {n}; i = i + 1) {{ s = s + o.get(i); }}
+        ''',
+    'inherited' : '''
+        class C0 {{ get(x) {{ return x; }} }}
+        ''' + ''.join('class C%d < C%d {{}}\n' % (i + 1, i) for i in range(Depth)) + '''
+        var o = C{depth}();
+        var s = 0;
+        for (var i = 0; i < {n}; i = i + 1) {{ s = s + o.get(i); }}
+        ''',
+}
+
+def measure(run, repeat=5):
+    best = None
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        for i in range(repeat):
+            t = time.perf_counter()
+            run()
+            dt = time.perf_counter() - t
+            best = dt if best is None else min(best, dt)
+    return best
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for engine in Lox.Engines:
+        base = None
+        for name, program in Programs.items():
+            dt = measure(prepare(program.format(n=n, depth=Depth), engine))
+            base = base or dt
+            print('{:8s} {:10s} {:8d} calls in {:.3f}s: {:5.2f}x of function calls'.format(engine, name, n, dt, dt / base))
@@ -0,0 +1,33 @@
+'''compare tokens/sec of Scanner and RegexScanner on a generated data table'''
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Scanner import Scanner, RegexScanner
+
+def genTable(rows):
+    'a large generated Lox file, as data tables are'
+    lines = ['// generated table', 'var table = Object();']
+    for i in range(rows):
+        lines.append('table.row{0} = lambda() {{ return "name \\"{0}\\"\\n" + {0}.5 * 2 >= -{0}; }}; /* row {0} */'.format(i))
+    return '\n'.join(lines) + '\n'
+
+def measure(cls, source, repeat=3):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        scanner = cls(source)
+        tokens = scanner.scanTokens()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return scanner, tokens, best
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    source = genTable(rows)
+    print('source: {:.1f} MB, {} lines'.format(len(source) / 1e6, rows + 2))
+    results = {}
+    for cls in (Scanner, RegexScanner):
+        scanner, tokens, dt = measure(cls, source)
+        results[cls.__name__] = [(t.type, t.lexeme, t.literal, t.line, col)     # tokens compare by identity
+                                 for t, col in zip(tokens, scanner.columns)]
+        print('{:14s} {:8d} tokens in {:.3f}s: {:10.0f} tokens/sec'.format(cls.__name__, len(tokens), dt, len(tokens) / dt))
+    assert results['Scanner'] == results['RegexScanner'], 'token streams differ'
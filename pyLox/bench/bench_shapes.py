@@ -0,0 +1,53 @@
+'''build a linked list of records, then read and write their fields, on every engine; reports the
+time of each phase and the memory held per record, from the peak RSS of a child process per engine
+
+usage: python bench_shapes.py [n records, default 100000] [engine ...]
+
+The default takes some seconds per engine; n = 1000000 takes minutes, most of them on interp.'''
+import os, sys, io, json, subprocess, contextlib
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_bench import prepare, peakRSS
+from pyLox import Lox
+
+Program = '''
+class Record {{
+    init(id, x, y, next) {{ this.id = id; this.x = x; this.y = y; this.next = next; }}
+}}
+var t = clock();
+var head = nil;
+for (var i = 0; i < {n}; i = i + 1) {{ head = Record(i, i, i, head); }}
+printf("%f\\n", clock() - t);
+t = clock();
+var s = 0;
+var r = head;
+while (r != nil) {{ s = s + r.x + r.y; r = r.next; }}
+printf("%f\\n", clock() - t);
+t = clock();
+r = head;
+while (r != nil) {{ r.x = r.y + 1; r = r.next; }}
+printf("%f\\n", clock() - t);
+'''
+
+def child(n, engine):
+    'run in the child process: print the phase times and the peak RSS as JSON'
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        prepare(Program.format(n=n), engine)()
+    build, get, set = map(float, out.getvalue().split())
+    print(json.dumps({ 'build' : build, 'get' : get, 'set' : set, 'rss_kb' : peakRSS() }))
+
+def measure(n, engine):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', str(n), engine],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]), sys.argv[3])
+        sys.exit()
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('{:8s} {:>9s} {:>9s} {:>9s} {:>12s}'.format('engine', 'build', 'get', 'set', 'bytes/record'))
+    for engine in sys.argv[2:] or Lox.Engines:
+        base, r = measure(1, engine), measure(n, engine)
+        held = (r['rss_kb'] - base['rss_kb']) * 1024 / n if r['rss_kb'] else float('nan')
+        print('{:8s} {:8.3f}s {:8.3f}s {:8.3f}s {:12.0f}'.format(engine, r['build'], r['get'], r['set'], held))
@@ -0,0 +1,34 @@
+'''build a string by appending n pieces to it, s = s + piece, on every engine; reports the time of
+the appends and of the first read of the string, which joins the pieces
+
+usage: python bench_strings.py [n pieces, default 100000] [engine ...]'''
+import os, sys, io, contextlib
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_bench import prepare
+from pyLox import Lox
+
+Program = '''
+var t = clock();
+var s = "";
+for (var i = 0; i < {n}; i = i + 1) {{ s = s + "piece"; }}
+printf("%f\\n", clock() - t);
+t = clock();
+printf("%.0s", s);
+printf("%f\\n", clock() - t);
+print s == s + "";
+'''
+
+def measure(n, engine):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        prepare(Program.format(n=n), engine)()
+    append, read, same = out.getvalue().split()
+    assert same == 'true'
+    return float(append), float(read)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('{:8s} {:>9s} {:>9s} {:>12s}'.format('engine', 'append', 'read', 'ns/append'))
+    for engine in sys.argv[2:] or Lox.Engines:
+        append, read = measure(n, engine)
+        print('{:8s} {:8.3f}s {:8.3f}s {:12.0f}'.format(engine, append, read, append * 1e9 / n))
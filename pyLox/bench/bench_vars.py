@@ -0,0 +1,44 @@
+'''time variable-heavy loops (globals, locals, upvalues) on the tree walking engines'''
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Scanner import RegexScanner
+from Parser import Parser
+from Interpreter import Interpreter
+from ClosureCompiler import ClosureCompiler
+
+Programs = {
+    'globals' : '''
+        var i = 0; var a = 0; var b = 1;
+        while (i < {n}) {{ a = a + b; b = a - b; i = i + 1; }}
+        ''',
+    'locals' : '''
+        {{ var i = 0; var a = 0; var b = 1;
+           while (i < {n}) {{ a = a + b; b = a - b; i = i + 1; }} }}
+        ''',
+    'upvalues' : '''
+        fun outer() {{
+            var i = 0; var a = 0; var b = 1;
+            fun inner() {{ while (i < {n}) {{ a = a + b; b = a - b; i = i + 1; }} }}
+            inner();
+        }}
+        outer();
+        ''',
+}
+
+def measure(engine, source, repeat=3):
+    best = None
+    for i in range(repeat):
+        ast, errors = Parser(RegexScanner(source).scanTokens()).parse()
+        assert not errors, errors
+        t = time.perf_counter()
+        engine().interpret(ast)
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for engine in (Interpreter, ClosureCompiler):
+        for name, program in Programs.items():
+            dt = measure(engine, program.format(n=n))
+            print('{:16s} {:10s} {:8d} iterations in {:.3f}s: {:10.0f} iterations/sec'.format(engine.__name__, name, n, dt, n / dt))
@@ -0,0 +1,129 @@
+'''run the Lox programs of bench/ on every engine, report median/p95 wall time,
+byte code instructions per second and peak RSS, and save the results as JSON
+
+usage: python run_bench.py [-n 5] [--engine vm ...] [--json out.json] [--compare base.json] [name.lox ...]
+
+Every (program, engine) pair runs in a child process of its own, so the peak RSS
+is its own. The instruction count of a program is measured once on the vm, and
+is the unit of work of every engine: instructions/sec = count / median time.'''
+import os, sys, json, time, math, statistics, subprocess, contextlib
+Here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(Here, '..'))
+from Scanner import RegexScanner
+from Parser import Parser
+from Resolver import Resolver
+from Optimizer import Optimizer
+from Compiler import Compiler
+from Peephole import Peephole
+from StackVM import StackVM
+from pyLox import Lox
+
+def prepare(source, engine):
+    'returns run() executing source on engine: scanned, parsed, resolved, optimized and compiled on each call'
+    def run():
+        ast, errors = Parser(RegexScanner(source).iterTokens()).parse()
+        errors = errors or Resolver().resolve(ast)
+        if errors: raise errors[0]
+        ast = Optimizer().optimize(ast)
+        if engine != 'vm':
+            return Lox.Engines[engine]().interpret(ast, resolved=True)
+        compiler, vm = Compiler(), StackVM()
+        compiler.compile(ast)
+        Peephole(compiler).optimize()
+        vm.replace(compiler.code, compiler.data, compiler.lines, compiler.notes, compiler.names)
+        return vm.run()
+    return run
+
+def countInstructions(source):
+    'byte code instructions executed by the vm running source'
+    ast, errors = Parser(RegexScanner(source).iterTokens()).parse()
+    errors = errors or Resolver().resolve(ast)
+    if errors: raise errors[0]
+    compiler, vm = Compiler(), StackVM()
+    compiler.compile(Optimizer().optimize(ast))
+    Peephole(compiler).optimize()
+    vm.replace(compiler.code, compiler.data, compiler.lines, compiler.notes, compiler.names)
+    vm.quickening = False   # one step per plain instruction
+    vm.decode()
+    count = 0
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        while vm.runOnce(): count += 1
+    vm.recover()
+    return count
+
+def peakRSS():
+    'peak resident set size of this process in KB, None if unknown'
+    try:
+        import resource
+    except ImportError:     # windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss    # bytes on macOS
+
+def child(path, engine, repeat):
+    'run in the child process: time repeat runs, print the result as JSON'
+    with open(path) as f: source = f.read()
+    run, times = prepare(source, engine), []
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        for i in range(repeat):
+            t = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t)
+    print(json.dumps({ 'times' : times, 'rss_kb' : peakRSS() }))
+
+def percentile(values, p):
+    'nearest rank percentile'
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def measure(path, engine, repeat):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', path, engine, str(repeat)],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    result = json.loads(out.splitlines()[-1])
+    times = result['times']
+    result.update(median=statistics.median(times), p95=percentile(times, 95))
+    return result
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Here, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(base, results):
+    print('\ncompared with {} ({}): median time new/base'.format(base.get('commit'), base.get('date')))
+    for name, engines in results['programs'].items():
+        for engine, r in engines.items():
+            old = base['programs'].get(name, {}).get(engine)
+            if old: print('{:12s} {:8s} {:6.2f}x'.format(name, engine, r['median'] / old['median']))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit()
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('programs', nargs='*', help='.lox files (default: all in bench/)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='runs per program and engine (default: %(default)s)')
+    parser.add_argument('--engine', action='append', choices=Lox.Engines, help='engines to run (default: all)')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='JSON results of another run to compare with')
+    args = parser.parse_args()
+    programs = args.programs or sorted(os.path.join(Here, f) for f in os.listdir(Here) if f.endswith('.lox'))
+    results = { 'commit' : commit(), 'date' : time.strftime('%Y-%m-%d %H:%M:%S'), 'python' : sys.version.split()[0],
+                'repeat' : args.repeat, 'programs' : {} }
+    print('{:12s} {:8s} {:>9s} {:>9s} {:>12s} {:>9s}'.format('program', 'engine', 'median', 'p95', 'instr/sec', 'peak RSS'))
+    for path in programs:
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f: count = countInstructions(f.read())
+        results['programs'][name] = engines = {}
+        for engine in args.engine or Lox.Engines:
+            r = engines[engine] = measure(path, engine, args.repeat)
+            r.update(instructions=count, ips=count / r['median'])
+            rss = '{:.1f}MB'.format(r['rss_kb'] / 1024) if r['rss_kb'] else '-'
+            print('{:12s} {:8s} {:8.3f}s {:8.3f}s {:12.0f} {:>9s}'.format(name, engine, r['median'], r['p95'], r['ips'], rss))
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f: compare(json.load(f), results)
@@ -13,14 +13,32 @@ stmts = {
     "Assert"    : "op, expr",
     "Expr"      : "expr, semicolon",
     "Var"       : "name, initial",
-    'Func'      : "name, params, block",
+    'Func'      : "name, params, block, line", # line of the name, or of keyword lambda
     'Class'     : "name, parent, members",
     "If"        : "condition, then_branch, else_branch",
     "While"     : "condition, loop, iteration", # support both while and for loop
     "Flow"      : "type, value", # break, continue, return
 }
 
-print("from collections import namedtuple\n\n")
+resolved = {   # set by the Resolver: (depth, slot) of the variable, depth -1 for globals
+    "Identifier": "where",
+    "VarStmt"   : "where",
+    "FuncStmt"  : "where, captures",    # captures: (depth, slot, boxed) of the variables closed over
+    "ClassStmt" : "where, parent_where",
+}
+
+cached = {     # set by the engines running the node
+    "Binary"    : "fast",   # (left type, right type, function) of the last operands, see Interpreter.visitBinaryExpr
+    "Attrib"    : "field, method",  # (shape, index...) and (class, method) of the last instance, see lookupField
+}
+
+print('''class Node:
+    "base of the ast nodes: __slots__ classes, no per node dict"
+    __slots__ = ()
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(repr(getattr(self, k)) for k in self.__slots__))
+
+''')
 print('''class Visitor:
     def visit(self, obj):
         return obj.accept(self)
@@ -33,18 +51,27 @@ for k in stmts.keys():
 for k in exprs.keys():
     print('''    def visit{type}Expr(self, expr):\n        pass'''.format(type=k))
 
-for k, v in exprs.items():
+def node(name, fields, visit):
+    names = [f.strip() for f in fields.split(',')]
+    extra = [f.strip() for table in (resolved, cached) if name in table for f in table[name].split(',')]
+    slots = names + extra
     print('''
-class {type}(namedtuple("{type}", "{fields}")):
-    def accept(self, visitor):
-        return visitor.visit{type}Expr(self)'''.format(type=k, fields=v))
+class {name}(Node):
+    __slots__ = ({slots})
+    def __init__(self, {args}):
+        {attrs} = {args}'''.format(name=name, args=', '.join(names),
+        slots=', '.join(repr(f) for f in slots) + (',' if len(slots) == 1 else ''), attrs=', '.join('self.' + f for f in names)))
+    if extra:
+        print('''        {} = {}'''.format(', '.join('self.' + f for f in extra), ', '.join('None' for f in extra)))
+    print('''    def accept(self, visitor):
+        return visitor.{visit}(self)'''.format(visit=visit))
+
+for k, v in exprs.items():
+    node(k, v, 'visit{}Expr'.format(k))
 
 print("\n\n# Statements:")
 for k, v in stmts.items():
-    print('''
-class {type}Stmt(namedtuple("{type}Stmt", "{fields}")):
-    def accept(self, visitor):
-        return visitor.visit{type}Stmt(self)'''.format(type=k, fields=v))
+    node(k + 'Stmt', v, 'visit{}Stmt'.format(k))
 
 print('''
 class ScopeStmt(list):
@@ -1,51 +1,105 @@
+import os, json
+from array import array
+from contextlib import contextmanager
 from LoxError import *
 from Parser import Parser
-from Scanner import Scanner
+from Scanner import Scanner, RegexScanner
 from AstPrinter import LispPrinter
 from Resolver import Resolver
+from Optimizer import Optimizer
 from Interpreter import Interpreter, stringify
-from Compiler import Compiler, StackVM
+from ClosureCompiler import ClosureCompiler
+from Compiler import Compiler, StackVM, sourceKey, loadCache, saveCache
+from Peephole import Peephole
+from Transpiler import Transpiler, loadCode, saveCode
+from StackVM import VMStats
+from Profiler import Profiler
 
 class Lox:
+    Engines = {
+        'interp'    : Interpreter,
+        'closure'   : ClosureCompiler,
+        'vm'        : None,     # Compiler + StackVM
+        'py'        : Transpiler,
+    }
+    CacheFiles = { 'vm' : '.loxc', 'py' : '.loxpy' }
 
-    def __init__(self):
+    def __init__(self, engine='interp', optimize=True):
         self.hadError = False
         self.tokens = []            # saved tokens from previous uncompleted lines
-        self.interp = Interpreter() # for retain inner statements when runPrompt()
+        self.columns = array('I')   # and their columns
+        self.parens = (0, 0)        # unclosed (parens, braces) in self.tokens
+        self.engine = engine
+        self.interp = (Lox.Engines[engine] or Interpreter)()  # for retain inner statements when runPrompt()
         self.resolver = Resolver()
+        self.optimizer = Optimizer() if optimize else None
         self.compiler = Compiler()
+        self.peephole = Peephole(self.compiler) if optimize else None
         self.vm = StackVM()
+        self.stats = None   # VMStats counting the runs of self.vm
 
-    def run(self, data, prompt=False):
+    def run(self, data, prompt=False, cache=None):
+        '''data: source str, or an iterable of str chunks scanned as parsing goes
+        cache: (path, sourceKey) of the .loxc file of the vm engine, or the .loxpy file of the py engine'''
         try:
-            tokens = Scanner(data).scanTokens()
-            if prompt:
-                tokens = self.continueLines(tokens)
-                if not tokens: return
+            cached = (loadCache if self.engine == 'vm' else loadCode)(*cache) if cache else None
+            if cached and self.engine == 'vm':
+                self.vm.replace(*cached)
+                rlt = self.vm.run(stats=self.stats)
+            elif cached:
+                rlt = self.interp.run(*cached)
+            else:
+                if prompt:
+                    scanner = RegexScanner(data)
+                    tokens, columns = self.continueLines(scanner.scanTokens(), scanner.columns)
+                    if not tokens: return
+                elif isinstance(data, str):
+                    scanner = RegexScanner(data)
+                    tokens, columns = scanner.iterTokens(), scanner.columns
+                else:
+                    scanner = RegexScanner('')
+                    tokens, columns = scanner.iterTokens(data), scanner.columns
 
-            ast, errors = Parser(tokens).parse()
-            if errors: return self.alarmErrors('parser', errors)
+                ast, errors = Parser(tokens, columns).parse()
+                if errors: return self.alarmErrors('parser', errors)
 
-            LispPrinter().printProgram(ast)
+                LispPrinter().printProgram(ast)
 
-            ids, errors = self.resolver.resolve(ast)
-            if errors: return self.alarmErrors('resolver', errors)
+                errors = self.resolver.resolve(ast)
+                if errors: return self.alarmErrors('resolver', errors)
 
-            #self.compiler.compile(ast)
-            #self.vm.replace(self.compiler.code, self.compiler.data)
-            #self.vm.print()
-            #self.vm.run()
-            #if self.vm.stack: print(self.vm.pop())
+                if self.optimizer: ast = self.optimizer.optimize(ast)
 
-            rlt = self.interp.interpret(ast, ids=ids)
+                if self.engine == 'vm':
+                    start = self.compiler.pc
+                    self.compiler.compile(ast)
+                    if self.peephole: self.peephole.optimize(start)
+                    if cache: saveCache(*cache, self.compiler)
+                    rlt = self.runVM()
+                elif self.engine == 'py':
+                    code = self.interp.transpile(ast, resolved=True)
+                    if cache: saveCode(*cache, *code)
+                    rlt = self.interp.run(*code)
+                else:
+                    rlt = self.interp.interpret(ast, resolved=True)
             if rlt is not None: print(stringify(rlt))
         except LoxError as ex:
             print(ex)
             self.hadError = True
 
-    def runFile(self, path):
-        data = open(path).read()
-        self.run(data)
+    def runVM(self):
+        self.vm.replace(self.compiler.code, self.compiler.data, self.compiler.lines, self.compiler.notes, self.compiler.names)
+        #self.vm.print()
+        return self.vm.run(stats=self.stats)
+
+    def runFile(self, path, cache=True):
+        cache = cache and self.engine in Lox.CacheFiles
+        with open(path) as f:   # streamed, the whole script is never held in memory
+            if cache:
+                key = sourceKey(RegexScanner.chunksOf(f), optimize=self.optimizer is not None)
+                cache = os.path.splitext(path)[0] + Lox.CacheFiles[self.engine], key
+                f.seek(0)
+            self.run(RegexScanner.chunksOf(f), cache=cache)
         if self.hadError: exit(65)
 
     def runPrompt(self):
@@ -62,15 +116,27 @@ class Lox:
         except KeyboardInterrupt:
             return
 
-    def continueLines(self, tokens):
+    def continueLines(self, tokens, columns):
         self.tokens.extend(tokens)
-        if Scanner.checkParen(self.tokens) > 0:  # uncompleted
-            tokens = []
+        self.columns.extend(columns)
+        self.parens = paren, brace = Scanner.countParens(tokens, self.parens)  # only the new line is counted
+        if (paren or brace) > 0:  # uncompleted
+            tokens, columns = [], None
             self.tokens.pop()   # pop EOF
+            self.columns.pop()
         else:   # matched or error
-            tokens = self.tokens
-            self.tokens = []
-        return tokens
+            tokens, columns = self.tokens, self.columns
+            self.tokens, self.columns, self.parens = [], array('I'), (0, 0)
+        return tokens, columns
+
+    @contextmanager
+    def profiled(self, profiler):
+        'profile the programs run in the with block, see Profiler'
+        with profiler.hooked(self.vm if self.engine == 'vm' else self.interp):
+            try:
+                yield
+            finally:
+                profiler.unwind()
 
     def alarmErrors(self, title, errors):
         for ex in errors: print(ex)
@@ -79,11 +145,46 @@ class Lox:
 
 
 if __name__ == "__main__":
-    from sys import argv
-    lox = Lox()
-    if len(argv) == 2:
-        lox.runFile(argv[1])
-    elif len(argv) == 1:
-        lox.runPrompt()
-    else:
-        print("usage: %s [script]" % argv[0])
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('script', nargs='?')
+    parser.add_argument('--engine', choices=Lox.Engines, default='interp',
+                        help='execution engine (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help="don't read or write the .loxc byte code cache of the vm engine, or the .loxpy one of py")
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help="don't fold constants, drop unreachable code and rewrite the vm's byte code before running")
+    parser.add_argument('--profile', action='store_true',
+                        help='print calls and time of each function to stderr at exit')
+    parser.add_argument('--profile-out', metavar='FILE',
+                        help='save the profile to FILE instead: collapsed stacks if it ends with .folded, else pstats')
+    parser.add_argument('--vm-stats', action='store_true',
+                        help='count executed opcodes, loops and hot blocks of the vm engine, print them to stderr at exit')
+    parser.add_argument('--vm-stats-out', metavar='FILE',
+                        help='save the vm stats to FILE as JSON instead')
+    parser.add_argument('--max-depth', type=int, metavar='N',
+                        help='nested calls allowed to the vm engine, beyond them a stack overflow error is raised '
+                             '(default: {}); its frames are on the heap, so N is a memory budget'.format(StackVM.MaxDepth))
+    args = parser.parse_args()
+    if (args.vm_stats or args.vm_stats_out) and args.engine != 'vm':
+        parser.error('--vm-stats needs --engine vm')
+    if (args.profile or args.profile_out) and args.engine == 'py':
+        parser.error('--profile is not supported by --engine py')
+    if args.max_depth is not None and args.engine != 'vm':
+        parser.error('--max-depth needs --engine vm')
+    lox = Lox(engine=args.engine, optimize=args.optimize)
+    if args.max_depth is not None: lox.vm.maxDepth = args.max_depth
+    run = (lambda: lox.runFile(args.script, cache=args.cache)) if args.script else lox.runPrompt
+    profiler = Profiler(args.script or '<stdin>') if args.profile or args.profile_out else None
+    if args.vm_stats or args.vm_stats_out: lox.stats = VMStats(lox.vm)
+    try:
+        if profiler:
+            with lox.profiled(profiler): run()
+        else:
+            run()
+    finally:   # also when exit(65)
+        if profiler and args.profile_out: profiler.dump(args.profile_out)
+        elif profiler: profiler.report()
+        if lox.stats and args.vm_stats_out:
+            with open(args.vm_stats_out, 'w') as f: json.dump(lox.stats.asdict(), f, indent=1)
+        elif lox.stats: lox.stats.report()